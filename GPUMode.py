@@ -1,32 +1,2341 @@
 #!/usr/bin/env python3
-import gi
-gi.require_version('Gtk', '3.0')
-gi.require_version('AppIndicator3', '0.1')
-gi.require_version('Notify', '0.7')
-gi.require_version('UPowerGlib', '1.0')
-from gi.repository import Gtk, AppIndicator3, Notify, GLib, UPowerGlib
 import subprocess
 import threading
 import os
 import sys
 import fcntl
+import time
+import ctypes
+import json
+import shutil
+import argparse
+import statistics
+import importlib
+import configparser
+import difflib
+import hashlib
+import select
+import signal
+import pty
+import errno
+import socket
+import re
+import shlex
 import logging
+from array import array
+from collections import deque
+from contextlib import nullcontext
 from pathlib import Path
 
+from gpumode_common import (
+    MetricsStore, PowerHistory, log_event, print_events, setup_logging,
+    PCI_VENDOR_NVIDIA, PCI_CLASS_DISPLAY, display_devices, live_gpu_mode,
+)
+
+# gi.repository modules, imported on demand by load_gi_modules()
+Gtk = AppIndicator3 = Notify = GLib = UPowerGlib = None
+GI_VERSIONS = {
+    'Gtk': '3.0',
+    'AppIndicator3': '0.1',
+    'Notify': '0.7',
+    'UPowerGlib': '1.0',
+}
+
+STARTED_AT = time.monotonic()
+
 VERSION = "1.0.0"
-LOCK_FILE = "/tmp/gpumode.lock"
 LOG_DIR = Path.home() / ".local/share/gpumode"
 LOG_FILE = LOG_DIR / "gpumode.log"
+EVENTS_FILE = LOG_DIR / "events.jsonl"
 SETTINGS_FILE = LOG_DIR / "settings.conf"
+STATE_FILE = LOG_DIR / "state.json"
+METRICS_FILE = LOG_DIR / "metrics.bin"
+POWER_HISTORY_FILE = LOG_DIR / "power.bin"
+APP_INDEX_FILE = LOG_DIR / "apps.json"
+# Per-user runtime state served to other clients (tray, CLI, prompts, widgets)
+RUNTIME_DIR = Path(os.environ.get("XDG_RUNTIME_DIR", f"/run/user/{os.getuid()}")) / "gpumode"
+SOCKET_PATH = RUNTIME_DIR / "control.sock"
+RUNTIME_STATE_FILE = RUNTIME_DIR / "state.json"
+# Per-user instance lock shared by the tray, --daemon and in-process CLI switches
+LOCK_FILE = RUNTIME_DIR / "gpumode.lock"
+CONTROL_TIMEOUT = 2.0
+CONTROL_MAX_REQUEST = 4096
+SETTINGS_SECTION = "gpumode"
+SETTINGS_DEFAULTS = {
+    'power_prompts': 'enabled',
+    # Seconds before a running switch is killed
+    'switch_timeout': '600',
+    # node_exporter textfile to keep updated with operation timings (empty = off)
+    'metrics_textfile': '',
+    # Warn when the dGPU has not runtime-suspended for this long in hybrid mode (0 = off)
+    'rtd3_warn_minutes': '15',
+    # Desktop file IDs pinned to the top of "Run on Discrete GPU", comma-separated
+    'dgpu_apps': '',
+}
+# Rules for power-change suggestions, see PowerPolicy
+POLICY_SECTION = "policy"
+POLICY_ACTIONS = ("notify", "schedule")
+POLICY_DEFAULTS = {
+    # notify = suggest a switch; schedule = run the switch so it applies on next reboot
+    'action': 'notify',
+    'debounce': '30',
+    'cooldown': '1800',
+    'battery_percent_below': '100',
+    'battery_minutes_below': '0',
+    'hysteresis_percent': '5',
+}
+SETTINGS_SECTIONS = {SETTINGS_SECTION: SETTINGS_DEFAULTS, POLICY_SECTION: POLICY_DEFAULTS}
+STARTUP_BENCHMARK_TIMEOUT = 30
+
+SYSFS_ROOT = os.environ.get("GPUMODE_SYSFS_ROOT", "/sys")
+CONFIG_ROOT = os.environ.get("GPUMODE_CONFIG_ROOT", "/")
+PROC_ROOT = os.environ.get("GPUMODE_PROC_ROOT", "/proc")
+# Prebuilt per-mode config sets and initramfs images (written as root)
+STAGE_DIR = Path(os.environ.get("GPUMODE_STAGE_DIR", "/var/cache/gpumode/stages"))
+STAGED_MODES = ("integrated", "hybrid")
+# Packages whose updates change what dracut puts into an initramfs
+STAGE_KEY_PACKAGES = ("dracut", "systemd", "linux-firmware")
+# Config dracut reads, relative to CONFIG_ROOT; a staged image is stale once any of it changes
+STAGE_KEY_CONFIG = ("etc/dracut.conf", "etc/dracut.conf.d", "usr/lib/dracut/dracut.conf.d",
+                    "etc/crypttab", "etc/vconsole.conf", "etc/locale.conf")
+HYBRID_RTD3_LEVEL = "2"
+# Boot images envycontrol rebuilds (rescue and kdump images are left alone)
+INITRAMFS_GLOB = "boot/initramfs-*.img"
+INITRAMFS_SKIP = ("rescue", "kdump")
+# Kernel "Apply Now" restarts into through kexec, relative to CONFIG_ROOT
+KERNEL_IMAGE_TEMPLATE = "boot/vmlinuz-{kernel}"
+# --reboot-into phases -> progress labels
+REBOOT_PHASES = {
+    'check': 'Checking the new configuration',
+    'load': 'Loading the kernel',
+    'reboot': 'Restarting',
+}
+# Exit code of --stage-apply when no usable staged set exists (caller falls back to envycontrol)
+STAGE_EXIT_UNAVAILABLE = 3
+# pkexec target for the root operations; polkit allows only this helper, not gpumode itself
+GPUMODE_HELPER = os.environ.get("GPUMODE_HELPER", "/usr/libexec/gpumode/gpumode-helper")
+# The only options gpumode accepts when running as root (through the helper)
+ROOT_OPTIONS = ('stage_prepare', 'stage_apply', 'force', 'reboot_into')
+# Safety net for changes inotify cannot see (sysfs only notifies on some nodes)
+MODE_CACHE_TTL = 300
+# Minimum seconds between background mode probes
+MODE_REFRESH_INTERVAL = 2.0
+# dGPU runtime PM sampling (hybrid mode) and residency windows, seconds
+RTD3_SAMPLE_INTERVAL = 10
+RTD3_WINDOWS = (60, 600, 3600)
+# While the dGPU is awake, look for processes holding it this often (seconds)
+GPU_HOLDER_SCAN_INTERVAL = 30
+NVIDIA_DEV_PREFIX = "/dev/nvidia"
+GPU_HOLDER_MENU_MAX = 3
+# Battery discharge sampling (seconds) and the in-memory ring of recent samples
+BATTERY_SAMPLE_INTERVAL = 30
+BATTERY_RING_SIZE = 240
+BATTERY_RECENT_WINDOW = 600
+# Per-mode figures are only quoted once a mode has this many samples (about 30 minutes)
+BATTERY_MIN_SAMPLES = 60
+TUNED_ACTIVE_PROFILE = "etc/tuned/active_profile"
+APP_INDEX_VERSION = 1
+# NVIDIA PRIME render offload, the same variables switcheroo-control sets
+PRIME_OFFLOAD_ENV = {
+    '__NV_PRIME_RENDER_OFFLOAD': '1',
+    '__GLX_VENDOR_LIBRARY_NAME': 'nvidia',
+    '__VK_LAYER_NV_optimus': 'NVIDIA_only',
+}
+# Desktop entry Exec field codes that expand to nothing when no files are passed
+EXEC_DROPPED_CODES = {'%f', '%F', '%u', '%U', '%d', '%D', '%n', '%N', '%v', '%m'}
+
+# Files envycontrol writes, relative to CONFIG_ROOT
+ENVYCONTROL_BLACKLIST = "etc/modprobe.d/blacklist-nvidia.conf"
+ENVYCONTROL_UDEV_INTEGRATED = "lib/udev/rules.d/50-remove-nvidia.rules"
+ENVYCONTROL_UDEV_PM = "lib/udev/rules.d/80-nvidia-pm.rules"
+ENVYCONTROL_MODESET = "etc/modprobe.d/nvidia.conf"
+ENVYCONTROL_XORG = "etc/X11/xorg.conf"
+ENVYCONTROL_EXTRA_XORG = "etc/X11/xorg.conf.d/10-nvidia.conf"
+ENVYCONTROL_FILES = [
+    ENVYCONTROL_BLACKLIST,
+    ENVYCONTROL_UDEV_INTEGRATED,
+    ENVYCONTROL_UDEV_PM,
+    ENVYCONTROL_MODESET,
+    ENVYCONTROL_XORG,
+    ENVYCONTROL_EXTRA_XORG,
+]
+
+
+class StageError(Exception):
+    """A staged switch cannot be prepared or applied"""
+
+
+class ControlError(Exception):
+    """The running service did not answer a control request properly"""
+
+
+def envycontrol_command(mode):
+    """envycontrol arguments used for every switch to `mode`"""
+    cmd = ['envycontrol', '-s', mode]
+    if mode == 'hybrid':
+        cmd.extend(['--rtd3', HYBRID_RTD3_LEVEL])
+    return cmd
+
+
+# envycontrol/dracut/staged-apply output -> (phase, label); phases only move forward.
+# Patterns match whole-line messages from those tools (optionally behind a
+# logging "INFO: " / "INFO - " prefix), not words that may occur anywhere.
+SWITCH_PHASES = [
+    ('auth', 'Waiting for authentication', None),
+    ('config', 'Writing configuration',
+     re.compile(r'^(?:INFO\W+)?(?:Created file |Removed file |Installing staged set )')),
+    ('initramfs', 'Rebuilding initramfs',
+     re.compile(r'^(?:INFO\W+)?(?:Rebuilding the initramfs|Kept the previous initramfs )|^dracut\b')),
+    ('done', 'Finishing',
+     re.compile(r'^(?:INFO\W+)?(?:Operation completed successfully|Applied staged set )')),
+]
+# Colour and cursor sequences a tool may emit now that it writes to a terminal
+ANSI_ESCAPE = re.compile(r'\x1b\[[0-9;?]*[A-Za-z]')
+
+
+class Settings:
+    """settings.conf (INI); older versions stored only "enabled"/"disabled" """
+
+    def __init__(self, path=SETTINGS_FILE):
+        self.path = Path(path)
+        self.parser = configparser.ConfigParser()
+        self.parser.read_dict(SETTINGS_SECTIONS)
+        self.load()
+
+    def load(self):
+        try:
+            text = self.path.read_text()
+        except OSError:
+            return
+        if text.strip() in ("enabled", "disabled"):
+            self.parser[SETTINGS_SECTION]['power_prompts'] = text.strip()
+            return
+        try:
+            self.parser.read_string(text)
+        except configparser.Error as e:
+            logging.error(f"Ignoring malformed settings file: {e}")
+
+    def get(self, key, section=SETTINGS_SECTION):
+        return self.parser.get(section, key, fallback=None)
+
+    def getfloat(self, key, section=SETTINGS_SECTION, fallback=None):
+        try:
+            return self.parser.getfloat(section, key)
+        except (ValueError, configparser.Error):
+            return fallback if fallback is not None else float(SETTINGS_SECTIONS[section][key])
+
+    def set(self, key, value, section=SETTINGS_SECTION):
+        if not self.parser.has_section(section):
+            self.parser.add_section(section)
+        self.parser.set(section, key, str(value))
+
+    def save(self):
+        tmp = self.path.with_suffix('.tmp')
+        with open(tmp, 'w') as f:
+            self.parser.write(f)
+        tmp.replace(self.path)
+
+
+class SwitchProcess:
+    """Run a (privileged) switch command, streaming its output as progress phases"""
+
+    def __init__(self, cmd, timeout, on_phase=None):
+        self.cmd = cmd
+        self.timeout = timeout
+        self.on_phase = on_phase
+        self.proc = None
+        self.phase = 0
+        self.cancelled = False
+        # Past the timeout but running as root, so it could not be stopped
+        self.overrun = False
+        self.output = []
+
+    def _set_phase(self, index):
+        if index > self.phase:
+            self.phase = index
+            name, label, _ = SWITCH_PHASES[index]
+            logging.info(f"Switch phase: {label}")
+            if self.on_phase:
+                self.on_phase(name, label)
+
+    def _handle_line(self, line):
+        line = ANSI_ESCAPE.sub('', line)
+        self.output.append(line)
+        for index, (_, _, pattern) in enumerate(SWITCH_PHASES):
+            if pattern is not None and pattern.search(line):
+                self._set_phase(index)
+
+    def run(self):
+        """Run to completion; returns the exit code, raises TimeoutExpired"""
+        started = time.monotonic()
+        if self.on_phase:
+            self.on_phase(*SWITCH_PHASES[0][:2])
+        # A pty, not a pipe: envycontrol (Python) and dracut line-buffer only
+        # when writing to a terminal, and pkexec clears PYTHONUNBUFFERED
+        fd, slave = pty.openpty()
+        try:
+            self.proc = subprocess.Popen(self.cmd, stdout=slave, stderr=slave, stdin=subprocess.DEVNULL)
+        except BaseException:
+            os.close(fd)
+            raise
+        finally:
+            os.close(slave)
+        buffer = b''
+        try:
+            while True:
+                remaining = started + self.timeout - time.monotonic()
+                if remaining <= 0 and not self.overrun:
+                    logging.error(f"Switch command exceeded {self.timeout:.0f}s, stopping it")
+                    if self.terminate():
+                        raise subprocess.TimeoutExpired(self.cmd, self.timeout)
+                    # Keep reading: closing the pipe would kill envycontrol/dracut midway
+                    self.overrun = True
+                    logging.warning("Switch command runs as root and cannot be stopped, waiting for it")
+                    if self.on_phase:
+                        self.on_phase('overrun', f"Still running as root ({self.timeout:.0f}s limit passed)")
+                ready, _, _ = select.select([fd], [], [], 1.0 if self.overrun else min(remaining, 1.0))
+                if not ready:
+                    continue
+                try:
+                    chunk = os.read(fd, 4096)
+                except OSError as e:
+                    # Linux reports EIO on the master once every writer closed the slave
+                    if e.errno != errno.EIO:
+                        raise
+                    chunk = b''
+                if not chunk:
+                    break
+                buffer += chunk
+                *lines, buffer = buffer.split(b'\n')
+                for line in lines:
+                    self._handle_line(line.decode(errors='replace').rstrip())
+            if buffer:
+                self._handle_line(buffer.decode(errors='replace').rstrip())
+            return self.proc.wait()
+        finally:
+            os.close(fd)
+
+    def terminate(self):
+        """Stop the process; only possible while pkexec still runs as the user"""
+        if self.proc is None or self.proc.poll() is not None:
+            return False
+        try:
+            self.proc.send_signal(signal.SIGTERM)
+            return True
+        except PermissionError:
+            logging.warning("Switch process already runs as root and cannot be stopped")
+            return False
+
+    def cancel(self):
+        """Stop the process; only counts as cancelled if the signal was delivered"""
+        if self.terminate():
+            self.cancelled = True
+        return self.cancelled
+
+    def error_text(self):
+        return "\n".join(self.output[-5:])
+
+
+def load_gi_modules(*names):
+    """Import gi.repository modules on demand and publish them as module globals"""
+    import gi
+    for name in names:
+        if globals()[name] is not None:
+            continue
+        if name in GI_VERSIONS:
+            gi.require_version(name, GI_VERSIONS[name])
+        globals()[name] = importlib.import_module(f'gi.repository.{name}')
+
+
+class InotifyWatch:
+    """Minimal non-blocking inotify wrapper (libc via ctypes)"""
+
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+                  IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
 
-class GPUIndicator:
     def __init__(self):
-        LOG_DIR.mkdir(parents=True, exist_ok=True)
-        logging.basicConfig(
-            filename=LOG_FILE,
-            level=logging.INFO,
-            format='%(asctime)s - %(levelname)s - %(message)s'
-        )
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {}
+
+    def add(self, path):
+        """Watch a file or directory; missing paths are ignored"""
+        path = str(path)
+        if path in self.watches or not os.path.exists(path):
+            return False
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), self.WATCH_MASK)
+        if wd < 0:
+            return False
+        self.watches[path] = wd
+        return True
+
+    def pending(self):
+        """Drain queued events, return True if anything changed since last call"""
+        changed = False
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            if not data:
+                break
+            changed = True
+        return changed
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class ModeProbe:
+    """Work out the GPU mode from sysfs and envycontrol config files, cached"""
+
+    def __init__(self, sysfs_root=SYSFS_ROOT, config_root=CONFIG_ROOT, ttl=MODE_CACHE_TTL,
+                 metrics=None):
+        self.sysfs_root = Path(sysfs_root)
+        self.metrics = metrics
+        self.config_root = Path(config_root)
+        self.ttl = ttl
+        self.cached_mode = None
+        self.cached_at = 0.0
+        self.configured_mode = None
+        self.lock = threading.Lock()
+        self.watch = None
+        try:
+            self.watch = InotifyWatch()
+        except (OSError, AttributeError) as e:
+            logging.warning(f"inotify unavailable, mode cache uses TTL only: {e}")
+
+    def _watch_paths(self):
+        # Directory watches also report changes to the files inside them
+        paths = {(self.config_root / f).parent for f in ENVYCONTROL_FILES}
+        paths.add(self.config_root / "etc/X11")
+        paths.add(self.sysfs_root / "bus/pci/devices")
+        paths.add(self.sysfs_root / "bus/pci/drivers/nvidia")
+        paths.add(self.sysfs_root / "class/drm")
+        return paths
+
+    def display_devices(self):
+        """List PCI display controllers with vendor, driver binding and boot_vga"""
+        return display_devices(self.sysfs_root)
+
+    def probe_configured_mode(self):
+        """Mode envycontrol has configured on disk (same rules as envycontrol --query)"""
+        root = self.config_root
+        if (root / ENVYCONTROL_BLACKLIST).exists() and (root / ENVYCONTROL_UDEV_INTEGRATED).exists():
+            return "integrated"
+        if (root / ENVYCONTROL_XORG).exists():
+            return "nvidia"
+        return "hybrid"
+
+    def probe_live_mode(self, configured):
+        """Mode the running system is in, or None if sysfs is inconclusive"""
+        return live_gpu_mode(self.display_devices(), configured)
+
+    def invalidate(self):
+        with self.lock:
+            self.cached_mode = None
+
+    def _is_fresh(self):
+        if self.cached_mode is None:
+            return False
+        if self.watch is not None and self.watch.pending():
+            logging.info("GPU config/sysfs changed, invalidating mode cache")
+            return False
+        return time.monotonic() - self.cached_at < self.ttl
+
+    def get_mode(self):
+        """Return cached mode, re-probing only when watched paths changed"""
+        with self.lock:
+            if self._is_fresh():
+                return self.cached_mode
+            if self.watch is not None:
+                for path in self._watch_paths():
+                    self.watch.add(path)
+            with self.metrics.timed('probe_mode') if self.metrics else nullcontext():
+                configured = self.probe_configured_mode()
+                live = self.probe_live_mode(configured)
+            mode = live if live is not None else configured
+            if mode != self.cached_mode:
+                logging.info(f"Detected {mode} mode via sysfs (configured: {configured})")
+            self.configured_mode = configured
+            self.cached_mode = mode
+            self.cached_at = time.monotonic()
+            return mode
+
+
+class RuntimePMMonitor:
+    """Sample the dGPU's runtime PM counters and compute suspended-time residency
+
+    Only power/runtime_* attributes are read; they do not resume a suspended
+    device. Counters are in milliseconds and reset when the device is re-added.
+    """
+
+    def __init__(self, sysfs_root=SYSFS_ROOT, bdf=None, clock=time.monotonic):
+        self.sysfs_root = Path(sysfs_root)
+        self.bdf = bdf
+        self.clock = clock
+        self.samples = deque(maxlen=int(max(RTD3_WINDOWS) / RTD3_SAMPLE_INTERVAL) + 2)
+        self.status = None
+        self.started = None
+        self.last_suspended = None
+
+    def find_dgpu(self):
+        """PCI address of the NVIDIA display controller, or None"""
+        pci_dir = self.sysfs_root / "bus/pci/devices"
+        try:
+            devices = sorted(pci_dir.iterdir())
+        except OSError:
+            return None
+        for dev in devices:
+            try:
+                if ((dev / "vendor").read_text().strip() == PCI_VENDOR_NVIDIA
+                        and (dev / "class").read_text().startswith(PCI_CLASS_DISPLAY)):
+                    return dev.name
+            except OSError:
+                continue
+        return None
+
+    def reset(self):
+        self.samples.clear()
+        self.status = None
+        self.started = None
+        self.last_suspended = None
+
+    def sample(self):
+        """Take one sample; returns the runtime status or None if there is no dGPU"""
+        if self.bdf is None:
+            self.bdf = self.find_dgpu()
+            if self.bdf is None:
+                return None
+        power = self.sysfs_root / "bus/pci/devices" / self.bdf / "power"
+        try:
+            status = (power / "runtime_status").read_text().strip()
+            suspended = int((power / "runtime_suspended_time").read_text())
+            active = int((power / "runtime_active_time").read_text())
+        except (OSError, ValueError):
+            # Removed (integrated mode) or runtime PM not available
+            self.bdf = None
+            self.reset()
+            return None
+        now = self.clock()
+        # Either counter going backwards means the device was re-added and they restarted
+        if self.samples and (suspended < self.samples[-1][1] or active < self.samples[-1][2]):
+            self.samples.clear()
+        if self.started is None:
+            self.started = now
+        if status == "suspended" or (self.samples and suspended > self.samples[-1][1]):
+            self.last_suspended = now
+        self.samples.append((now, suspended, active))
+        self.status = status
+        return status
+
+    def residency(self, window):
+        """Fraction of the last `window` seconds (or as much as was sampled) spent suspended"""
+        if len(self.samples) < 2:
+            return None
+        newest = self.samples[-1]
+        # Baseline: the last sample at or before the window start, else the oldest one
+        oldest = self.samples[0]
+        for sample in self.samples:
+            if sample[0] > newest[0] - window:
+                break
+            oldest = sample
+        suspended = newest[1] - oldest[1]
+        total = suspended + newest[2] - oldest[2]
+        return suspended / total if total > 0 else None
+
+    def awake_for(self):
+        """Seconds since the dGPU was last seen suspended (or since monitoring began)"""
+        if self.status is None:
+            return None
+        return self.clock() - (self.last_suspended if self.last_suspended is not None else self.started)
+
+    def summary(self):
+        if self.status is None:
+            return None
+        return {
+            'bdf': self.bdf,
+            'status': self.status,
+            'awake_for': self.awake_for(),
+            'residency': {f"{w // 60}m": self.residency(w) for w in RTD3_WINDOWS},
+        }
+
+
+class GPUHolderScanner:
+    """Find processes holding the dGPU's device nodes open
+
+    Every scan resolves every fd of every process. Caching fd targets between
+    scans misses a process that closes an fd and reopens the same number on
+    (or off) the GPU, and checking an fd for such a change costs the same
+    syscall as resolving it. The scan only runs while the dGPU is awake and
+    then every GPU_HOLDER_SCAN_INTERVAL seconds, so it stays cheap.
+    """
+
+    def __init__(self, proc_root=PROC_ROOT, sysfs_root=SYSFS_ROOT, bdf=None, metrics=None):
+        self.proc_root = Path(proc_root)
+        self.sysfs_root = Path(sysfs_root)
+        self.bdf = bdf
+        self.metrics = metrics
+        self.denied = 0
+
+    def dgpu_nodes(self):
+        """/dev/dri nodes of the dGPU (the /dev/nvidia* nodes are matched by prefix)"""
+        if self.bdf is None:
+            self.bdf = RuntimePMMonitor(self.sysfs_root).find_dgpu()
+        if self.bdf is None:
+            return set()
+        drm_dir = self.sysfs_root / "bus/pci/devices" / self.bdf / "drm"
+        try:
+            return {f"/dev/dri/{node.name}" for node in drm_dir.iterdir()
+                    if node.name.startswith(("card", "renderD"))}
+        except OSError:
+            return set()
+
+    def _scan_pid(self, pid, nodes):
+        """dGPU nodes `pid` holds open, or None if its fds cannot be listed"""
+        fd_dir = self.proc_root / pid / "fd"
+        try:
+            fds = os.listdir(fd_dir)
+        except PermissionError:
+            self.denied += 1
+            return None
+        except OSError:
+            return None
+        devices = set()
+        for fd in fds:
+            try:
+                target = os.readlink(fd_dir / fd)
+            except OSError:
+                continue
+            if target.startswith(NVIDIA_DEV_PREFIX) or target in nodes:
+                devices.add(target)
+        return devices
+
+    def scan(self):
+        """Return [{'pid', 'name', 'devices'}] for processes holding a dGPU node"""
+        with self.metrics.timed('scan_gpu_holders') if self.metrics else nullcontext():
+            nodes = self.dgpu_nodes()
+            self.denied = 0
+            holders = []
+            try:
+                pids = [p for p in os.listdir(self.proc_root) if p.isdigit()]
+            except OSError:
+                return holders
+            for pid in pids:
+                devices = self._scan_pid(pid, nodes)
+                if not devices:
+                    continue
+                try:
+                    name = (self.proc_root / pid / "comm").read_text().strip()
+                except OSError:
+                    name = "?"
+                holders.append({'pid': int(pid), 'name': name, 'devices': sorted(devices)})
+        holders.sort(key=lambda h: h['pid'])
+        return holders
+
+
+class BatterySampler:
+    """Sample battery discharge power into a fixed-size in-memory ring and PowerHistory
+
+    The ring (two preallocated arrays) holds the recent samples for quick
+    averages; the mmap-backed history keeps the long-term per-mode record.
+    """
+
+    def __init__(self, history, sysfs_root=SYSFS_ROOT, size=BATTERY_RING_SIZE, clock=time.monotonic):
+        self.history = history
+        self.sysfs_root = Path(sysfs_root)
+        self.clock = clock
+        self.times = array('d', [0.0]) * size
+        self.watts = array('f', [0.0]) * size
+        self.head = 0
+        self.count = 0
+        self.battery = None
+
+    def find_battery(self):
+        for supply in sorted(Path(self.sysfs_root, "class/power_supply").glob("BAT*")):
+            try:
+                if (supply / "type").read_text().strip() == "Battery":
+                    return supply
+            except OSError:
+                continue
+        return None
+
+    def _read_int(self, name):
+        try:
+            return int((self.battery / name).read_text())
+        except (OSError, ValueError):
+            return None
+
+    def read_discharge_watts(self):
+        """Current discharge power in watts, None when not discharging or unknown"""
+        if self.battery is None:
+            self.battery = self.find_battery()
+            if self.battery is None:
+                return None
+        try:
+            status = (self.battery / "status").read_text().strip()
+        except OSError:
+            self.battery = None
+            return None
+        if status != "Discharging":
+            return None
+        power = self._read_int("power_now")
+        if power is None:
+            current, voltage = self._read_int("current_now"), self._read_int("voltage_now")
+            if current is None or voltage is None:
+                return None
+            power = abs(current) * voltage / 1e6
+        # sysfs reports microwatts
+        return abs(power) / 1e6 if power else None
+
+    def full_energy_wh(self):
+        """Energy of a full charge in Wh, None if the battery does not report it"""
+        if self.battery is None:
+            return None
+        energy = self._read_int("energy_full")
+        if energy is None:
+            charge, voltage = self._read_int("charge_full"), self._read_int("voltage_min_design")
+            if charge is None or voltage is None:
+                return None
+            energy = charge * voltage / 1e6
+        return energy / 1e6
+
+    def sample(self, mode, profile):
+        """Take one sample; returns watts or None when the battery is not discharging"""
+        watts = self.read_discharge_watts()
+        if watts is None:
+            return None
+        self.times[self.head] = self.clock()
+        self.watts[self.head] = watts
+        self.head = (self.head + 1) % len(self.times)
+        self.count = min(self.count + 1, len(self.times))
+        self.history.append(watts, mode, profile)
+        return watts
+
+    def recent_watts(self, window=BATTERY_RECENT_WINDOW):
+        """Average discharge power over the last `window` seconds of samples"""
+        now = self.clock()
+        values = [self.watts[(self.head - 1 - i) % len(self.times)] for i in range(self.count)
+                  if now - self.times[(self.head - 1 - i) % len(self.times)] <= window]
+        return sum(values) / len(values) if values else None
+
+    def mode_stats(self, since=None):
+        """{mode: {'samples', 'watts', 'hours'}} from the history; hours on a full charge"""
+        full = self.full_energy_wh()
+        return {
+            mode: {'samples': count, 'watts': watts, 'hours': full / watts if full and watts else None}
+            for mode, (count, watts) in self.history.stats(since).items()
+        }
+
+
+def read_tuned_profile():
+    """Active TuneD profile (as written by tuned), or "" if unknown"""
+    try:
+        return Path(CONFIG_ROOT, TUNED_ACTIVE_PROFILE).read_text().strip()
+    except OSError:
+        return ""
+
+
+class StagedSwitch:
+    """Per-mode envycontrol config sets and initramfs images, built ahead of time
+
+    prepare() runs envycontrol once per mode and snapshots the files it wrote
+    plus the regenerated initramfs. apply() then swaps a prepared set into
+    place, which takes seconds instead of a full envycontrol/dracut run.
+    Snapshots are keyed on kernel release, NVIDIA driver and envycontrol
+    versions, the dracut, systemd and linux-firmware packages, and the
+    content of dracut's config and /etc/crypttab; they are ignored once any
+    of them changes, so an image never reverts a later dracut input. The
+    replaced image is kept as <image>.gpumode-bak. Both need root.
+    """
+
+    def __init__(self, config_root=CONFIG_ROOT, stage_dir=STAGE_DIR, kernel=None):
+        self.root = Path(config_root)
+        self.stage_dir = Path(stage_dir)
+        self.kernel = kernel or os.uname().release
+        self._key = None
+
+    def initramfs_path(self):
+        return self.root / f"boot/initramfs-{self.kernel}.img"
+
+    def _command_output(self, cmd):
+        try:
+            result = subprocess.run(cmd, capture_output=True, text=True, timeout=10)
+            return result.stdout.strip() if result.returncode == 0 else None
+        except (OSError, subprocess.TimeoutExpired):
+            return None
+
+    def package_versions(self):
+        """{package: NEVRA or None} for STAGE_KEY_PACKAGES"""
+        return {name: self._command_output(['rpm', '-q', '--qf', '%{NEVRA}', name])
+                for name in STAGE_KEY_PACKAGES}
+
+    def config_digest(self):
+        """Hash of the dracut config files' paths, sizes and mtimes
+
+        Metadata rather than content, so the tray (not root) gets the same
+        key as --stage-apply: /etc/crypttab is only readable by root.
+        """
+        digest = hashlib.sha256()
+        for rel in STAGE_KEY_CONFIG:
+            base = self.root / rel
+            paths = sorted(p for p in base.rglob("*") if p.is_file()) if base.is_dir() else [base]
+            for path in paths:
+                try:
+                    st = path.stat()
+                except OSError:
+                    continue
+                digest.update(f"{path.relative_to(self.root)}\0{st.st_size}\0{st.st_mtime_ns}\n".encode())
+        return digest.hexdigest()
+
+    def cache_key(self):
+        """Versions and config a prepared set depends on"""
+        if self._key is None:
+            self._key = {
+                'kernel': self.kernel,
+                'nvidia': self._command_output(['modinfo', '-F', 'version', '-k', self.kernel, 'nvidia']),
+                'envycontrol': self._command_output(['envycontrol', '--version']),
+                'packages': self.package_versions(),
+                'dracut_config': self.config_digest(),
+            }
+        return self._key
+
+    def manifest(self, mode):
+        try:
+            return json.loads((self.stage_dir / mode / "manifest.json").read_text())
+        except (OSError, ValueError):
+            return None
+
+    def is_ready(self, mode):
+        """True if a prepared set for `mode` exists and matches the running versions"""
+        manifest = self.manifest(mode)
+        return (manifest is not None and manifest.get('key') == self.cache_key()
+                and (self.stage_dir / mode / "initramfs.img").exists())
+
+    def capture(self, mode):
+        """Snapshot the current envycontrol files and initramfs as the set for `mode`"""
+        image = self.initramfs_path()
+        if not image.exists():
+            raise StageError(f"initramfs {image} not found")
+        mode_dir = self.stage_dir / mode
+        tmp_dir = self.stage_dir / f".{mode}.tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        (tmp_dir / "files").mkdir(parents=True)
+        files = []
+        for rel in ENVYCONTROL_FILES:
+            src = self.root / rel
+            if src.exists():
+                dest = tmp_dir / "files" / rel
+                dest.parent.mkdir(parents=True, exist_ok=True)
+                shutil.copy2(src, dest)
+                files.append(rel)
+        shutil.copy2(image, tmp_dir / "initramfs.img")
+        (tmp_dir / "manifest.json").write_text(json.dumps({
+            'mode': mode,
+            'key': self.cache_key(),
+            'files': files,
+            'created': time.time(),
+        }))
+        shutil.rmtree(mode_dir, ignore_errors=True)
+        tmp_dir.rename(mode_dir)
+        logging.info(f"Captured staged set for {mode}: {len(files)} files + initramfs")
+
+    def prepare(self, modes=STAGED_MODES, force=False):
+        """Build any missing or stale sets, leaving the system in its configured mode"""
+        current = ModeProbe(config_root=self.root).probe_configured_mode()
+        if current not in STAGED_MODES:
+            raise StageError(f"cannot stage from {current} mode")
+        # Prepare the configured mode last so the system ends up where it started
+        order = sorted(modes, key=lambda m: m == current)
+        last_run = current
+        for mode in order:
+            if not force and self.is_ready(mode):
+                print(f"{mode}: already prepared", flush=True)
+                continue
+            print(f"{mode}: running {' '.join(envycontrol_command(mode))}", flush=True)
+            result = subprocess.run(envycontrol_command(mode), capture_output=True, text=True)
+            if result.returncode != 0:
+                raise StageError(f"envycontrol failed for {mode}: {result.stderr.strip()}")
+            self.capture(mode)
+            last_run = mode
+            print(f"{mode}: prepared", flush=True)
+        if last_run != current:
+            self.apply(current)
+
+    def apply(self, mode):
+        """Swap the prepared set for `mode` into place"""
+        if not self.is_ready(mode):
+            raise StageError(f"no up-to-date staged set for {mode}")
+        logging.info(f"Installing staged set for {mode}")
+        manifest = self.manifest(mode)
+        mode_dir = self.stage_dir / mode
+        staged = set(manifest['files'])
+        
+        # Copy everything next to its target first, then rename in one quick pass
+        pending = []
+        for rel in staged:
+            target = self.root / rel
+            target.parent.mkdir(parents=True, exist_ok=True)
+            tmp = target.with_name(f".{target.name}.gpumode-tmp")
+            shutil.copy2(mode_dir / "files" / rel, tmp)
+            pending.append((tmp, target))
+        image = self.initramfs_path()
+        tmp_image = image.with_name(f".{image.name}.gpumode-tmp")
+        shutil.copy2(mode_dir / "initramfs.img", tmp_image)
+        with open(tmp_image, 'rb') as f:
+            os.fsync(f.fileno())
+        
+        self.backup_image(image)
+        for rel in ENVYCONTROL_FILES:
+            if rel not in staged:
+                (self.root / rel).unlink(missing_ok=True)
+        for tmp, target in pending:
+            os.replace(tmp, target)
+        os.replace(tmp_image, image)
+        os.sync()
+        logging.info(f"Applied staged set for {mode}")
+
+    def backup_image(self, image):
+        """Keep the image about to be replaced as <image>.gpumode-bak (a hard link where possible)"""
+        if not image.exists():
+            return
+        backup = image.with_name(f"{image.name}.gpumode-bak")
+        tmp = image.with_name(f".{backup.name}.tmp")
+        tmp.unlink(missing_ok=True)
+        try:
+            os.link(image, tmp)
+        except OSError:
+            shutil.copy2(image, tmp)
+        os.replace(tmp, backup)
+        logging.info(f"Kept the previous initramfs as {backup}")
+
+
+class SwitchPreflight:
+    """Compare the envycontrol files and initramfs on disk with what a mode needs
+
+    Run before a switch, so a target that is already configured (typically a
+    switch still waiting for its reboot) skips the privileged envycontrol and
+    dracut run. Expected file contents come from the mode's staged set when
+    one is up to date, otherwise from the files envycontrol writes per mode.
+    """
+
+    def __init__(self, config_root=CONFIG_ROOT, stages=None):
+        self.root = Path(config_root)
+        self.stages = stages or StagedSwitch(config_root)
+
+    def _read(self, path):
+        try:
+            return path.read_bytes()
+        except OSError:
+            return None
+
+    def expected_files(self, mode):
+        """({file: bytes, True (any content), a regex, or None (absent)}, source)"""
+        if self.stages.is_ready(mode):
+            mode_dir = self.stages.stage_dir / mode / "files"
+            staged = set(self.stages.manifest(mode)['files'])
+            return {rel: self._read(mode_dir / rel) if rel in staged else None
+                    for rel in ENVYCONTROL_FILES}, 'staged'
+        expected = dict.fromkeys(ENVYCONTROL_FILES)
+        if mode == 'integrated':
+            expected[ENVYCONTROL_BLACKLIST] = True
+            expected[ENVYCONTROL_UDEV_INTEGRATED] = True
+        else:
+            expected[ENVYCONTROL_UDEV_PM] = True
+            expected[ENVYCONTROL_MODESET] = re.compile(
+                rf'NVreg_DynamicPowerManagement=0x0*{HYBRID_RTD3_LEVEL}\b'.encode())
+        return expected, 'rules'
+
+    def _file_change(self, rel, want):
+        path = self.root / rel
+        have = self._read(path)
+        if want is None:
+            if have is None:
+                return None
+            return {'path': f"/{rel}", 'action': 'remove', 'diff': self._diff(rel, have, b'')}
+        if have is None:
+            diff = self._diff(rel, b'', want) if isinstance(want, bytes) else None
+            return {'path': f"/{rel}", 'action': 'create', 'diff': diff}
+        if isinstance(want, bytes):
+            if have == want:
+                return None
+            return {'path': f"/{rel}", 'action': 'update', 'diff': self._diff(rel, have, want)}
+        if want is True or want.search(have):
+            return None
+        return {'path': f"/{rel}", 'action': 'update', 'diff': None}
+
+    @staticmethod
+    def _diff(rel, old, new):
+        lines = difflib.unified_diff(old.decode(errors='replace').splitlines(),
+                                     new.decode(errors='replace').splitlines(),
+                                     f"a/{rel}", f"b/{rel}", lineterm='')
+        return list(lines)
+
+    def initramfs_images(self):
+        return [p for p in sorted(self.root.glob(INITRAMFS_GLOB))
+                if not any(word in p.name for word in INITRAMFS_SKIP)]
+
+    def stale_initramfs(self, mode, source):
+        """Initramfs images that predate the current config, or a reason none qualify"""
+        images = self.initramfs_images()
+        if not images:
+            return ["initramfs"]
+        if source == 'staged':
+            staged = self.stages.stage_dir / mode / "initramfs.img"
+            running = self.stages.initramfs_path()
+            try:
+                a, b = staged.stat(), running.stat()
+                # apply() copies the image with copy2, which keeps size and mtime
+                if (a.st_size, a.st_mtime_ns) == (b.st_size, b.st_mtime_ns):
+                    return []
+            except OSError:
+                pass
+        # Removing a file only shows up as a change of its directory; only
+        # etc/modprobe.d is checked, lib/udev/rules.d changes with every package
+        newest = 0
+        for path in [self.root / rel for rel in ENVYCONTROL_FILES] + [self.root / "etc/modprobe.d"]:
+            try:
+                newest = max(newest, path.stat().st_mtime_ns)
+            except OSError:
+                continue
+        stale = []
+        for image in images:
+            try:
+                if image.stat().st_mtime_ns < newest:
+                    stale.append(f"/{image.relative_to(self.root)}")
+            except OSError:
+                continue
+        return stale
+
+    def check(self, mode):
+        """{'mode', 'satisfied', 'source', 'changes': [{'path', 'action', 'diff'}]}"""
+        expected, source = self.expected_files(mode)
+        changes = [c for c in (self._file_change(rel, want) for rel, want in expected.items()) if c]
+        if changes:
+            # envycontrol always rebuilds the initramfs after writing the config
+            changes.append({'path': "initramfs", 'action': 'rebuild', 'diff': None})
+        else:
+            for image in self.stale_initramfs(mode, source):
+                changes.append({'path': image, 'action': 'rebuild', 'diff': None})
+        return {'mode': mode, 'satisfied': not changes, 'source': source, 'changes': changes}
+
+    @staticmethod
+    def summary(changes):
+        """One short line per change, as shown in notifications and the event log"""
+        return [f"{c['action']} {c['path']}" for c in changes]
+
+
+class FastReboot:
+    """Restart into the configured GPU mode, through kexec where that is safe
+
+    kexec loads the running kernel with the regenerated initramfs and
+    `systemctl kexec` restarts into it without going through firmware POST.
+    A normal `systemctl reboot` is used instead under kernel lockdown
+    (Secure Boot), when kexec is disabled or kexec-tools is missing, and
+    whenever loading or starting the kexec kernel fails. systemd's
+    soft-reboot is no option: it keeps the running kernel and its loaded
+    modules, so neither the NVIDIA blacklist nor the new initramfs would
+    take effect. Needs root, except for plan().
+    """
+
+    def __init__(self, config_root=CONFIG_ROOT, sysfs_root=SYSFS_ROOT, proc_root=PROC_ROOT, stages=None):
+        self.root = Path(config_root)
+        self.sysfs_root = Path(sysfs_root)
+        self.proc_root = Path(proc_root)
+        self.stages = stages or StagedSwitch(config_root)
+
+    def kernel_image(self):
+        return self.root / KERNEL_IMAGE_TEMPLATE.format(kernel=self.stages.kernel)
+
+    def lockdown(self):
+        """Active kernel lockdown level ('none', 'integrity', 'confidentiality'), None if unknown"""
+        try:
+            text = (self.sysfs_root / "kernel/security/lockdown").read_text()
+        except OSError:
+            return None
+        match = re.search(r'\[(\w+)\]', text)
+        return match.group(1) if match else None
+
+    def cmdline(self):
+        """Running kernel's command line, without the BOOT_IMAGE= the boot loader adds"""
+        text = (self.proc_root / "cmdline").read_text().strip()
+        return re.sub(r'(^|\s)BOOT_IMAGE=\S+', '', text).strip()
+
+    def kexec_blocker(self):
+        """Why kexec cannot be used on this system, or None"""
+        if shutil.which('kexec') is None:
+            return "kexec-tools is not installed"
+        level = self.lockdown()
+        if level not in (None, 'none'):
+            return f"kernel lockdown ({level}) forbids kexec"
+        try:
+            if (self.proc_root / "sys/kernel/kexec_load_disabled").read_text().strip() == '1':
+                return "kexec is disabled (kernel.kexec_load_disabled)"
+        except OSError:
+            pass
+        for path in (self.kernel_image(), self.stages.initramfs_path()):
+            if not path.exists():
+                return f"/{path.relative_to(self.root)} not found"
+        try:
+            self.cmdline()
+        except OSError as e:
+            return f"cannot read the kernel command line: {e}"
+        return None
+
+    def kexec_command(self):
+        return ['kexec', '--load', str(self.kernel_image()),
+                f'--initrd={self.stages.initramfs_path()}', f'--append={self.cmdline()}']
+
+    def plan(self, mode):
+        """{'mode', 'error', 'method', 'reason', 'commands'} for restarting into `mode`
+
+        error is set when the files on disk do not configure `mode` yet, as a
+        restart would then not change the mode either.
+        """
+        check = SwitchPreflight(self.root, self.stages).check(mode)
+        error = None
+        if not check['satisfied']:
+            error = f"the configuration on disk is not set up for {mode} mode yet (" + \
+                ", ".join(SwitchPreflight.summary(check['changes'])) + ")"
+        reason = self.kexec_blocker()
+        if reason is None:
+            commands = [self.kexec_command(), ['systemctl', 'kexec']]
+        else:
+            commands = [['systemctl', 'reboot']]
+        return {'mode': mode, 'error': error, 'method': 'reboot' if reason else 'kexec',
+                'reason': reason, 'commands': commands}
+
+    def _run(self, cmd):
+        logging.info(f"Running {shlex.join(cmd)}")
+        result = subprocess.run(cmd, capture_output=True, text=True, stdin=subprocess.DEVNULL)
+        error = (result.stderr.strip() or result.stdout.strip() or f"exit code {result.returncode}")
+        return result.returncode == 0, None if result.returncode == 0 else error
+
+    def run(self, plan, report):
+        """Carry out `plan`; report(phase, started, **detail) after each phase. Returns an exit code"""
+        method = plan['method']
+        if method == 'kexec':
+            started = time.monotonic()
+            ok, error = self._run(plan['commands'][0])
+            report('load', started, method=method, ok=ok, error=error)
+            if not ok:
+                logging.warning(f"kexec load failed, rebooting normally: {error}")
+                method = 'reboot'
+        started = time.monotonic()
+        ok, error = self._run(['systemctl', method])
+        if not ok and method == 'kexec':
+            logging.warning(f"systemctl kexec failed, rebooting normally: {error}")
+            # With a kernel still loaded, newer systemd turns "reboot" into a kexec too
+            self._run(['kexec', '--unload'])
+            method = 'reboot'
+            ok, error = self._run(['systemctl', method])
+        report('reboot', started, method=method, ok=ok, error=error)
+        return 0 if ok else 1
+
+
+def application_dirs():
+    """XDG application directories, highest priority first"""
+    data_home = os.environ.get("XDG_DATA_HOME") or str(Path.home() / ".local/share")
+    data_dirs = os.environ.get("XDG_DATA_DIRS") or "/usr/local/share:/usr/share"
+    dirs = []
+    for base in [data_home] + data_dirs.split(":"):
+        path = os.path.join(base, "applications")
+        if base and path not in dirs:
+            dirs.append(path)
+    return dirs
+
+
+def parse_desktop_entry(text):
+    """Launchable application from a .desktop file, or None"""
+    fields = {}
+    group = None
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if line.startswith('['):
+            if group == 'Desktop Entry':
+                break
+            group = line.strip('[]')
+            continue
+        key, sep, value = line.partition('=')
+        if sep and group == 'Desktop Entry':
+            fields.setdefault(key.strip(), value.strip())
+    if fields.get('Type') != 'Application' or not fields.get('Exec'):
+        return None
+    if 'true' in (fields.get('NoDisplay'), fields.get('Hidden'), fields.get('Terminal')):
+        return None
+    lang = (os.environ.get('LC_ALL') or os.environ.get('LC_MESSAGES') or os.environ.get('LANG') or '')
+    lang = lang.split('.')[0].split('@')[0]
+    name = fields.get(f'Name[{lang}]') or fields.get(f"Name[{lang.split('_')[0]}]") or fields.get('Name')
+    return {
+        'name': name or fields['Exec'].split()[0],
+        'exec': fields['Exec'],
+        'icon': fields.get('Icon'),
+        'path': fields.get('Path'),
+        'prefers_dgpu': 'true' in (fields.get('PrefersNonDefaultGPU'), fields.get('X-KDE-RunOnDiscreteGpu')),
+    }
+
+
+class AppIndex:
+    """Installed applications from .desktop files, cached on disk
+
+    The cache keeps every directory's mtime and listing and every file's
+    mtime and parsed entry, so a refresh only lists directories that changed
+    and only parses files that are new or modified. With `watch`, inotify on
+    the application directories tells whether a refresh is needed at all.
+    """
+
+    def __init__(self, cache_file=APP_INDEX_FILE, dirs=None, watch=True):
+        self.cache_file = Path(cache_file)
+        self.dirs = dirs or application_dirs()
+        self.lock = threading.Lock()
+        # dir -> (mtime_ns, subdirs, .desktop names); file -> (mtime_ns, entry or None)
+        self.listings = {}
+        self.files = {}
+        self.apps = {}
+        self.generation = 0
+        self.scanned = False
+        self.watch = None
+        if watch:
+            try:
+                self.watch = InotifyWatch()
+            except (OSError, AttributeError) as e:
+                logging.warning(f"inotify unavailable, app index rescans every time: {e}")
+        self.load()
+
+    def load(self):
+        try:
+            data = json.loads(self.cache_file.read_text())
+        except (OSError, ValueError):
+            return
+        if data.get('version') != APP_INDEX_VERSION or data.get('dirs') != self.dirs:
+            return
+        self.listings = {path: tuple(listing) for path, listing in data['listings'].items()}
+        self.files = {path: tuple(entry) for path, entry in data['files'].items()}
+        self.apps = self._resolve()
+
+    def save(self):
+        try:
+            self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.cache_file.with_suffix('.tmp')
+            tmp.write_text(json.dumps({'version': APP_INDEX_VERSION, 'dirs': self.dirs,
+                                       'listings': self.listings, 'files': self.files}))
+            tmp.replace(self.cache_file)
+        except OSError as e:
+            logging.error(f"Failed to save app index: {e}")
+
+    def needs_refresh(self):
+        if not self.scanned or self.watch is None:
+            return True
+        return self.watch.pending()
+
+    def _list_dir(self, path):
+        subdirs, desktop = [], []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    subdirs.append(entry.name)
+                elif entry.name.endswith('.desktop'):
+                    desktop.append(entry.name)
+        return subdirs, desktop
+
+    def refresh(self):
+        """Bring the index up to date; returns True if the application list changed"""
+        with self.lock:
+            if self.watch is not None:
+                self.watch.pending()
+            listings, files = {}, {}
+            parsed = 0
+            for base in self.dirs:
+                stack = [base]
+                while stack:
+                    path = stack.pop()
+                    try:
+                        mtime = os.stat(path).st_mtime_ns
+                        cached = self.listings.get(path)
+                        if cached is not None and cached[0] == mtime:
+                            subdirs, desktop = cached[1], cached[2]
+                        else:
+                            subdirs, desktop = self._list_dir(path)
+                    except OSError:
+                        continue
+                    if self.watch is not None:
+                        self.watch.add(path)
+                    listings[path] = (mtime, subdirs, desktop)
+                    stack.extend(os.path.join(path, d) for d in subdirs)
+                    for name in desktop:
+                        file = os.path.join(path, name)
+                        try:
+                            file_mtime = os.stat(file).st_mtime_ns
+                        except OSError:
+                            continue
+                        cached = self.files.get(file)
+                        if cached is not None and cached[0] == file_mtime:
+                            files[file] = cached
+                            continue
+                        try:
+                            entry = parse_desktop_entry(Path(file).read_text(errors='replace'))
+                        except OSError:
+                            entry = None
+                        files[file] = (file_mtime, entry)
+                        parsed += 1
+            dirty = parsed or listings != self.listings or files.keys() != self.files.keys()
+            self.listings, self.files = listings, files
+            self.scanned = True
+            apps = self._resolve()
+            changed = apps != self.apps
+            if changed:
+                self.apps = apps
+                self.generation += 1
+            if dirty:
+                logging.info(f"App index: {len(apps)} applications, {parsed} files parsed")
+                self.save()
+            return changed
+
+    def _resolve(self):
+        """Desktop file ID -> app; a file in an earlier directory shadows later ones"""
+        apps = {}
+        seen = set()
+        for base in self.dirs:
+            prefix = base + os.sep
+            for file in sorted(f for f in self.files if f.startswith(prefix)):
+                app_id = file[len(prefix):].replace(os.sep, '-')
+                if app_id in seen:
+                    continue
+                seen.add(app_id)
+                entry = self.files[file][1]
+                if entry is not None:
+                    apps[app_id] = dict(entry, id=app_id, file=file)
+        return apps
+
+    def sorted_apps(self):
+        return sorted(self.apps.values(), key=lambda app: app['name'].casefold())
+
+    def lookup(self, query):
+        """Apps whose desktop file ID or name is exactly `query`"""
+        for app_id in (query, f"{query}.desktop"):
+            if app_id in self.apps:
+                return [self.apps[app_id]]
+        folded = query.casefold()
+        return [app for app in self.sorted_apps() if app['name'].casefold() == folded]
+
+    def search(self, query):
+        """Apps whose desktop file ID or name contains `query`"""
+        folded = query.casefold()
+        return [app for app in self.sorted_apps()
+                if folded in app['name'].casefold() or folded in app['id'].casefold()]
+
+
+def desktop_exec_argv(app):
+    """An app's Exec line as argv, with no files or URLs passed"""
+    argv = []
+    for arg in shlex.split(app['exec']):
+        if arg in EXEC_DROPPED_CODES:
+            continue
+        if arg == '%i':
+            argv.extend(['--icon', app['icon']] if app.get('icon') else [])
+            continue
+        argv.append(re.sub(r'%([ck%])', lambda m: {'c': app['name'], 'k': app['file'], '%': '%'}[m.group(1)],
+                           arg))
+    if not argv:
+        raise ValueError(f"{app['id']} has an empty Exec line")
+    return argv
+
+
+def prime_offload_command(argv):
+    """(argv, env) that run argv on the NVIDIA GPU through PRIME render offload"""
+    argv = list(argv)
+    env = dict(os.environ, **PRIME_OFFLOAD_ENV)
+    # Flatpak apps only see the variables passed into their sandbox
+    if os.path.basename(argv[0]) == 'flatpak' and 'run' in argv:
+        at = argv.index('run') + 1
+        argv[at:at] = [f"--env={key}={value}" for key, value in PRIME_OFFLOAD_ENV.items()]
+    return argv, env
+
+
+def launch_on_dgpu(app):
+    """Start a desktop app detached from the tray, rendering on the NVIDIA GPU"""
+    argv, env = prime_offload_command(desktop_exec_argv(app))
+    cwd = app.get('path') if app.get('path') and os.path.isdir(app['path']) else None
+    proc = subprocess.Popen(argv, env=env, cwd=cwd, start_new_session=True, stdin=subprocess.DEVNULL,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    # Reap it when it exits so it does not linger as a zombie of the tray
+    threading.Thread(target=proc.wait, name="app-reaper", daemon=True).start()
+    logging.info(f"Launched {app['id']} on the dGPU (pid {proc.pid})")
+    log_event('app-launched', app=app['id'], pid=proc.pid)
+    return proc
+
+
+def pinned_apps(settings):
+    return [app_id for app_id in (settings.get('dgpu_apps') or '').split(',') if app_id]
+
+
+class PowerPolicy:
+    """Decide when a power change should lead to a GPU mode suggestion (or switch)
+
+    Rules come from the [policy] settings section:
+    - the power source must be stable for `debounce` seconds;
+    - on battery, suggest Integrated once the battery is at or below
+      `battery_percent_below` percent or under `battery_minutes_below` minutes
+      (re-armed only after rising `hysteresis_percent` above the threshold);
+    - on AC, suggest Hybrid when running Integrated;
+    - each suggestion fires once per power-source period and at most once per
+      `cooldown` seconds.
+
+    The policy only sees observations and reads time from `clock`, so an event
+    sequence can be replayed with a simulated clock (--simulate-policy).
+    """
+
+    def __init__(self, settings, clock=time.monotonic):
+        self.clock = clock
+        self.action = settings.get('action', POLICY_SECTION)
+        if self.action not in POLICY_ACTIONS:
+            logging.error(f"Unknown policy action {self.action!r}, using 'notify'")
+            self.action = 'notify'
+        self.debounce = settings.getfloat('debounce', POLICY_SECTION)
+        self.cooldown = settings.getfloat('cooldown', POLICY_SECTION)
+        self.percent_below = settings.getfloat('battery_percent_below', POLICY_SECTION)
+        self.minutes_below = settings.getfloat('battery_minutes_below', POLICY_SECTION)
+        self.hysteresis = settings.getfloat('hysteresis_percent', POLICY_SECTION)
+        self.on_battery = None
+        self.since = None
+        self.percentage = None
+        self.time_to_empty = None
+        self.battery_low = False
+        self.fired = set()
+        self.last_fired = {}
+        # Seconds until evaluate() may decide differently without a new observation
+        self.retry_in = None
+
+    def observe(self, on_battery, percentage=None, time_to_empty=None, settled=False):
+        """Record the power state; `settled` treats it as already stable (startup)"""
+        now = self.clock()
+        if on_battery != self.on_battery:
+            logging.info(f"Policy: power source {'battery' if on_battery else 'AC'}")
+            self.on_battery = on_battery
+            self.since = now - self.debounce if settled else now
+            self.fired.clear()
+        if percentage is not None:
+            self.percentage = percentage
+        if time_to_empty is not None:
+            self.time_to_empty = time_to_empty
+        self._update_battery_low()
+
+    def _update_battery_low(self):
+        pct = self.percentage
+        short = bool(self.minutes_below and self.time_to_empty
+                     and self.time_to_empty < self.minutes_below * 60)
+        if pct is None or self.percent_below >= 100:
+            low = self.percent_below >= 100
+        else:
+            # Once low, stay low until the battery rises `hysteresis` above the threshold
+            low = pct <= self.percent_below + (self.hysteresis if self.battery_low else 0)
+        low = low or short
+        if low and not self.battery_low:
+            # Newly low: allow a fresh battery suggestion in this period
+            self.fired.discard('integrated')
+        self.battery_low = low
+
+    def evaluate(self, mode):
+        """Return {'target', 'reason', 'action'} if a suggestion is due now, else None"""
+        self.retry_in = None
+        if self.on_battery is None or mode not in ('integrated', 'hybrid', 'nvidia'):
+            return None
+        if self.on_battery:
+            if mode == 'integrated' or not self.battery_low:
+                return None
+            target = 'integrated'
+            if self.percentage is not None and self.percent_below < 100:
+                reason = f"battery at {self.percentage:.0f}%"
+            else:
+                reason = "running on battery"
+        else:
+            if mode != 'integrated':
+                return None
+            target = 'hybrid'
+            reason = "AC power connected"
+        if target in self.fired:
+            return None
+        now = self.clock()
+        wait = max(self.since + self.debounce - now,
+                   self.last_fired.get(target, -self.cooldown) + self.cooldown - now)
+        if wait > 0:
+            self.retry_in = wait
+            return None
+        self.fired.add(target)
+        self.last_fired[target] = now
+        # NVIDIA mode is set in BIOS, so it can only ever be a suggestion
+        action = 'notify' if mode == 'nvidia' else self.action
+        logging.info(f"Policy: {action} {target} ({reason})")
+        return {'target': target, 'reason': reason, 'action': action}
+
+
+class ModeRefresher:
+    """Background worker that re-probes the GPU mode off the GTK main thread
+
+    Requests made while a probe is queued or running are coalesced into one,
+    and probes are spaced at least min_interval seconds apart.
+    """
+
+    def __init__(self, probe, on_result, min_interval=MODE_REFRESH_INTERVAL):
+        self.probe = probe
+        self.on_result = on_result
+        self.min_interval = min_interval
+        self.cond = threading.Condition()
+        self.requested = False
+        self.last_run = None
+        self.thread = threading.Thread(target=self._run, name="mode-refresh", daemon=True)
+        self.thread.start()
+
+    def request(self):
+        """Ask for a refresh; returns immediately"""
+        with self.cond:
+            self.requested = True
+            self.cond.notify()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.requested:
+                    self.cond.wait()
+                if self.last_run is not None:
+                    delay = self.last_run + self.min_interval - time.monotonic()
+                    while delay > 0:
+                        self.cond.wait(delay)
+                        delay = self.last_run + self.min_interval - time.monotonic()
+                self.requested = False
+                self.last_run = time.monotonic()
+            try:
+                mode = self.probe()
+            except Exception as e:
+                logging.error(f"Background mode refresh failed: {e}")
+                continue
+            self.on_result(mode)
+
+
+class TrayMenu:
+    """Persistent tray menu that only touches items whose state changed
+
+    AppIndicator exports the menu over D-Bus (dbusmenu); replacing the whole
+    menu re-serialises every item, while a property change on an existing
+    item is sent as a single ItemsPropertiesUpdated entry.
+    """
+
+    def __init__(self, indicator):
+        self.indicator = indicator
+        self.menu = Gtk.Menu()
+        self.menu.connect('show', lambda _: indicator.refresh_mode())
+        self.menu.connect('show', lambda _: indicator.refresh_app_index())
+        self.items = {}
+        self.values = {}
+        self.stats = {'state_changes': 0, 'widget_updates': 0, 'dbus_updates': 0, 'app_menu_builds': 0}
+        self.app_menu = Gtk.Menu()
+        self.app_items = []
+        self.app_menu_key = None
+
+        self._add('status', Gtk.MenuItem(label=''))
+        self._add('dgpu_power', Gtk.MenuItem(label=''))
+        self._add('dgpu_holders', Gtk.MenuItem(label=''))
+        self._add('sep_status', Gtk.SeparatorMenuItem())
+        self._add('nvidia_warning', Gtk.MenuItem(label='⚠ NVIDIA Mode Active'))
+        self._add('nvidia_bios', Gtk.MenuItem(label='Set BIOS to Hybrid (F2) to enable switching'))
+        self._add('bios_hint', Gtk.MenuItem(label='⚠ NVIDIA mode: Use BIOS (F2)'))
+        self._add('sep_modes', Gtk.SeparatorMenuItem())
+        self._add('integrated', Gtk.MenuItem(label=''), indicator.switch_integrated)
+        self._add('hybrid', Gtk.MenuItem(label=''), indicator.switch_hybrid)
+        self._add('nvidia', Gtk.MenuItem(label=''))
+        self._add('switch_progress', Gtk.MenuItem(label=''))
+        self._add('cancel_switch', Gtk.MenuItem(label='✕ Cancel Switch'), indicator.cancel_switch)
+        self._add('apply_now', Gtk.MenuItem(label=''), indicator.apply_now)
+        dgpu_apps = Gtk.MenuItem(label='Run on Discrete GPU')
+        dgpu_apps.set_submenu(self.app_menu)
+        self._add('dgpu_apps', dgpu_apps)
+        self._add('sep_settings', Gtk.SeparatorMenuItem())
+        self._add('fast_switch', Gtk.MenuItem(label=''), indicator.prepare_fast_switching)
+        power_prompts = Gtk.CheckMenuItem(label='Power Change Notifications')
+        power_prompts.set_active(indicator.power_prompts_enabled)
+        self._add('power_prompts', power_prompts, indicator.toggle_power_prompts)
+        self._add('about', Gtk.MenuItem(label='About'), indicator.show_about)
+        self._add('sep_quit', Gtk.SeparatorMenuItem())
+        self._add('quit', Gtk.MenuItem(label='Quit'), lambda _: Gtk.main_quit())
+
+        self.set_apps(None, [])
+        self.menu.show_all()
+
+    def _add(self, name, item, on_activate=None):
+        if on_activate is not None:
+            item.connect('activate', on_activate)
+        self.items[name] = item
+        self.menu.append(item)
+
+    def _app_item(self, menu, item, on_activate=None):
+        if on_activate is not None:
+            item.connect('activate', on_activate)
+        menu.append(item)
+        # Items of nested submenus go with their parent item
+        if menu is self.app_menu:
+            self.app_items.append(item)
+
+    def set_apps(self, index, pinned):
+        """Rebuild the Run on Discrete GPU submenu, only when the app list or pins changed"""
+        key = (index.generation if index is not None else None, tuple(pinned))
+        if key == self.app_menu_key:
+            return False
+        self.app_menu_key = key
+        self.stats['app_menu_builds'] += 1
+        for item in self.app_items:
+            item.destroy()
+        self.app_items = []
+        ind = self.indicator
+        if index is None:
+            item = Gtk.MenuItem(label='Loading applications...')
+            item.set_sensitive(False)
+            self._app_item(self.app_menu, item)
+            self.app_menu.show_all()
+            return True
+        
+        def launcher(app):
+            return lambda _: ind.launch_app(app['id'])
+        
+        apps = index.sorted_apps()
+        # Pinned apps first, then apps that ask for the discrete GPU themselves
+        top = [index.apps[app_id] for app_id in pinned if app_id in index.apps]
+        top += [app for app in apps if app['prefers_dgpu'] and app['id'] not in pinned]
+        for app in top:
+            self._app_item(self.app_menu, Gtk.MenuItem(label=app['name']), launcher(app))
+        if top:
+            self._app_item(self.app_menu, Gtk.SeparatorMenuItem())
+        
+        all_menu = Gtk.Menu()
+        pin_menu = Gtk.Menu()
+        for app in apps:
+            self._app_item(all_menu, Gtk.MenuItem(label=app['name']), launcher(app))
+            pin = Gtk.CheckMenuItem(label=app['name'])
+            # Set before connecting: set_active() emits 'activate'
+            pin.set_active(app['id'] in pinned)
+            self._app_item(pin_menu, pin, lambda widget, app_id=app['id']: ind.toggle_pin(widget, app_id))
+        for label, submenu in (('All Applications', all_menu), ('Pin Apps', pin_menu)):
+            item = Gtk.MenuItem(label=label)
+            item.set_submenu(submenu)
+            item.set_sensitive(bool(apps))
+            self._app_item(self.app_menu, item)
+        self.app_menu.show_all()
+        return True
+
+    def desired_state(self):
+        """Map indicator state to {item: (label, sensitive, visible)}"""
+        ind = self.indicator
+        mode = ind.current_mode
+        pending = ind.pending_mode
+        switching = ind.switching
+        nvidia_mode = mode == 'nvidia'
+        if switching:
+            status = f'━━━ {ind.busy_label}... ━━━'
+        elif pending:
+            status = f'━━━ Current: {mode.upper()} → {pending.upper()} after reboot ━━━'
+        else:
+            status = f'━━━ Current: {mode.upper()} ━━━'
+        if nvidia_mode:
+            integrated = ('⚪ Integrated GPU', False, True)
+            hybrid = ('⚪ Hybrid Mode', False, True)
+            nvidia = ('● NVIDIA GPU (ACTIVE)', False, True)
+        else:
+            integrated = (
+                '● Integrated GPU (ACTIVE)' if mode == 'integrated'
+                else '◐ Integrated GPU (after reboot)' if pending == 'integrated' else '⚪ Integrated GPU',
+                not ((mode == 'integrated' and not pending) or switching), True
+            )
+            hybrid = (
+                '● Hybrid Mode (ACTIVE)' if mode == 'hybrid'
+                else '◐ Hybrid Mode (after reboot)' if pending == 'hybrid' else '⚪ Hybrid Mode',
+                not ((mode == 'hybrid' and not pending) or switching), True
+            )
+            nvidia = ('⚪ NVIDIA GPU', False, True)
+        all_ready = all(ind.fast_switch_ready.get(m) for m in STAGED_MODES)
+        progress = ind.switch_progress_text()
+        cancellable = ind.switch_proc is not None and not (ind.switch_proc.cancelled or ind.switch_proc.overrun)
+        dgpu_power = ind.dgpu_power_text()
+        dgpu_holders = ind.dgpu_holders_text()
+        return {
+            'status': (status, False, True),
+            'dgpu_power': (dgpu_power, False, dgpu_power is not None),
+            'dgpu_holders': (dgpu_holders, False, dgpu_holders is not None),
+            'nvidia_warning': (None, False, nvidia_mode),
+            'nvidia_bios': (None, False, nvidia_mode),
+            'bios_hint': (None, False, not nvidia_mode),
+            'integrated': integrated,
+            'hybrid': hybrid,
+            'nvidia': nvidia,
+            'fast_switch': (
+                '⚡ Fast Switching Ready' if all_ready else '⚡ Prepare Fast Switching',
+                not (switching or nvidia_mode or all_ready), not nvidia_mode
+            ),
+            'power_prompts': (None, not (switching or nvidia_mode), True),
+            'switch_progress': (progress, False, progress is not None),
+            'cancel_switch': (None, cancellable, ind.switch_proc is not None),
+            'apply_now': (
+                f'↻ Restart Now into {pending.capitalize()}' if pending else None,
+                not switching, pending is not None and not switching
+            ),
+            # PRIME offload needs the NVIDIA driver loaded next to the iGPU's
+            'dgpu_apps': (None, True, mode == 'hybrid'),
+            'quit': (None, not switching, True),
+        }
+
+    def update(self):
+        """Apply a state change, touching only changed properties"""
+        widget_updates = 0
+        dbus_updates = 0
+        for name, (label, sensitive, visible) in self.desired_state().items():
+            item = self.items[name]
+            changed = 0
+            for prop, value in (('label', label), ('sensitive', sensitive), ('visible', visible)):
+                if value is None or self.values.get((name, prop)) == value:
+                    continue
+                self.values[(name, prop)] = value
+                if prop == 'label':
+                    item.set_label(value)
+                elif prop == 'sensitive':
+                    item.set_sensitive(value)
+                else:
+                    item.set_visible(value)
+                changed += 1
+            widget_updates += changed
+            dbus_updates += 1 if changed else 0
+        self.stats['state_changes'] += 1
+        self.stats['widget_updates'] += widget_updates
+        self.stats['dbus_updates'] += dbus_updates
+        logging.debug(f"Menu update: {widget_updates} widget updates, {dbus_updates} dbusmenu item updates")
+        return widget_updates, dbus_updates
+
+
+def pending_mode(mode, configured):
+    """Mode the next boot switches to, or None if it keeps the live mode"""
+    return configured if configured != mode and {configured, mode} <= set(STAGED_MODES) else None
+
+
+def reboot_into(mode, metrics, on_phase=None):
+    """Run --reboot-into MODE through pkexec, recording how long each phase took
+
+    Returns {'result': 'rebooting'|'cancelled'|'failed', 'method', 'reason',
+    'error', 'phases': {phase: seconds}}.
+    """
+    outcome = {'result': 'failed', 'method': None, 'reason': None, 'error': None, 'phases': {}}
+    if on_phase:
+        on_phase(*SWITCH_PHASES[0][:2])
+    try:
+        proc = subprocess.Popen(['pkexec', GPUMODE_HELPER, '--reboot-into', mode], stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL, text=True)
+    except OSError as e:
+        outcome['error'] = str(e)
+        return outcome
+    output = []
+    with proc.stdout:
+        # One JSON object per finished phase; anything else is log output
+        for line in proc.stdout:
+            try:
+                report = json.loads(line)
+                phase = report['phase']
+            except (ValueError, KeyError, TypeError):
+                output.append(line.rstrip())
+                continue
+            metrics.record(f'apply_now_{phase}', report['seconds'])
+            outcome['phases'][phase] = report['seconds']
+            outcome['method'] = report.get('method') or outcome['method']
+            outcome['reason'] = report.get('reason') or outcome['reason']
+            if report.get('error'):
+                outcome['error'] = report['error']
+            following = {'check': 'load' if outcome['method'] == 'kexec' else 'reboot',
+                         'load': 'reboot'}.get(phase)
+            if on_phase and following:
+                on_phase(following, REBOOT_PHASES[following])
+    returncode = proc.wait()
+    if returncode in (126, 127):
+        outcome['result'] = 'cancelled'
+    elif returncode == 0:
+        outcome['result'] = 'rebooting'
+        outcome['error'] = None
+    else:
+        outcome['error'] = outcome['error'] or "\n".join(output[-5:]) or "Command failed"
+    return outcome
+
+
+class GPUModeService:
+    """Headless GPU mode, switching and staging logic shared by the tray and --daemon
+
+    Listeners get (event, data) callbacks from whichever thread produced the
+    change; GUI clients must hand them to their main loop themselves.
+    """
+
+    def __init__(self, settings, metrics, publish=True):
+        self.settings = settings
+        self.metrics = metrics
+        # False for throwaway instances (the startup benchmark): leave the live
+        # runtime state file and the cached mode to the real service
+        self.publish = publish
+        self.lock = threading.RLock()
+        self.listeners = []
+        self.mode = load_cached_mode()
+        self.mode_accurate = False
+        self.switching = False
+        self.busy_label = 'SWITCHING'
+        self.switch_target = None
+        self.switch_proc = None
+        self.switch_phase = None
+        self.switch_started = None
+        self.switch_timeout = settings.getfloat('switch_timeout')
+        self.fast_switch_ready = {}
+        # Mode envycontrol has configured for the next boot, if it differs from the live mode
+        self.pending_mode = None
+        self.last_switch = None
+        self.last_apply = None
+        # None = unknown; set by the tray from UPower, otherwise read from sysfs on each probe
+        self.on_battery = None
+        self.power_from_client = False
+        self.mode_probe = None
+        self.refresher = None
+        self.rtd3 = RuntimePMMonitor()
+        self.rtd3_warn_after = settings.getfloat('rtd3_warn_minutes') * 60
+        self.rtd3_warned = False
+        self.holder_scanner = GPUHolderScanner(metrics=metrics)
+        self.gpu_holders = []
+        self.holders_scanned = 0.0
+        self.battery = BatterySampler(PowerHistory(POWER_HISTORY_FILE))
+
+    def start(self):
+        """Start background probing; call once the UI (if any) is up"""
+        self.mode_probe = ModeProbe(metrics=self.metrics)
+        self.refresher = ModeRefresher(self.probe_mode, self._on_probed)
+        self.refresher.request()
+        self.check_staged_sets()
+        self.publish_state()
+        threading.Thread(target=self._rtd3_loop, name="rtd3-monitor", daemon=True).start()
+        threading.Thread(target=self._battery_loop, name="battery-sampler", daemon=True).start()
+
+    def _battery_loop(self):
+        """Record discharge power tagged with the running GPU mode and TuneD profile"""
+        while True:
+            time.sleep(BATTERY_SAMPLE_INTERVAL)
+            if self.on_battery is False or self.mode == 'unknown':
+                continue
+            try:
+                with self.lock:
+                    self.battery.sample(self.mode, read_tuned_profile())
+            except Exception as e:
+                logging.error(f"Battery sampling failed: {e}")
+
+    def _rtd3_loop(self):
+        """Sample dGPU runtime PM while in hybrid mode (the only mode where it can suspend)"""
+        while True:
+            time.sleep(RTD3_SAMPLE_INTERVAL)
+            self.sample_rtd3()
+
+    def sample_rtd3(self):
+        """One RTD3 sample: update the status, the holder list and the awake warning"""
+        if self.mode != 'hybrid' or self.switching:
+            if self.rtd3.status is not None:
+                with self.lock:
+                    self.rtd3.reset()
+                self._emit('dgpu-status', status=None)
+            self._set_gpu_holders([])
+            return
+        old_status = self.rtd3.status
+        with self.lock:
+            status = self.rtd3.sample()
+            awake_for = self.rtd3.awake_for()
+        if status != old_status:
+            logging.info(f"dGPU runtime status: {old_status} -> {status}")
+            self._emit('dgpu-status', status=status)
+        if status in (None, 'suspended'):
+            self._set_gpu_holders([])
+        elif time.monotonic() - self.holders_scanned >= GPU_HOLDER_SCAN_INTERVAL:
+            self.scan_gpu_holders()
+        if awake_for is None or awake_for < self.rtd3_warn_after:
+            self.rtd3_warned = False
+        elif self.rtd3_warn_after > 0 and not self.rtd3_warned:
+            self.rtd3_warned = True
+            logging.warning(f"dGPU has not suspended for {awake_for / 60:.0f} minutes in hybrid mode")
+            self._emit('dgpu-awake', minutes=awake_for / 60, bdf=self.rtd3.bdf,
+                       holders=self.gpu_holders)
+
+    def scan_gpu_holders(self):
+        """Rescan which processes hold the dGPU open (background thread)"""
+        self.holders_scanned = time.monotonic()
+        self.holder_scanner.bdf = self.rtd3.bdf
+        try:
+            holders = self.holder_scanner.scan()
+        except Exception as e:
+            logging.error(f"Failed to scan dGPU holders: {e}")
+            return
+        self._set_gpu_holders(holders)
+
+    def _set_gpu_holders(self, holders):
+        if holders == self.gpu_holders:
+            return
+        self.gpu_holders = holders
+        if holders:
+            logging.info("Processes using the dGPU: " + ", ".join(f"{h['name']} ({h['pid']})" for h in holders))
+        self._emit('dgpu-holders', holders=holders)
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def _emit(self, event, **data):
+        log_event(event, **data)
+        self.publish_state()
+        for listener in self.listeners:
+            try:
+                listener(event, data)
+            except Exception as e:
+                logging.error(f"Service listener failed on {event}: {e}")
+
+    def state(self):
+        """Snapshot of the cached state, as served to clients"""
+        with self.lock:
+            return {
+                'mode': self.mode,
+                'configured_mode': self.mode_probe.configured_mode if self.mode_probe else None,
+                'mode_accurate': self.mode_accurate,
+                'pending_mode': self.pending_mode,
+                'switching': self.switching,
+                'busy': self.busy_label.lower() if self.switching else None,
+                'switch_target': self.switch_target,
+                'switch_phase': self.switch_phase,
+                'switch_elapsed': (time.monotonic() - self.switch_started) if self.switching else None,
+                'fast_switch_ready': dict(self.fast_switch_ready),
+                'last_switch': self.last_switch,
+                'last_apply': self.last_apply,
+                'on_battery': self.on_battery,
+                'dgpu': self.rtd3.summary(),
+                'dgpu_holders': list(self.gpu_holders),
+                'battery_watts': self.battery.recent_watts(),
+                'pid': os.getpid(),
+                'updated': time.time(),
+            }
+
+    def publish_state(self):
+        """Write the state for clients that just read a file (prompts, other daemons)"""
+        if not self.publish:
+            return
+        try:
+            RUNTIME_DIR.mkdir(mode=0o700, parents=True, exist_ok=True)
+            tmp = RUNTIME_STATE_FILE.with_suffix('.tmp')
+            tmp.write_text(json.dumps(self.state()))
+            tmp.replace(RUNTIME_STATE_FILE)
+        except OSError as e:
+            logging.error(f"Failed to publish GPU state: {e}")
+
+    def set_power_state(self, on_battery):
+        """Take the power state from a client that watches it (the tray's UPower client)"""
+        self.power_from_client = True
+        if on_battery != self.on_battery:
+            self.on_battery = on_battery
+            self._emit('power-changed', on_battery=on_battery)
+
+    def probe_mode(self):
+        """Query current GPU mode from sysfs and envycontrol config files (cached)"""
+        if not self.power_from_client:
+            on_battery = probe_on_battery()
+            if on_battery != self.on_battery:
+                self.on_battery = on_battery
+                self._emit('power-changed', on_battery=on_battery)
+        try:
+            return self.mode_probe.get_mode()
+        except Exception as e:
+            logging.error(f"Failed to query GPU mode: {e}")
+            return "unknown"
+
+    def probe_now(self):
+        """Probe mode and staged sets synchronously (one-shot CLI use)"""
+        self.mode_probe = ModeProbe(metrics=self.metrics)
+        self._on_probed(self.probe_mode())
+        stages = StagedSwitch()
+        self.fast_switch_ready = {mode: stages.is_ready(mode) for mode in STAGED_MODES}
+
+    def refresh(self):
+        """Re-probe in the background; clients keep the last known mode meanwhile"""
+        if not self.switching and self.refresher is not None:
+            self.refresher.request()
+
+    def refresh_now(self):
+        """Re-probe synchronously (sysfs reads only) and return the resulting state"""
+        if not self.switching and self.mode_probe is not None:
+            self.mode_probe.invalidate()
+            self._on_probed(self.probe_mode())
+        return self.state()
+
+    def _on_probed(self, mode):
+        with self.lock:
+            first = not self.mode_accurate
+            self.mode_accurate = True
+            old_mode = self.mode
+            pending = pending_mode(mode, self.mode_probe.configured_mode)
+            changed = not self.switching and (mode != self.mode or pending != self.pending_mode)
+            if changed:
+                if mode != self.mode:
+                    logging.info(f"GPU mode changed: {self.mode} -> {mode}")
+                    if self.publish:
+                        save_cached_mode(mode)
+                if pending != self.pending_mode:
+                    logging.info(f"Mode pending after reboot: {pending or 'none'}")
+                self.mode = mode
+                self.pending_mode = pending
+        if changed or first:
+            self._emit('mode-changed', mode=self.mode, old_mode=old_mode, pending_mode=self.pending_mode,
+                       first=first)
+
+    def check_staged_sets(self):
+        """Check in the background which modes have an up-to-date staged set"""
+        def check_thread():
+            stages = StagedSwitch()
+            ready = {mode: stages.is_ready(mode) for mode in STAGED_MODES}
+            if ready != self.fast_switch_ready:
+                logging.info(f"Staged switch sets ready: {ready}")
+                self.fast_switch_ready = ready
+                self._emit('staged-sets', ready=ready)
+        
+        threading.Thread(target=check_thread, daemon=True).start()
+
+    def _begin(self, busy_label, target=None):
+        with self.lock:
+            if self.switching:
+                return False
+            self.switching = True
+            self.busy_label = busy_label
+            self.switch_target = target
+            self.switch_phase = None
+            self.switch_started = time.monotonic()
+            return True
+
+    def _end(self):
+        with self.lock:
+            self.switching = False
+            self.busy_label = 'SWITCHING'
+            self.switch_target = None
+            self.switch_proc = None
+            self.switch_phase = None
+
+    def _on_phase(self, phase, label):
+        self.switch_phase = label
+        self._emit('switch-phase', phase=phase, label=label)
+
+    def switch(self, mode):
+        """Start a switch to `mode`; returns (accepted, message)"""
+        if mode not in STAGED_MODES:
+            return False, f"cannot switch to {mode}"
+        if self.mode == 'nvidia':
+            return False, "NVIDIA mode is set in BIOS; switching is disabled"
+        staged = self.fast_switch_ready.get(mode, False)
+        if not self._begin('SWITCHING', mode):
+            return False, "a switch is already running"
+        threading.Thread(target=self._switch_thread, args=(mode, staged), daemon=True).start()
+        return True, f"switching to {mode}"
+
+    def _switch_thread(self, mode, staged):
+        result, error = 'failed', None
+        try:
+            with self.metrics.timed('switch_preflight'):
+                preflight = SwitchPreflight().check(mode)
+        except Exception as e:
+            logging.error(f"Switch preflight failed, switching anyway: {e}")
+            preflight = {'satisfied': False, 'changes': []}
+        if preflight['satisfied']:
+            logging.info(f"Configuration already matches {mode} mode, not running envycontrol")
+            self._finish_switch(mode, 'unchanged', None)
+            return
+        changes = SwitchPreflight.summary(preflight['changes'])
+        logging.info(f"Switching to {mode} mode ({'staged' if staged else 'envycontrol'}): {', '.join(changes)}")
+        self._emit('switch-started', mode=mode, staged=staged, changes=changes)
+        try:
+            returncode = None
+            if staged:
+                self.switch_proc = SwitchProcess(['pkexec', GPUMODE_HELPER, '--stage-apply', mode],
+                                                 self.switch_timeout, self._on_phase)
+                with self.metrics.timed('switch_staged'):
+                    returncode = self.switch_proc.run()
+                if returncode == STAGE_EXIT_UNAVAILABLE:
+                    logging.info(f"Staged set unusable ({self.switch_proc.error_text()}), using envycontrol")
+                    returncode = None
+            if returncode is None:
+                self.switch_proc = SwitchProcess(['pkexec'] + envycontrol_command(mode),
+                                                 self.switch_timeout, self._on_phase)
+                with self.metrics.timed('switch_envycontrol'):
+                    returncode = self.switch_proc.run()
+            
+            if returncode in (126, 127) or (self.switch_proc.cancelled and returncode != 0):
+                result = 'cancelled'
+            elif returncode == 0:
+                result = 'success'
+            else:
+                error = self.switch_proc.error_text()
+        except subprocess.TimeoutExpired:
+            logging.error("Switch command timed out")
+            error = f"Command timed out after {self.switch_timeout:.0f} seconds"
+        except Exception as e:
+            logging.error(f"Switch error: {e}")
+            error = str(e)
+        
+        if result == 'success':
+            logging.info(f"Successfully switched to {mode}")
+        elif result == 'cancelled':
+            logging.info("Switch cancelled")
+        else:
+            logging.error(f"Failed to switch to {mode}: {error}")
+        self._finish_switch(mode, result, error)
+
+    def _finish_switch(self, mode, result, error):
+        """Record the outcome and end the switch; the live mode only changes after the reboot
+
+        Both happen under one lock hold so a client that sees switching go
+        False also sees this switch's last_switch and pending_mode.
+        """
+        with self.lock:
+            if result in ('success', 'unchanged'):
+                self.pending_mode = mode if mode != self.mode else None
+            self.last_switch = {'mode': mode, 'result': result, 'error': error}
+            self._end()
+        if self.mode_probe is not None:
+            self.mode_probe.invalidate()
+        self._emit('switch-finished', mode=mode, result=result, error=error,
+                   pending_mode=self.pending_mode)
+
+    def apply_now(self):
+        """Restart into the pending mode (kexec where possible); returns (accepted, message)"""
+        mode = self.pending_mode
+        if mode is None:
+            return False, "no switch is waiting for a reboot"
+        if not self._begin('RESTARTING', mode):
+            return False, "a switch is already running"
+        logging.info(f"Restarting into {mode} mode")
+        self._emit('apply-now-started', mode=mode)
+        
+        def apply_thread():
+            try:
+                outcome = reboot_into(mode, self.metrics, self._on_phase)
+            except Exception as e:
+                outcome = {'result': 'failed', 'method': None, 'reason': None, 'error': str(e), 'phases': {}}
+            if outcome['result'] == 'rebooting':
+                logging.info(f"Restarting through {outcome['method']}: " +
+                             ", ".join(f"{p} {s:.2f}s" for p, s in outcome['phases'].items()))
+            elif outcome['result'] == 'failed':
+                logging.error(f"Restart into {mode} failed: {outcome['error']}")
+            # Like _finish_switch: the outcome is visible before switching goes False
+            with self.lock:
+                self.last_apply = dict(outcome, mode=mode)
+                self._end()
+            self._emit('apply-now-finished', **self.last_apply)
+        
+        threading.Thread(target=apply_thread, daemon=True).start()
+        return True, f"restarting into {mode}"
+
+    def cancel_switch(self):
+        """Try to stop the running switch; False if it can no longer be stopped"""
+        proc = self.switch_proc
+        if proc is None:
+            return False
+        logging.info("Switch cancellation requested")
+        return proc.cancel()
+
+    def prepare_fast_switching(self):
+        """Build the per-mode staged sets in the background; returns (accepted, message)"""
+        if self.mode == 'nvidia':
+            return False, "NVIDIA mode is set in BIOS; switching is disabled"
+        if not self._begin('PREPARING'):
+            return False, "a switch is already running"
+        logging.info("Preparing staged switch sets")
+        self._emit('prepare-started')
+        
+        def prepare_thread():
+            try:
+                with self.metrics.timed('stage_prepare'):
+                    result = subprocess.run(['pkexec', GPUMODE_HELPER, '--stage-prepare'],
+                                            capture_output=True, text=True)
+                error = None if result.returncode == 0 else (result.stderr.strip() or "Command failed")
+            except Exception as e:
+                error = str(e)
+            self._end()
+            if error is None:
+                logging.info("Staged switch sets prepared")
+            else:
+                logging.error(f"Failed to prepare staged switch sets: {error}")
+            self._emit('prepare-finished', error=error)
+            self.check_staged_sets()
+        
+        threading.Thread(target=prepare_thread, daemon=True).start()
+        return True, "preparing fast switching"
+
+
+class ControlServer:
+    """Unix socket that answers state queries and commands from the cached service state
+
+    Protocol: one JSON object per line in each direction, e.g.
+    {"cmd": "status"} or {"cmd": "switch", "mode": "hybrid"}.
+    """
+
+    def __init__(self, service, path=SOCKET_PATH):
+        self.service = service
+        self.path = Path(path)
+        self.sock = None
+
+    def start(self):
+        self.path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        if self.path.exists():
+            try:
+                control_request('status', path=self.path)
+                raise RuntimeError(f"another instance already serves {self.path}")
+            except ControlError as e:
+                raise RuntimeError(f"{self.path} is in use but does not answer: {e}")
+            except ConnectionError:
+                self.path.unlink()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM | socket.SOCK_CLOEXEC)
+        self.sock.bind(str(self.path))
+        os.chmod(self.path, 0o600)
+        self.sock.listen(8)
+        threading.Thread(target=self._serve, name="control-server", daemon=True).start()
+        logging.info(f"Control socket listening on {self.path}")
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            # One bad client must never end the only thread serving the socket
+            try:
+                with conn:
+                    self._handle(conn)
+            except Exception as e:
+                logging.error(f"Control request failed: {e}")
+
+    def _handle(self, conn):
+        try:
+            conn.settimeout(CONTROL_TIMEOUT)
+            line = conn.makefile('rb').readline(CONTROL_MAX_REQUEST)
+            reply = self.dispatch(json.loads(line))
+        except (OSError, ValueError) as e:
+            reply = {'ok': False, 'error': f"bad request: {e}"}
+        except Exception as e:
+            logging.error(f"Control request failed: {e}")
+            reply = {'ok': False, 'error': f"internal error: {e}"}
+        try:
+            conn.sendall(json.dumps(reply).encode() + b'\n')
+        except OSError:
+            pass
+
+    def dispatch(self, request):
+        if not isinstance(request, dict):
+            return {'ok': False, 'error': "bad request: expected a JSON object"}
+        cmd = request.get('cmd')
+        service = self.service
+        if cmd == 'status':
+            return {'ok': True, 'state': service.state()}
+        if cmd == 'refresh':
+            return {'ok': True, 'state': service.refresh_now()}
+        if cmd == 'switch':
+            mode = request.get('mode')
+            if not isinstance(mode, str):
+                return {'ok': False, 'error': "bad request: 'mode' must be a string"}
+            ok, message = service.switch(mode)
+            return {'ok': ok, 'message': message}
+        if cmd == 'cancel':
+            ok = service.cancel_switch()
+            return {'ok': ok, 'message': "cancel requested" if ok else "switch cannot be cancelled"}
+        if cmd == 'prepare':
+            ok, message = service.prepare_fast_switching()
+            return {'ok': ok, 'message': message}
+        if cmd == 'apply-now':
+            ok, message = service.apply_now()
+            return {'ok': ok, 'message': message}
+        return {'ok': False, 'error': f"unknown command {cmd!r}"}
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.path.unlink(missing_ok=True)
+
+
+def control_request(cmd, path=SOCKET_PATH, **args):
+    """Send one command to the running service
+
+    Raises ConnectionError if none runs, ControlError if it answers late,
+    drops the connection or replies with something that is not JSON.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM | socket.SOCK_CLOEXEC)
+    sock.settimeout(CONTROL_TIMEOUT)
+    try:
+        sock.connect(str(path))
+        sock.sendall(json.dumps(dict(args, cmd=cmd)).encode() + b'\n')
+        line = sock.makefile('rb').readline()
+    except (FileNotFoundError, ConnectionRefusedError) as e:
+        raise ConnectionError(str(e))
+    except socket.timeout:
+        raise ControlError(f"no reply from gpumode service within {CONTROL_TIMEOUT:g}s")
+    except OSError as e:
+        raise ControlError(f"control socket error: {e.strerror or e}")
+    finally:
+        sock.close()
+    if not line:
+        raise ControlError("gpumode service closed the connection without replying")
+    try:
+        reply = json.loads(line)
+    except ValueError:
+        raise ControlError("gpumode service sent a malformed reply")
+    if not isinstance(reply, dict):
+        raise ControlError("gpumode service sent a malformed reply")
+    return reply
+
+
+def probe_on_battery(sysfs_root=SYSFS_ROOT):
+    """True/False from the mains/USB supplies in sysfs, None if the machine reports none"""
+    online = None
+    for supply in Path(sysfs_root, "class/power_supply").glob("*"):
+        try:
+            if (supply / "type").read_text().strip() not in ("Mains", "USB"):
+                continue
+            online = online or (supply / "online").read_text().strip() == "1"
+        except OSError:
+            continue
+    return None if online is None else not online
+
+
+def load_cached_mode():
+    """Load the last known GPU mode saved by a previous run"""
+    try:
+        return json.loads(STATE_FILE.read_text()).get('mode', 'unknown')
+    except (OSError, ValueError, AttributeError):
+        return "unknown"
+
+
+def save_cached_mode(mode):
+    """Persist the GPU mode so the next start can show it immediately"""
+    try:
+        STATE_FILE.parent.mkdir(parents=True, exist_ok=True)
+        tmp = STATE_FILE.with_suffix('.tmp')
+        tmp.write_text(json.dumps({'mode': mode}))
+        tmp.replace(STATE_FILE)
+    except OSError as e:
+        logging.error(f"Failed to save GPU mode cache: {e}")
+
+
+class GPUIndicator:
+    """Tray client of GPUModeService"""
+
+    def __init__(self, startup_probe=False):
+        setup_file_logging()
         logging.info("GPUMode Fedora started")
         
         if not self.check_envycontrol():
@@ -34,67 +2343,239 @@ class GPUIndicator:
                                     "Please install envycontrol:\ninstall envycontrol\nfrom https://github.com/bayasdev/envycontrol, releases/assets")
             return
         
-        Notify.init("GPUMode")
+        # Phase 1: show the icon with the last known mode, nothing else
+        self.startup_probe = startup_probe
+        self.startup_marks = {}
+        self.startup_checked = False
+        self.upower_client = None
+        self.upower_ready = False
+        self.last_power_state = None
+        self.settings = Settings()
+        self.metrics = MetricsStore(METRICS_FILE, textfile=self.settings.get('metrics_textfile') or None)
+        self.power_prompts_enabled = self.load_power_prompts_setting()
+        self.policy = PowerPolicy(self.settings)
+        self.policy_timer = None
+        self.policy_switch = None
+        self.battery_device = None
+        self.service = GPUModeService(self.settings, self.metrics, publish=not startup_probe)
+        self.control_server = None
+        self.switch_notification = None
+        self.app_index = None
+        self.app_index_busy = False
         
         self.indicator = AppIndicator3.Indicator.new(
-            "gpumode",
+            "gpumode-benchmark" if startup_probe else "gpumode",
             "video-display",
             AppIndicator3.IndicatorCategory.HARDWARE
         )
         self.indicator.set_status(AppIndicator3.IndicatorStatus.ACTIVE)
-        
-        self.switching = False
-        self.current_mode = self.get_current_mode()
         self.update_icon()
+        self.indicator.set_menu(self.build_menu())
         
-        self.power_prompts_enabled = self.load_power_prompts_setting()
+        logging.info(f"Cached GPU mode: {self.current_mode}")
+        logging.info(f"Power prompts enabled: {self.power_prompts_enabled}")
         
-        self.indicator.set_menu(self.build_menu())
+        GLib.idle_add(self.finish_startup)
+
+    # Service state, read by TrayMenu and the notification helpers
+    @property
+    def current_mode(self):
+        return self.service.mode
+
+    @property
+    def pending_mode(self):
+        return self.service.pending_mode
+
+    @property
+    def switching(self):
+        return self.service.switching
+
+    @property
+    def busy_label(self):
+        return self.service.busy_label
+
+    @property
+    def fast_switch_ready(self):
+        return self.service.fast_switch_ready
+
+    @property
+    def switch_proc(self):
+        return self.service.switch_proc
+
+    def mark_startup(self, phase):
+        """Record a startup milestone (CLOCK_MONOTONIC, comparable across processes)"""
+        self.startup_marks[phase] = time.monotonic()
+        logging.info(f"Startup phase '{phase}' reached after {(self.startup_marks[phase] - STARTED_AT) * 1000:.0f} ms")
+
+    def finish_startup(self):
+        """Phase 2: runs once the icon is up - notifications, service, UPower"""
+        self.mark_startup('icon')
         
-        self.upower_client = UPowerGlib.Client.new()
-        self.upower_client.connect('notify::on-battery', self.on_power_changed)
-        self.last_power_state = self.upower_client.get_on_battery()
+        load_gi_modules('Notify', 'UPowerGlib')
+        Notify.init("GPUMode")
         
+        self.service.add_listener(
+            lambda event, data: GLib.idle_add(self.on_service_event, event, data)
+        )
+        self.service.start()
+        if not self.startup_probe:
+            self.control_server = ControlServer(self.service)
+            try:
+                self.control_server.start()
+            except (OSError, RuntimeError) as e:
+                logging.error(f"Control socket unavailable: {e}")
+                self.control_server = None
+        self.connect_upower()
+        self.refresh_app_index()
+        return False
+
+    def on_service_event(self, event, data):
+        """Apply a service state change (GTK main thread)"""
+        if event == 'mode-changed':
+            self.update_icon()
+            self.update_menu()
+            if data['first']:
+                self.maybe_check_startup()
+        elif event in ('staged-sets', 'dgpu-status', 'dgpu-holders'):
+            self.update_menu()
+        elif event == 'dgpu-awake':
+            self.notify_dgpu_awake(data['minutes'], data['holders'])
+        elif event == 'switch-started':
+            self.switch_started(data['mode'], data['staged'], data['changes'])
+        elif event == 'switch-phase':
+            self.on_switch_phase(data['phase'], data['label'])
+        elif event == 'switch-finished':
+            if data['result'] == 'cancelled':
+                self.switch_cancelled()
+            else:
+                self.switch_complete(data['mode'], data['result'] in ('success', 'unchanged'),
+                                     data['error'], unchanged=data['result'] == 'unchanged')
+        elif event == 'prepare-started':
+            self.prepare_started()
+        elif event == 'prepare-finished':
+            self.prepare_complete(data['error'])
+        elif event == 'apply-now-started':
+            self.update_icon()
+            self.update_menu()
+            GLib.timeout_add_seconds(1, self.tick_switch_progress)
+        elif event == 'apply-now-finished':
+            self.apply_now_complete(data)
+        return False
+
+    def connect_upower(self):
+        """Create the UPower client without blocking the main loop where possible"""
+        if hasattr(UPowerGlib.Client, 'new_async'):
+            UPowerGlib.Client.new_async(None, self.on_upower_ready)
+        else:
+            self.on_upower_ready(None, None)
+
+    def on_upower_ready(self, _source, result):
+        """Finish UPower client creation and subscribe to AC/battery changes"""
+        try:
+            if result is not None:
+                client = UPowerGlib.Client.new_finish(result)
+            else:
+                client = UPowerGlib.Client.new()
+            client.connect('notify::on-battery', self.on_power_changed)
+            self.upower_client = client
+            self.last_power_state = client.get_on_battery()
+            self.service.set_power_state(self.last_power_state)
+            logging.info(f"Initial power state: {'battery' if self.last_power_state else 'AC'}")
+        except Exception as e:
+            logging.error(f"Failed to connect to UPower: {e}")
+        try:
+            device = self.upower_client.get_display_device()
+            if device.props.is_present:
+                device.connect('notify::percentage', self.on_battery_changed)
+                device.connect('notify::time-to-empty', self.on_battery_changed)
+                self.battery_device = device
+        except Exception as e:
+            logging.info(f"No battery level from UPower: {e}")
+        self.upower_ready = True
+        self.maybe_check_startup()
+
+    def maybe_check_startup(self):
+        """Run the startup mismatch check once mode and power state are accurate"""
+        if self.startup_checked or not (self.service.mode_accurate and self.upower_ready):
+            return
+        self.startup_checked = True
+        self.mark_startup('accurate')
         logging.info(f"Initial GPU mode: {self.current_mode}")
-        logging.info(f"Initial power state: {'battery' if self.last_power_state else 'AC'}")
-        logging.info(f"Power prompts enabled: {self.power_prompts_enabled}")
         
-        GLib.timeout_add(2000, self.check_startup_mismatch)
+        if self.startup_probe:
+            print(json.dumps(self.startup_marks), flush=True)
+            Gtk.main_quit()
+            return
+        
+        self.check_startup_mismatch()
 
     def check_startup_mismatch(self):
         """Check if GPU mode mismatches power state at startup"""
-        if not self.power_prompts_enabled:
-            logging.info("Power prompts disabled, skipping startup check")
+        if self.upower_client is None:
+            logging.info("No UPower client, skipping startup check")
+            return False
+        
+        # The power source has been what it is since before we started: no debounce
+        self.observe_power(settled=True)
+        self.evaluate_policy()
+        return False
+
+    def observe_power(self, settled=False):
+        """Feed the current UPower state to the policy"""
+        percentage = time_to_empty = None
+        if self.battery_device is not None:
+            percentage = self.battery_device.props.percentage
+            time_to_empty = self.battery_device.props.time_to_empty
+        self.policy.observe(self.last_power_state, percentage, time_to_empty, settled=settled)
+
+    def evaluate_policy(self):
+        """Act on a due policy decision, or wait for the debounce/cooldown to pass"""
+        if self.policy_timer is not None:
+            GLib.source_remove(self.policy_timer)
+            self.policy_timer = None
+        if not self.power_prompts_enabled or self.switching:
             return False
         
-        on_battery = self.upower_client.get_on_battery()
+        # A switch waiting for its reboot already decides the next boot's mode
+        mode = self.pending_mode or self.current_mode
+        decision = self.policy.evaluate(mode)
+        if decision is None:
+            if self.policy.retry_in is not None:
+                self.policy_timer = GLib.timeout_add(int(self.policy.retry_in * 1000) + 100,
+                                                     self.on_policy_timer)
+            return False
         
-        if on_battery and self.current_mode in ['nvidia', 'hybrid']:
-            logging.info("Startup mismatch: On battery but using NVIDIA/Hybrid")
-            self.notify_switch_suggestion_battery()
-        elif not on_battery and self.current_mode == 'integrated':
-            logging.info("Startup mismatch: On AC but using Integrated")
-            self.notify_switch_suggestion_ac()
+        log_event('policy-decision', mode=mode, **decision)
+        if decision['action'] == 'schedule' and self.schedule_switch(decision):
+            return False
+        if decision['target'] == 'integrated':
+            self.notify_switch_suggestion_battery(decision['reason'])
         else:
-            logging.info("No startup mismatch detected")
-        
+            self.notify_switch_suggestion_ac()
         return False
 
+    def on_policy_timer(self):
+        self.policy_timer = None
+        return self.evaluate_policy()
+
+    def schedule_switch(self, decision):
+        """Start the switch the policy decided on; it takes effect on next reboot"""
+        ok, message = self.service.switch(decision['target'])
+        if not ok:
+            logging.info(f"Policy switch to {decision['target']} not started: {message}")
+            return False
+        self.policy_switch = decision
+        return True
+
     def load_power_prompts_setting(self):
         """Load power prompts enabled setting from file"""
-        if not SETTINGS_FILE.exists():
-            return True
-        
-        try:
-            content = SETTINGS_FILE.read_text().strip()
-            return content == "enabled"
-        except:
-            return True
+        return self.settings.get('power_prompts') != "disabled"
 
     def save_power_prompts_setting(self, enabled):
         """Save power prompts enabled setting to file"""
         try:
-            SETTINGS_FILE.write_text("enabled" if enabled else "disabled")
+            self.settings.set('power_prompts', "enabled" if enabled else "disabled")
+            self.settings.save()
             logging.info(f"Power prompts {'enabled' if enabled else 'disabled'}")
         except Exception as e:
             logging.error(f"Failed to save power prompts setting: {e}")
@@ -120,17 +2601,19 @@ class GPUIndicator:
         
         logging.info(f"Power state changed: {'AC->Battery' if on_battery else 'Battery->AC'}")
         self.last_power_state = on_battery
+        self.service.set_power_state(on_battery)
         
-        if not self.power_prompts_enabled:
-            logging.info("Power notifications disabled, skipping")
+        self.observe_power()
+        self.evaluate_policy()
+
+    def on_battery_changed(self, device, pspec):
+        """Handle battery percentage / time-to-empty changes"""
+        if self.last_power_state is None:
             return
-        
-        if on_battery:
-            self.notify_switch_suggestion_battery()
-        else:
-            self.notify_switch_suggestion_ac()
+        self.observe_power()
+        self.evaluate_policy()
 
-    def notify_switch_suggestion_battery(self):
+    def notify_switch_suggestion_battery(self, reason="Running on battery"):
         """Show informational notification suggesting switch to integrated on battery"""
         if self.current_mode == "integrated":
             logging.info("Already on integrated, skipping battery notification")
@@ -140,13 +2623,40 @@ class GPUIndicator:
         
         notification = Notify.Notification.new(
             "Battery Power Detected",
-            f"Currently in {self.current_mode.upper()} mode.\n\nConsider switching to Integrated GPU via the menu for better battery life.\n\nNote: Manual GPU switching takes 1-3 minutes due to how Fedora processes GPU configuration changes.",
+            f"{reason[0].upper() + reason[1:]}. Currently in {self.current_mode.upper()} mode.\n\n{self.battery_gain_text()}\n\n{self.switch_time_text('integrated')}",
             "battery-caution-symbolic"
         )
         notification.set_urgency(Notify.Urgency.NORMAL)
         notification.set_timeout(10000)
         notification.show()
 
+    def battery_gain_text(self):
+        """Suggestion text quoting measured per-mode discharge where there is enough data"""
+        battery = self.service.battery
+        with self.service.lock:
+            stats = battery.mode_stats()
+            recent = battery.recent_watts()
+        current = stats.get(self.current_mode)
+        integrated = stats.get('integrated')
+        if (current and integrated and current['samples'] >= BATTERY_MIN_SAMPLES
+                and integrated['samples'] >= BATTERY_MIN_SAMPLES):
+            def describe(label, entry):
+                hours = f" (about {entry['hours']:.1f} h per charge)" if entry['hours'] else ""
+                return f"{label} averages {entry['watts']:.1f} W{hours}"
+            return (f"Measured on this laptop: {describe(self.current_mode.capitalize(), current)}, "
+                    f"{describe('Integrated', integrated)}. Switch via the menu to save power.")
+        if recent is not None:
+            return (f"Currently drawing {recent:.1f} W. Consider switching to Integrated GPU "
+                    "via the menu for better battery life.")
+        return "Consider switching to Integrated GPU via the menu for better battery life."
+
+    def switch_time_text(self, mode):
+        """How long a switch to `mode` takes, from the same staged-set status the menu shows"""
+        if self.fast_switch_ready.get(mode):
+            return f"Fast switching is prepared: switching to {mode.capitalize()} takes a few seconds."
+        return ("Switching takes 1-3 minutes while Fedora rebuilds the GPU configuration. "
+                "Select \"Prepare Fast Switching\" in the menu to make switches take a few seconds.")
+
     def notify_switch_suggestion_ac(self):
         """Show informational notification suggesting switch to hybrid on AC"""
         if self.current_mode == "hybrid":
@@ -157,7 +2667,7 @@ class GPUIndicator:
         
         notification = Notify.Notification.new(
             "AC Power Connected",
-            f"Currently in {self.current_mode.upper()} mode.\n\nConsider switching to Hybrid mode via the menu for balanced performance.\n\nNote: Manual GPU switching takes 1-3 minutes due to how Fedora processes GPU configuration changes.",
+            f"Currently in {self.current_mode.upper()} mode.\n\nConsider switching to Hybrid mode via the menu for balanced performance.\n\n{self.switch_time_text('hybrid')}",
             "battery-full-charging-symbolic"
         )
         notification.set_urgency(Notify.Urgency.NORMAL)
@@ -166,12 +2676,7 @@ class GPUIndicator:
 
     def check_envycontrol(self):
         """Check if envycontrol is installed"""
-        try:
-            result = subprocess.run(['which', 'envycontrol'], 
-                                  capture_output=True, timeout=2)
-            return result.returncode == 0
-        except:
-            return False
+        return shutil.which('envycontrol') is not None
 
     def show_error_and_exit(self, title, message):
         """Show error dialog and exit"""
@@ -187,46 +2692,8 @@ class GPUIndicator:
         sys.exit(1)
 
     def get_current_mode(self):
-        """Query current GPU mode - checks glxinfo first to detect BIOS-set NVIDIA mode"""
-        try:
-            glx_result = subprocess.run(['sh', '-c', 'glxinfo | grep "OpenGL renderer"'], 
-                                      capture_output=True, text=True, timeout=2)
-            if glx_result.returncode == 0:
-                renderer = glx_result.stdout.strip()
-                logging.info(f"glxinfo renderer string: {renderer}")
-                
-                if 'NVIDIA' in renderer and 'AMD' not in renderer:
-                    logging.info("Detected NVIDIA-only mode via glxinfo (BIOS-set)")
-                    return "nvidia"
-                elif 'AMD' in renderer and 'NVIDIA' not in renderer:
-                    try:
-                        result = subprocess.run(['envycontrol', '--query'], 
-                                              capture_output=True, text=True, timeout=2)
-                        if result.returncode == 0:
-                            mode = result.stdout.strip().lower()
-                            logging.info(f"Queried GPU mode from envycontrol: {mode}")
-                            return mode
-                    except:
-                        pass
-                    logging.info("Detected integrated mode via glxinfo")
-                    return "integrated"
-                elif 'AMD' in renderer and 'NVIDIA' in renderer:
-                    logging.info("Detected hybrid mode via glxinfo")
-                    return "hybrid"
-        except Exception as e:
-            logging.error(f"Failed to query GPU mode with glxinfo: {e}")
-            
-            try:
-                result = subprocess.run(['envycontrol', '--query'], 
-                                      capture_output=True, text=True, timeout=2)
-                if result.returncode == 0:
-                    mode = result.stdout.strip().lower()
-                    logging.info(f"Queried GPU mode from envycontrol (fallback): {mode}")
-                    return mode
-            except:
-                pass
-        
-        return "unknown"
+        """Query current GPU mode from sysfs and envycontrol config files (cached)"""
+        return self.service.probe_mode()
 
     def update_icon(self):
         """Update tray icon based on current state"""
@@ -242,104 +2709,118 @@ class GPUIndicator:
             self.indicator.set_icon("dialog-question-symbolic")
 
     def refresh_mode(self):
-        """Refresh current GPU mode"""
-        if not self.switching:
-            old_mode = self.current_mode
-            self.current_mode = self.get_current_mode()
-            if old_mode != self.current_mode:
-                logging.info(f"GPU mode changed: {old_mode} -> {self.current_mode}")
-                self.update_icon()
-                self.indicator.set_menu(self.build_menu())
+        """Refresh current GPU mode in the background, menu keeps the last known mode"""
+        self.service.refresh()
+        # The dGPU residency figures move without a state change; refresh them when shown
+        if self.service.rtd3.status is not None:
+            self.update_menu()
 
-    def build_menu(self):
-        """Build the indicator menu"""
-        menu = Gtk.Menu()
-        
-        menu.connect('show', lambda _: self.refresh_mode())
-        
-        if self.switching:
-            status = Gtk.MenuItem(label='━━━ SWITCHING... ━━━')
-        else:
-            status = Gtk.MenuItem(label=f'━━━ Current: {self.current_mode.upper()} ━━━')
-        status.set_sensitive(False)
-        menu.append(status)
+    def dgpu_power_text(self):
+        """dGPU runtime PM line for the menu (hybrid mode only), or None"""
+        with self.service.lock:
+            summary = self.service.rtd3.summary()
+        if summary is None:
+            return None
+        text = f"dGPU: {summary['status']}"
+        residency = summary['residency']['10m']
+        if residency is not None:
+            text += f" · {residency:.0%} suspended (10 min)"
+        return text
+
+    def dgpu_holders_text(self):
+        """Menu line naming the processes that keep the dGPU awake, or None"""
+        holders = self.service.gpu_holders
+        if not holders:
+            return None
+        names = [f"{h['name']} ({h['pid']})" for h in holders[:GPU_HOLDER_MENU_MAX]]
+        if len(holders) > GPU_HOLDER_MENU_MAX:
+            names.append(f"+{len(holders) - GPU_HOLDER_MENU_MAX} more")
+        return "Using dGPU: " + ", ".join(names)
+
+    def refresh_app_index(self):
+        """Update the app list in the background if application directories changed"""
+        self.settings.load()
+        self.update_app_menu()
+        if self.app_index_busy or (self.app_index is not None and not self.app_index.needs_refresh()):
+            return
+        self.app_index_busy = True
+        index = self.app_index
         
-        menu.append(Gtk.SeparatorMenuItem())
+        def refresh_thread():
+            try:
+                app_index = index or AppIndex()
+                app_index.refresh()
+            except Exception as e:
+                logging.error(f"Failed to index applications: {e}")
+                app_index = index
+            GLib.idle_add(self.on_app_index_refreshed, app_index)
         
-        if self.current_mode == 'nvidia':
-            blocked_warning = Gtk.MenuItem(label='⚠ NVIDIA Mode Active')
-            blocked_warning.set_sensitive(False)
-            menu.append(blocked_warning)
-            
-            blocked_msg = Gtk.MenuItem(label='Set BIOS to Hybrid (F2) to enable switching')
-            blocked_msg.set_sensitive(False)
-            menu.append(blocked_msg)
-            
-            menu.append(Gtk.SeparatorMenuItem())
-            
-            integrated = Gtk.MenuItem(label='⚪ Integrated GPU')
-            integrated.set_sensitive(False)
-            menu.append(integrated)
-            
-            hybrid = Gtk.MenuItem(label='⚪ Hybrid Mode')
-            hybrid.set_sensitive(False)
-            menu.append(hybrid)
-            
-            nvidia = Gtk.MenuItem(label='● NVIDIA GPU (ACTIVE)')
-            nvidia.set_sensitive(False)
-            menu.append(nvidia)
-        else:
-            warning = Gtk.MenuItem(label='⚠ NVIDIA mode: Use BIOS (F2)')
-            warning.set_sensitive(False)
-            menu.append(warning)
-            
-            menu.append(Gtk.SeparatorMenuItem())
-            
-            integrated = Gtk.MenuItem(
-                label='⚪ Integrated GPU' if self.current_mode != 'integrated' 
-                else '● Integrated GPU (ACTIVE)'
-            )
-            integrated.connect('activate', self.switch_integrated)
-            if self.current_mode == 'integrated' or self.switching:
-                integrated.set_sensitive(False)
-            menu.append(integrated)
-            
-            hybrid = Gtk.MenuItem(
-                label='⚪ Hybrid Mode' if self.current_mode != 'hybrid' 
-                else '● Hybrid Mode (ACTIVE)'
+        threading.Thread(target=refresh_thread, name="app-index", daemon=True).start()
+
+    def on_app_index_refreshed(self, index):
+        self.app_index_busy = False
+        self.app_index = index
+        self.update_app_menu()
+        return False
+
+    def update_app_menu(self):
+        self.tray_menu.set_apps(self.app_index, pinned_apps(self.settings))
+        return False
+
+    def launch_app(self, app_id):
+        """Start an app from the Run on Discrete GPU menu"""
+        app = self.app_index.apps.get(app_id) if self.app_index else None
+        if app is None:
+            return
+        try:
+            launch_on_dgpu(app)
+        except (OSError, ValueError) as e:
+            logging.error(f"Failed to launch {app_id} on the dGPU: {e}")
+            notification = Notify.Notification.new(
+                f"Could Not Start {app['name']}",
+                f"Error: {e}",
+                "dialog-error"
             )
-            hybrid.connect('activate', self.switch_hybrid)
-            if self.current_mode == 'hybrid' or self.switching:
-                hybrid.set_sensitive(False)
-            menu.append(hybrid)
-            
-            nvidia = Gtk.MenuItem(label='⚪ NVIDIA GPU')
-            nvidia.set_sensitive(False)
-            menu.append(nvidia)
-        
-        menu.append(Gtk.SeparatorMenuItem())
-        
-        power_prompts_item = Gtk.CheckMenuItem(label='Power Change Notifications')
-        power_prompts_item.set_active(self.power_prompts_enabled)
-        power_prompts_item.connect('activate', self.toggle_power_prompts)
-        if self.switching or self.current_mode == 'nvidia':
-            power_prompts_item.set_sensitive(False)
-        menu.append(power_prompts_item)
-        
-        about_item = Gtk.MenuItem(label='About')
-        about_item.connect('activate', self.show_about)
-        menu.append(about_item)
-        
-        menu.append(Gtk.SeparatorMenuItem())
-        
-        quit_item = Gtk.MenuItem(label='Quit')
-        quit_item.connect('activate', Gtk.main_quit)
-        if self.switching:
-            quit_item.set_sensitive(False)
-        menu.append(quit_item)
-        
-        menu.show_all()
-        return menu
+            notification.show()
+
+    def toggle_pin(self, widget, app_id):
+        """Pin or unpin an app at the top of the Run on Discrete GPU menu"""
+        self.settings.load()
+        pinned = [a for a in pinned_apps(self.settings) if a != app_id]
+        if widget.get_active():
+            pinned.append(app_id)
+        try:
+            self.settings.set('dgpu_apps', ",".join(pinned))
+            self.settings.save()
+        except Exception as e:
+            logging.error(f"Failed to save pinned apps: {e}")
+        # Not from inside the activate handler of an item the rebuild destroys
+        GLib.idle_add(self.update_app_menu)
+
+    def notify_dgpu_awake(self, minutes, holders):
+        """Warn that the dGPU keeps hybrid mode from saving power"""
+        if holders:
+            cause = "Apps keeping it awake: " + ", ".join(f"{h['name']} ({h['pid']})" for h in holders)
+        else:
+            cause = "Apps using the NVIDIA GPU keep it awake."
+        notification = Notify.Notification.new(
+            "NVIDIA GPU Not Sleeping",
+            f"The NVIDIA GPU has not powered down for {minutes:.0f} minutes. In Hybrid mode this costs several watts.\n\n{cause}",
+            "dialog-warning"
+        )
+        notification.set_urgency(Notify.Urgency.NORMAL)
+        notification.set_timeout(10000)
+        notification.show()
+
+    def build_menu(self):
+        """Build the persistent indicator menu (once)"""
+        self.tray_menu = TrayMenu(self)
+        self.update_menu()
+        return self.tray_menu.menu
+
+    def update_menu(self):
+        """Update labels/sensitivity of the existing menu to the current state"""
+        self.tray_menu.update()
 
     def switch_integrated(self, _):
         self.switch_gpu('integrated')
@@ -347,59 +2828,162 @@ class GPUIndicator:
     def switch_hybrid(self, _):
         self.switch_gpu('hybrid')
 
-    def switch_gpu(self, mode):
-        """Switch GPU mode"""
-        if self.switching:
-            return
-        
-        logging.info(f"Switching to {mode} mode")
-        self.switching = True
+    def prepare_fast_switching(self, _):
+        """Build the per-mode staged sets so later switches take seconds"""
+        self.service.prepare_fast_switching()
+
+    def prepare_started(self):
+        """Staged set preparation started (main thread)"""
         self.update_icon()
-        self.indicator.set_menu(self.build_menu())
+        self.update_menu()
         
         notification = Notify.Notification.new(
             "GPUMode",
-            f"Switching to {mode} mode...\n\nThis will take 1-3 minutes.",
+            "Preparing fast switching...\n\nThis builds the configuration for each mode once and takes several minutes.",
             "emblem-synchronizing"
         )
         notification.show()
+
+    def prepare_complete(self, error):
+        """Handle the end of a staged set preparation"""
+        self.update_icon()
+        self.update_menu()
         
-        def switch_thread():
-            try:
-                cmd = ['pkexec', 'envycontrol', '-s', mode]
-                if mode == 'hybrid':
-                    cmd.extend(['--rtd3', '2'])
-                
-                result = subprocess.run(
-                    cmd,
-                    capture_output=True, 
-                    text=True
-                )
-                
-                if result.returncode == 126 or result.returncode == 127:
-                    GLib.idle_add(self.switch_cancelled)
-                elif result.returncode == 0:
-                    GLib.idle_add(self.switch_complete, mode, True, None)
-                else:
-                    GLib.idle_add(self.switch_complete, mode, False, result.stderr)
-                    
-            except subprocess.TimeoutExpired:
-                logging.error("Switch command timed out")
-                GLib.idle_add(self.switch_complete, mode, False, "Command timed out")
-            except Exception as e:
-                logging.error(f"Switch error: {e}")
-                GLib.idle_add(self.switch_complete, mode, False, str(e))
+        if error is None:
+            notification = Notify.Notification.new(
+                "✓ Fast Switching Ready",
+                "GPU switches will now take a few seconds.",
+                "dialog-information"
+            )
+        else:
+            notification = Notify.Notification.new(
+                "✗ Fast Switching Preparation Failed",
+                f"Error: {error}",
+                "dialog-error"
+            )
+        notification.show()
+        return False
+
+    def switch_progress_text(self):
+        """Phase and elapsed time of a running switch, or None"""
+        service = self.service
+        if not service.switching or service.switch_phase is None:
+            return None
+        elapsed = int(time.monotonic() - service.switch_started)
+        return f"{service.switch_phase} ({elapsed // 60}:{elapsed % 60:02d})"
+
+    def on_switch_phase(self, phase, label):
+        """A running switch reached a new phase (main thread)"""
+        self.tick_switch_progress()
+        if self.switch_notification is not None:
+            self.switch_notification.update("GPUMode", f"{self.busy_label.capitalize()}: {label}...",
+                                            "emblem-synchronizing")
+            self.switch_notification.show()
+        return False
+
+    def tick_switch_progress(self):
+        """Refresh the tray label/progress item once a second while switching"""
+        text = self.switch_progress_text()
+        if text is None:
+            self.indicator.set_label("", "")
+            return False
+        self.indicator.set_label(text, "Rebuilding initramfs (00:00)")
+        self.update_menu()
+        return True
+
+    def cancel_switch(self, _):
+        """Try to stop the running switch command"""
+        if not self.service.cancel_switch():
+            notification = Notify.Notification.new(
+                "Switch Cannot Be Cancelled",
+                "The switch is already running with administrator rights. Wait for it to finish before rebooting.",
+                "dialog-warning"
+            )
+            notification.show()
+        self.update_menu()
+
+    def apply_now(self, _):
+        """Restart into the pending mode after the user confirms"""
+        mode = self.pending_mode
+        if mode is None:
+            return
+        dialog = Gtk.MessageDialog(
+            message_type=Gtk.MessageType.QUESTION,
+            buttons=Gtk.ButtonsType.OK_CANCEL,
+            text=f"Restart now into {mode.capitalize()} mode?"
+        )
+        dialog.format_secondary_text(
+            "Unsaved work in open applications will be lost. Where the system allows it, "
+            "the restart skips the firmware startup and takes a few seconds."
+        )
+        response = dialog.run()
+        dialog.destroy()
+        if response != Gtk.ResponseType.OK:
+            return
+        ok, message = self.service.apply_now()
+        if not ok:
+            logging.info(f"Restart into {mode} not started: {message}")
+
+    def apply_now_complete(self, outcome):
+        """Handle the end of an Apply Now restart that did not go ahead (main thread)"""
+        self.end_switch()
+        self.update_icon()
+        self.update_menu()
+        if outcome['result'] == 'rebooting':
+            return False
+        if outcome['result'] == 'cancelled':
+            notification = Notify.Notification.new(
+                "Restart Cancelled",
+                "Authentication was cancelled. The new mode still applies on your next reboot.",
+                "dialog-information"
+            )
+        else:
+            notification = Notify.Notification.new(
+                "✗ Restart Failed",
+                f"Error: {outcome['error'] or 'Command failed'}\n\nReboot manually to apply {outcome['mode'].upper()} mode.",
+                "dialog-error"
+            )
+        notification.show()
+        return False
+
+    def switch_gpu(self, mode):
+        """Switch GPU mode"""
+        ok, message = self.service.switch(mode)
+        if not ok:
+            logging.info(f"Switch to {mode} not started: {message}")
+
+    def switch_started(self, mode, staged, changes):
+        """A switch started, possibly requested by another client (main thread)"""
+        self.update_icon()
+        self.update_menu()
         
-        thread = threading.Thread(target=switch_thread)
-        thread.daemon = True
-        thread.start()
+        # Shown before the authentication prompt, so the user knows what they approve
+        plan = "\n".join(f"• {change}" for change in changes)
+        self.switch_notification = Notify.Notification.new(
+            "GPUMode",
+            f"Switching to {mode} mode...\n\n{plan}\n\n" +
+            ("This will take a few seconds." if staged else "This will take 1-3 minutes."),
+            "emblem-synchronizing"
+        )
+        self.switch_notification.show()
+        GLib.timeout_add_seconds(1, self.tick_switch_progress)
+
+    def end_switch(self):
+        """Clear running-switch UI state (main thread)"""
+        self.policy_switch = None
+        self.indicator.set_label("", "")
+        if self.switch_notification is not None:
+            try:
+                self.switch_notification.close()
+            except Exception:
+                pass
+            self.switch_notification = None
 
     def switch_cancelled(self):
         """Handle user cancelling pkexec password prompt"""
-        logging.info("User cancelled authentication")
-        self.switching = False
+        self.end_switch()
         self.update_icon()
-        self.indicator.set_menu(self.build_menu())
+        self.update_menu()
         
         notification = Notify.Notification.new(
             "Switch Cancelled",
@@ -409,15 +2993,47 @@ class GPUIndicator:
         notification.show()
         return False
 
-    def switch_complete(self, mode, success, error_msg):
+    def switch_complete(self, mode, success, error_msg, unchanged=False):
         """Handle switch completion"""
-        self.switching = False
+        scheduled = self.policy_switch
+        self.end_switch()
         
-        if success:
-            logging.info(f"Successfully switched to {mode}")
-            self.current_mode = mode
+        if unchanged and mode == self.current_mode and self.pending_mode is None:
+            self.update_icon()
+            self.update_menu()
+            
+            notification = Notify.Notification.new(
+                f"Already in {mode.upper()} Mode",
+                "The GPU configuration already matches this mode. Nothing was changed.",
+                "dialog-information"
+            )
+            notification.show()
+        elif unchanged and scheduled is None:
+            self.update_icon()
+            self.update_menu()
+            
+            notification = Notify.Notification.new(
+                f"{mode.upper()} Mode Already Configured",
+                f"The GPU configuration already matches {mode.upper()} mode, so nothing was changed.\n\n⚠️ REBOOT NOW for it to take effect!",
+                "dialog-warning"
+            )
+            notification.set_urgency(Notify.Urgency.CRITICAL)
+            notification.set_timeout(10000)
+            notification.show()
+        elif success and scheduled is not None:
             self.update_icon()
-            self.indicator.set_menu(self.build_menu())
+            self.update_menu()
+            
+            notification = Notify.Notification.new(
+                "GPU Mode Scheduled",
+                f"Switched to {mode.upper()} mode ({scheduled['reason']}).\n\nThe change applies on your next reboot.",
+                "dialog-information"
+            )
+            notification.set_timeout(10000)
+            notification.show()
+        elif success:
+            self.update_icon()
+            self.update_menu()
             
             # Force GTK to process UI updates
             while Gtk.events_pending():
@@ -425,16 +3041,16 @@ class GPUIndicator:
             
             notification = Notify.Notification.new(
                 "✓ GPU Switched Successfully!",
-                f"Switched to {mode.upper()} mode.\n\n⚠️ REBOOT NOW for changes to take effect!",
+                f"Switched to {mode.upper()} mode.\n\n⚠️ REBOOT NOW for changes to take effect!\n"
+                "Restart Now in the GPUMode menu restarts quickly.",
                 "dialog-warning"
             )
             notification.set_urgency(Notify.Urgency.CRITICAL)
             notification.set_timeout(10000)
             notification.show()
         else:
-            logging.error(f"Failed to switch to {mode}: {error_msg}")
             self.update_icon()
-            self.indicator.set_menu(self.build_menu())
+            self.update_menu()
             
             notification = Notify.Notification.new(
                 "✗ GPU Switch Failed",
@@ -457,17 +3073,621 @@ class GPUIndicator:
         dialog.run()
         dialog.destroy()
 
+# Held for the life of the process; the lock goes away when the file is closed
+_instance_lock = None
+
 def single_instance():
-    """Ensure only one instance is running"""
+    """Ensure only one instance is running for this user"""
+    global _instance_lock
+    if _instance_lock is not None:
+        return True
     try:
+        RUNTIME_DIR.mkdir(mode=0o700, parents=True, exist_ok=True)
         lock_file = open(LOCK_FILE, 'w')
+    except OSError:
+        return False
+    try:
         fcntl.lockf(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
-        return True
-    except IOError:
+    except OSError:
+        lock_file.close()
         return False
+    _instance_lock = lock_file
+    return True
 
-if __name__ == "__main__":
+def benchmark_startup(runs):
+    """Start the tray `runs` times and report time-to-icon and time-to-accurate-state"""
+    samples = {'icon': [], 'accurate': []}
+    for i in range(runs):
+        started = time.monotonic()
+        try:
+            result = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--startup-probe'],
+                capture_output=True, text=True, timeout=STARTUP_BENCHMARK_TIMEOUT
+            )
+            marks = json.loads(result.stdout.strip().splitlines()[-1])
+        except (subprocess.TimeoutExpired, ValueError, IndexError) as e:
+            print(f"run {i + 1}: failed ({e})", file=sys.stderr)
+            continue
+        for phase in samples:
+            samples[phase].append((marks[phase] - started) * 1000)
+        print(f"run {i + 1}: icon {samples['icon'][-1]:.0f} ms, accurate {samples['accurate'][-1]:.0f} ms")
+    
+    if not samples['icon']:
+        return 1
+    for phase, label in (('icon', 'time-to-icon'), ('accurate', 'time-to-accurate-state')):
+        values = samples[phase]
+        print(f"{label}: median {statistics.median(values):.0f} ms, "
+              f"min {min(values):.0f} ms, max {max(values):.0f} ms ({len(values)} runs)")
+    return 0
+
+def run_stage_command(args):
+    """Handle --stage-prepare / --stage-apply (run as root through pkexec)"""
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s - %(message)s')
+    if os.geteuid() != 0:
+        print("Staged switching needs root (run through pkexec)", file=sys.stderr)
+        return 1
+    stages = StagedSwitch()
+    try:
+        if args.stage_prepare:
+            stages.prepare(force=args.force)
+        else:
+            stages.apply(args.stage_apply)
+    except StageError as e:
+        print(str(e), file=sys.stderr)
+        return STAGE_EXIT_UNAVAILABLE if args.stage_apply else 1
+    except (OSError, subprocess.SubprocessError) as e:
+        print(f"Staged switch failed: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+def run_reboot_command(mode):
+    """Handle --reboot-into (run as root through pkexec); prints one JSON line per phase"""
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s - %(message)s')
+    if os.geteuid() != 0:
+        print("Restarting needs root (run through pkexec)", file=sys.stderr)
+        return 1
+    
+    def report(phase, started, **detail):
+        print(json.dumps(dict(detail, phase=phase, seconds=round(time.monotonic() - started, 3))), flush=True)
+    
+    reboot = FastReboot()
+    started = time.monotonic()
+    try:
+        plan = reboot.plan(mode)
+    except OSError as e:
+        print(f"Cannot check the configuration: {e}", file=sys.stderr)
+        return 1
+    report('check', started, method=plan['method'], reason=plan['reason'])
+    if plan['error']:
+        print(f"Not restarting: {plan['error']}", file=sys.stderr)
+        return 1
+    if plan['reason']:
+        logging.info(f"Not using kexec: {plan['reason']}")
+    return reboot.run(plan, report)
+
+def show_stats(args):
+    """Print per-operation timing percentiles (--stats)"""
+    metrics = MetricsStore(METRICS_FILE)
+    since = time.time() - args.days * 86400 if args.days else None
+    print(metrics.format_stats(since))
+    if args.textfile:
+        metrics.write_textfile(args.textfile)
+    return 0
+
+def simulate_policy(path):
+    """Replay power events against the [policy] rules with a simulated clock
+
+    Each line is `SECONDS ac|battery [PERCENT [MINUTES_TO_EMPTY]]` or
+    `SECONDS mode MODE`; the starting mode is hybrid.
+    """
+    now = [0.0]
+    policy = PowerPolicy(Settings(), clock=lambda: now[0])
+    mode = 'hybrid'
+    
+    def evaluate():
+        nonlocal mode
+        decision = policy.evaluate(mode)
+        if decision is not None:
+            print(f"{now[0]:>8.0f}s  {decision['action']} {decision['target']} ({decision['reason']})")
+            if decision['action'] == 'schedule':
+                mode = decision['target']
+    
+    def advance(t):
+        while policy.retry_in is not None and now[0] + policy.retry_in <= t:
+            now[0] += policy.retry_in
+            evaluate()
+        now[0] = max(now[0], t)
+    
+    try:
+        lines = Path(path).read_text().splitlines()
+    except OSError as e:
+        print(f"Cannot read {path}: {e}", file=sys.stderr)
+        return 1
+    for number, line in enumerate(lines, 1):
+        fields = line.split('#')[0].split()
+        if not fields:
+            continue
+        try:
+            t = float(fields[0])
+            kind = fields[1]
+            advance(t)
+            if kind == 'mode':
+                mode = fields[2]
+            elif kind in ('ac', 'battery'):
+                percentage = float(fields[2]) if len(fields) > 2 else None
+                time_to_empty = float(fields[3]) * 60 if len(fields) > 3 else None
+                policy.observe(kind == 'battery', percentage, time_to_empty)
+            else:
+                raise ValueError(f"unknown event {kind!r}")
+        except (IndexError, ValueError) as e:
+            print(f"{path}:{number}: {e}", file=sys.stderr)
+            return 1
+        evaluate()
+    advance(now[0] + policy.debounce + policy.cooldown)
+    return 0
+
+def show_events(args):
+    """Print structured events, optionally filtered (--events)"""
+    return print_events(EVENTS_FILE, args.type, args.since, args.until, args.json)
+
+def show_gpu_holders():
+    """Print the processes holding the dGPU open (--gpu-holders)"""
+    scanner = GPUHolderScanner()
+    holders = scanner.scan()
+    if scanner.bdf is None:
+        print("No NVIDIA GPU found (integrated mode or GPU removed)")
+        return 0
+    status = RuntimePMMonitor(bdf=scanner.bdf).sample()
+    print(f"dGPU {scanner.bdf}: {status or 'runtime PM unavailable'}")
+    if not holders:
+        print("No processes hold the dGPU open")
+    for holder in holders:
+        print(f"{holder['pid']:>8}  {holder['name']:<16} {', '.join(holder['devices'])}")
+    if scanner.denied:
+        print(f"({scanner.denied} processes of other users not inspected; run as root to include them)")
+    return 0
+
+def find_app(index, query):
+    """The one app matching `query`, or None after printing why"""
+    matches = index.lookup(query) or index.search(query)
+    if len(matches) == 1:
+        return matches[0]
+    if not matches:
+        print(f"No installed application matches {query!r} (see gpumode --list-apps)", file=sys.stderr)
+    else:
+        print(f"{query!r} matches several applications:", file=sys.stderr)
+        for app in matches:
+            print(f"  {app['id']:<40} {app['name']}", file=sys.stderr)
+    return None
+
+def run_on_dgpu(command):
+    """--run-dgpu APP [ARGS...]: run an installed app or any command with PRIME render offload"""
+    if not command:
+        print("Usage: gpumode --run-dgpu APP|COMMAND [ARGS...]", file=sys.stderr)
+        return 2
+    if ModeProbe().get_mode() == 'integrated':
+        print("The NVIDIA GPU is off in integrated mode; switch to hybrid mode first", file=sys.stderr)
+        return 1
+    query, extra = command[0], command[1:]
+    index = AppIndex(watch=False)
+    index.refresh()
+    # An exact app match wins, then a command on PATH, then a unique partial app match
+    matches = index.lookup(query)
+    if not matches and shutil.which(query):
+        argv, cwd = command, None
+    else:
+        app = matches[0] if len(matches) == 1 else find_app(index, query)
+        if app is None:
+            return 1
+        argv, cwd = desktop_exec_argv(app) + extra, app.get('path')
+    argv, env = prime_offload_command(argv)
+    try:
+        if cwd and os.path.isdir(cwd):
+            os.chdir(cwd)
+        os.execvpe(argv[0], argv, env)
+    except OSError as e:
+        print(f"Cannot run {argv[0]}: {e}", file=sys.stderr)
+        return 127
+
+def list_apps():
+    """--list-apps: installed applications, pinned ones marked"""
+    index = AppIndex(watch=False)
+    index.refresh()
+    pinned = set(pinned_apps(Settings()))
+    for app in index.sorted_apps():
+        marks = [m for m, on in (('pinned', app['id'] in pinned), ('prefers dGPU', app['prefers_dgpu'])) if on]
+        print(f"{app['id']:<40} {app['name']}" + (f"  ({', '.join(marks)})" if marks else ""))
+    return 0
+
+def pin_app(query, pin):
+    """--pin/--unpin APP: keep an app at the top of the Run on Discrete GPU menu"""
+    index = AppIndex(watch=False)
+    index.refresh()
+    app = find_app(index, query)
+    if app is None:
+        return 1
+    settings = Settings()
+    pinned = [a for a in pinned_apps(settings) if a != app['id']]
+    if pin:
+        pinned.append(app['id'])
+    settings.set('dgpu_apps', ",".join(pinned))
+    LOG_DIR.mkdir(parents=True, exist_ok=True)
+    settings.save()
+    print(f"{'Pinned' if pin else 'Unpinned'} {app['name']} ({app['id']})")
+    return 0
+
+def show_power_stats(args):
+    """Print average discharge power and estimated runtime per GPU mode (--power-stats)"""
+    history = PowerHistory(POWER_HISTORY_FILE)
+    since = time.time() - args.days * 86400 if args.days else None
+    sampler = BatterySampler(history)
+    sampler.battery = sampler.find_battery()
+    stats = sampler.mode_stats(since)
+    if not stats:
+        print(f"No battery samples recorded in {POWER_HISTORY_FILE}")
+        return 0
+    print(f"{'mode':<12}{'samples':>9}{'avg W':>9}{'runtime':>10}")
+    for mode, entry in sorted(stats.items()):
+        hours = f"{entry['hours']:.1f} h" if entry['hours'] else "-"
+        print(f"{mode:<12}{entry['samples']:>9}{entry['watts']:>9.1f}{hours:>10}")
+    by_profile = history.stats(since, by_profile=True)
+    print(f"\n{'mode':<12}{'TuneD profile':<26}{'samples':>9}{'avg W':>9}")
+    for (mode, profile), (count, watts) in sorted(by_profile.items()):
+        print(f"{mode:<12}{profile or '-':<26}{count:>9}{watts:>9.1f}")
+    return 0
+
+def setup_file_logging():
+    setup_logging(LOG_FILE, EVENTS_FILE)
+
+def run_daemon():
+    """Headless service: no tray, just the control socket (--daemon)"""
+    setup_file_logging()
+    if not single_instance():
+        print("GPUMode is already running", file=sys.stderr)
+        return 1
+    settings = Settings()
+    service = GPUModeService(settings, MetricsStore(METRICS_FILE, textfile=settings.get('metrics_textfile') or None))
+    service.add_listener(lambda event, data: logging.info(f"Service event {event}: {data}"))
+    service.start()
+    server = ControlServer(service)
+    try:
+        server.start()
+    except (OSError, RuntimeError) as e:
+        print(f"Control socket unavailable: {e}", file=sys.stderr)
+        return 1
+    logging.info("GPUMode daemon started")
+    stop = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: stop.set())
+    stop.wait()
+    server.close()
+    logging.info("GPUMode daemon stopped")
+    return 0
+
+def print_state(state, as_json):
+    if as_json:
+        print(json.dumps(state, indent=2))
+        return
+    print(f"mode: {state['mode']}" + ("" if state.get('mode_accurate', True) else " (cached)"))
+    if state.get('pending_mode'):
+        print(f"after reboot: {state['pending_mode']}")
+    if state.get('on_battery') is not None:
+        watts = f" ({state['battery_watts']:.1f} W)" if state.get('battery_watts') and state['on_battery'] else ""
+        print(f"power: {'battery' if state['on_battery'] else 'AC'}{watts}")
+    if state.get('switching'):
+        print(f"{state['busy']}: {state['switch_phase'] or 'starting'} ({state['switch_elapsed']:.0f}s)")
+    dgpu = state.get('dgpu')
+    if dgpu:
+        residency = ", ".join(f"{value:.0%} ({window})" for window, value in dgpu['residency'].items()
+                              if value is not None)
+        awake = "" if dgpu['status'] == 'suspended' else f", awake for {dgpu['awake_for'] / 60:.0f} min"
+        print(f"dGPU {dgpu['bdf']}: {dgpu['status']}{awake}" + (f"; time suspended {residency}" if residency else ""))
+    for holder in state.get('dgpu_holders') or []:
+        print(f"  using dGPU: {holder['name']} (pid {holder['pid']}): {', '.join(holder['devices'])}")
+    ready = [mode for mode, ok in state.get('fast_switch_ready', {}).items() if ok]
+    print(f"fast switching ready: {', '.join(ready) if ready else 'no'}")
+
+def wait_for_switch(poll=0.5):
+    """Follow a switch running in the service, printing each new phase"""
+    last_phase = None
+    while True:
+        state = control_request('status')['state']
+        if not state['switching']:
+            return state
+        if state['switch_phase'] != last_phase:
+            last_phase = state['switch_phase']
+            print(f"{last_phase or 'starting'}...", flush=True)
+        time.sleep(poll)
+
+def switch_in_process(mode):
+    """Run a switch from the CLI when no service is running"""
+    setup_file_logging()
+    if not single_instance():
+        print("GPUMode is running but its control socket is unavailable", file=sys.stderr)
+        return 1
+    service = GPUModeService(Settings(), MetricsStore(METRICS_FILE))
+    service.probe_now()
+    finished = threading.Event()
+    outcome = {}
+    
+    def on_event(event, data):
+        if event == 'switch-phase':
+            print(f"{data['label']}...", flush=True)
+        elif event == 'switch-finished':
+            outcome.update(data)
+            finished.set()
+    
+    service.add_listener(on_event)
+    ok, message = service.switch(mode)
+    if not ok:
+        print(f"Cannot switch: {message}", file=sys.stderr)
+        return 1
+    finished.wait()
+    return report_switch(outcome['mode'], outcome['result'], outcome['error'],
+                         outcome['pending_mode'] == mode)
+
+def report_switch(mode, result, error, reboot=True):
+    if result == 'success':
+        print(f"Switched to {mode} mode. Reboot for the change to take effect.")
+        return 0
+    if result == 'unchanged':
+        if reboot:
+            print(f"{mode} mode is already configured, nothing changed. Reboot for it to take effect.")
+        else:
+            print(f"Already in {mode} mode, nothing to change.")
+        return 0
+    if result == 'cancelled':
+        print("Switch cancelled. GPU mode unchanged.", file=sys.stderr)
+    else:
+        print(f"Switch failed: {error or 'command failed'}", file=sys.stderr)
+    return 1
+
+def preview_switch(mode):
+    """--switch MODE --dry-run: print what a switch would change, without running it"""
+    preflight = SwitchPreflight().check(mode)
+    if preflight['satisfied']:
+        print(f"The configuration already matches {mode} mode; a switch would change nothing.")
+        return 0
+    source = "its prepared fast-switching set" if preflight['source'] == 'staged' else "envycontrol's rules"
+    print(f"Switching to {mode} mode would (expected files from {source}):")
+    for change in preflight['changes']:
+        print(f"  {change['action']} {change['path']}")
+    for change in preflight['changes']:
+        if change['diff']:
+            print()
+            print("\n".join(change['diff']))
+    return 0
+
+def preview_apply_now():
+    """--apply-now --dry-run: print how the restart would go, without running it"""
+    probe = ModeProbe()
+    mode = pending_mode(probe.get_mode(), probe.configured_mode)
+    if mode is None:
+        print("No switch is waiting for a reboot.")
+        return 0
+    plan = FastReboot().plan(mode)
+    if plan['error']:
+        print(f"Would not restart: {plan['error']}")
+        return 1
+    if plan['reason']:
+        print(f"Would restart into {mode} mode with a normal reboot ({plan['reason']}):")
+    else:
+        print(f"Would restart into {mode} mode through kexec, skipping the firmware:")
+    for cmd in plan['commands']:
+        print(f"  {shlex.join(cmd)}")
+    return 0
+
+def report_apply_now(outcome):
+    if outcome['result'] == 'rebooting':
+        phases = ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in outcome['phases'].items())
+        print(f"Restarting through {outcome['method']} ({phases}).")
+        return 0
+    if outcome['result'] == 'cancelled':
+        print("Restart cancelled.", file=sys.stderr)
+    else:
+        print(f"Restart failed: {outcome['error'] or 'command failed'}", file=sys.stderr)
+    return 1
+
+def apply_now_in_process():
+    """Run Apply Now from the CLI when no service is running"""
+    setup_file_logging()
     if not single_instance():
+        print("GPUMode is running but its control socket is unavailable", file=sys.stderr)
+        return 1
+    service = GPUModeService(Settings(), MetricsStore(METRICS_FILE))
+    service.probe_now()
+    finished = threading.Event()
+    outcome = {}
+    
+    def on_event(event, data):
+        if event == 'switch-phase':
+            print(f"{data['label']}...", flush=True)
+        elif event == 'apply-now-finished':
+            outcome.update(data)
+            finished.set()
+    
+    service.add_listener(on_event)
+    ok, message = service.apply_now()
+    if not ok:
+        print(f"Cannot restart: {message}", file=sys.stderr)
+        return 1
+    finished.wait()
+    return report_apply_now(outcome)
+
+def apply_now_command(args):
+    """--apply-now: restart into the pending mode, through the running instance if there is one"""
+    if args.dry_run:
+        return preview_apply_now()
+    try:
+        reply = control_request('apply-now')
+    except ConnectionError:
+        return apply_now_in_process()
+    except ControlError as e:
+        print(f"GPUMode is running but did not answer: {e}", file=sys.stderr)
+        return 1
+    if not reply['ok']:
+        print(f"Cannot restart: {reply.get('message', reply.get('error'))}", file=sys.stderr)
+        return 1
+    print("Restarting (running instance)...", flush=True)
+    try:
+        state = wait_for_switch()
+    except (ConnectionError, ControlError) as e:
+        print(f"Lost contact with the running instance: {e}", file=sys.stderr)
+        return 1
+    if state.get('last_apply'):
+        return report_apply_now(state['last_apply'])
+    print("Restart did not go ahead; see the tray notification or the log", file=sys.stderr)
+    return 1
+
+def run_client_command(args):
+    """Handle --query/--status/--switch/--cancel/--refresh against the running service"""
+    if args.switch and args.dry_run:
+        return preview_switch(args.switch)
+    try:
+        if args.switch:
+            reply = control_request('switch', mode=args.switch)
+            if not reply['ok']:
+                print(f"Cannot switch: {reply.get('message', reply.get('error'))}", file=sys.stderr)
+                return 1
+            print(f"Switching to {args.switch} mode (running instance)...", flush=True)
+            state = wait_for_switch()
+            last = state.get('last_switch') or {}
+            if last.get('mode') == args.switch:
+                return report_switch(args.switch, last['result'], last['error'],
+                                     state['pending_mode'] == args.switch)
+            print("Switch did not complete; see the tray notification or the log", file=sys.stderr)
+            return 1
+        if args.cancel:
+            reply = control_request('cancel')
+            print(reply.get('message', reply.get('error')), file=sys.stdout if reply['ok'] else sys.stderr)
+            return 0 if reply['ok'] else 1
+        reply = control_request('refresh' if args.refresh else 'status')
+        state = reply['state']
+    except ControlError as e:
+        print(f"GPUMode is running but did not answer: {e}", file=sys.stderr)
+        return 1
+    except ConnectionError:
+        if args.switch:
+            return switch_in_process(args.switch)
+        if args.cancel:
+            print("No switch is running", file=sys.stderr)
+            return 1
+        # No service: probe directly (uncached) so scripts still get an answer
+        probe = ModeProbe()
+        state = {'mode': probe.get_mode(), 'configured_mode': probe.configured_mode,
+                 'mode_accurate': True, 'switching': False, 'on_battery': probe_on_battery(),
+                 'fast_switch_ready': {}, 'pid': None}
+    if args.query:
+        print(state['mode'])
+    else:
+        print_state(state, args.json)
+    return 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="GPU mode switching tray for Fedora")
+    parser.add_argument('--benchmark-startup', type=int, nargs='?', const=5, metavar='RUNS',
+                        help="measure time-to-icon and time-to-accurate-state over RUNS starts")
+    parser.add_argument('--startup-probe', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--stage-prepare', action='store_true',
+                        help="prebuild config sets and initramfs images for each mode (root)")
+    parser.add_argument('--stage-apply', choices=STAGED_MODES, metavar='MODE',
+                        help="switch to MODE using its prebuilt set (root)")
+    parser.add_argument('--force', action='store_true', help="with --stage-prepare, rebuild existing sets")
+    parser.add_argument('--reboot-into', choices=STAGED_MODES, metavar='MODE',
+                        help="restart into the configured MODE, through kexec where possible (root)")
+    parser.add_argument('--stats', action='store_true', help="print timing percentiles for probes and switches")
+    parser.add_argument('--power-stats', action='store_true',
+                        help="print measured battery discharge and runtime per GPU mode")
+    parser.add_argument('--days', type=float,
+                        help="with --stats or --power-stats, only include the last DAYS days")
+    parser.add_argument('--textfile', metavar='PATH',
+                        help="with --stats, also write a node_exporter textfile to PATH")
+    parser.add_argument('--daemon', action='store_true',
+                        help="run the GPU mode service without a tray icon")
+    parser.add_argument('--query', action='store_true', help="print the current GPU mode and exit")
+    parser.add_argument('--status', action='store_true', help="print mode, power and switch state")
+    parser.add_argument('--json', action='store_true', help="with --status or --events, print JSON")
+    parser.add_argument('--switch', choices=STAGED_MODES, metavar='MODE',
+                        help="switch to MODE through the running instance (or directly if none runs)")
+    parser.add_argument('--apply-now', action='store_true',
+                        help="restart now into the mode a switch configured, skipping the firmware where possible")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="with --switch, show the files and initramfs the switch would change; "
+                             "with --apply-now, show how the restart would go")
+    parser.add_argument('--cancel', action='store_true', help="cancel the running switch")
+    parser.add_argument('--refresh', action='store_true', help="re-probe the GPU mode, then print the status")
+    parser.add_argument('--simulate-policy', metavar='EVENTS',
+                        help="replay power events from EVENTS against the [policy] settings")
+    parser.add_argument('--events', action='store_true',
+                        help="print logged mode, power, switch and policy events")
+    parser.add_argument('--type', action='append', metavar='EVENT',
+                        help="with --events, only show this event type (repeatable)")
+    parser.add_argument('--since', metavar='TIME', help="with --events, e.g. 2h, 1d or 2024-05-01T12:00")
+    parser.add_argument('--until', metavar='TIME', help="with --events, end of the time range")
+    parser.add_argument('--gpu-holders', action='store_true',
+                        help="list processes keeping the NVIDIA GPU awake")
+    parser.add_argument('--run-dgpu', nargs=argparse.REMAINDER, metavar='APP',
+                        help="run an installed app (desktop ID or name) or a command on the NVIDIA GPU")
+    parser.add_argument('--list-apps', action='store_true',
+                        help="list the installed apps --run-dgpu and the tray menu offer")
+    parser.add_argument('--pin', metavar='APP', help="pin APP at the top of Run on Discrete GPU")
+    parser.add_argument('--unpin', metavar='APP', help="remove APP from the pinned apps")
+    args = parser.parse_args()
+    if args.benchmark_startup is not None and args.benchmark_startup < 1:
+        parser.error("--benchmark-startup needs at least 1 run")
+    
+    if os.environ.get('PKEXEC_UID') or os.geteuid() == 0:
+        # Only the staged-switch and restart operations are meant to run as root
+        other = [name for name, value in vars(args).items() if value not in (None, False) and name not in ROOT_OPTIONS]
+        if other or not (args.stage_prepare or args.stage_apply or args.reboot_into):
+            print("As root, gpumode only runs --stage-prepare, --stage-apply or --reboot-into", file=sys.stderr)
+            sys.exit(1)
+    
+    if args.gpu_holders:
+        sys.exit(show_gpu_holders())
+    
+    if args.run_dgpu is not None:
+        sys.exit(run_on_dgpu(args.run_dgpu))
+    
+    if args.list_apps:
+        sys.exit(list_apps())
+    
+    if args.pin or args.unpin:
+        sys.exit(pin_app(args.pin or args.unpin, pin=bool(args.pin)))
+    
+    if args.simulate_policy:
+        sys.exit(simulate_policy(args.simulate_policy))
+    
+    if args.events:
+        sys.exit(show_events(args))
+    
+    if args.apply_now:
+        sys.exit(apply_now_command(args))
+    
+    if args.query or args.status or args.json or args.switch or args.cancel or args.refresh:
+        sys.exit(run_client_command(args))
+    
+    if args.daemon:
+        sys.exit(run_daemon())
+    
+    if args.stats:
+        sys.exit(show_stats(args))
+    
+    if args.power_stats:
+        sys.exit(show_power_stats(args))
+    
+    if args.benchmark_startup is not None:
+        sys.exit(benchmark_startup(args.benchmark_startup))
+    
+    if args.stage_prepare or args.stage_apply:
+        sys.exit(run_stage_command(args))
+    
+    if args.reboot_into:
+        sys.exit(run_reboot_command(args.reboot_into))
+    
+    load_gi_modules('Gtk', 'GLib', 'AppIndicator3')
+    
+    if not args.startup_probe and not single_instance():
         dialog = Gtk.MessageDialog(
             message_type=Gtk.MessageType.WARNING,
             buttons=Gtk.ButtonsType.OK,
@@ -478,5 +3698,5 @@ if __name__ == "__main__":
         dialog.destroy()
         sys.exit(0)
     
-    GPUIndicator()
+    GPUIndicator(startup_probe=args.startup_probe)
     Gtk.main()
@@ -0,0 +1,123 @@
+"""Headless stand-ins for the gi.repository modules GPUMode uses
+
+Widgets, notifications and main loop sources only record the calls made on
+them, so menu and power-event benchmarks measure GPUMode's own work and
+report how many widget updates, notifications and timers it caused.
+"""
+import sys
+import types
+from collections import Counter
+
+calls = Counter()
+
+
+class Recorder:
+    """Accepts any method call and counts it as '<Class>.<method>'"""
+
+    def __init__(self, *args, **kwargs):
+        self.props = types.SimpleNamespace(**kwargs)
+        calls[f"{type(self).__name__}.new"] += 1
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        key = f"{type(self).__name__}.{name}"
+
+        def method(*args, **kwargs):
+            calls[key] += 1
+        return method
+
+    @classmethod
+    def new(cls, *args, **kwargs):
+        return cls(*args, **kwargs)
+
+
+class Menu(Recorder):
+    pass
+
+
+class MenuItem(Recorder):
+    pass
+
+
+class SeparatorMenuItem(Recorder):
+    pass
+
+
+class CheckMenuItem(Recorder):
+    def set_active(self, active):
+        calls['CheckMenuItem.set_active'] += 1
+        self.props.active = active
+
+    def get_active(self):
+        return getattr(self.props, 'active', False)
+
+
+class MessageDialog(Recorder):
+    def run(self):
+        calls['MessageDialog.run'] += 1
+        return 'CANCEL'
+
+
+class Indicator(Recorder):
+    pass
+
+
+class Notification(Recorder):
+    pass
+
+
+def _enum(*names):
+    return types.SimpleNamespace(**{name: name for name in names})
+
+
+def _counted(name, result=None):
+    def function(*args, **kwargs):
+        calls[name] += 1
+        return result() if callable(result) else result
+    return function
+
+
+_source_ids = iter(range(1, 1 << 31))
+
+
+def _module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    return module
+
+
+def install():
+    """Register the stand-ins as gi and gi.repository.* in sys.modules"""
+    gi = _module('gi', require_version=lambda name, version: None)
+    repository = _module('gi.repository')
+    modules = {
+        'Gtk': _module(
+            'gi.repository.Gtk', Menu=Menu, MenuItem=MenuItem, CheckMenuItem=CheckMenuItem,
+            SeparatorMenuItem=SeparatorMenuItem, MessageDialog=MessageDialog, main=_counted('Gtk.main'),
+            main_quit=_counted('Gtk.main_quit'), events_pending=lambda: False,
+            main_iteration=_counted('Gtk.main_iteration'),
+            MessageType=_enum('ERROR', 'WARNING', 'INFO', 'QUESTION'), ButtonsType=_enum('OK', 'OK_CANCEL'),
+            ResponseType=_enum('OK', 'CANCEL'),
+        ),
+        'AppIndicator3': _module(
+            'gi.repository.AppIndicator3', Indicator=Indicator,
+            IndicatorCategory=_enum('HARDWARE'), IndicatorStatus=_enum('ACTIVE'),
+        ),
+        'Notify': _module(
+            'gi.repository.Notify', Notification=Notification, init=_counted('Notify.init', True),
+            Urgency=_enum('LOW', 'NORMAL', 'CRITICAL'),
+        ),
+        'GLib': _module(
+            'gi.repository.GLib',
+            idle_add=_counted('GLib.idle_add', lambda: next(_source_ids)),
+            timeout_add=_counted('GLib.timeout_add', lambda: next(_source_ids)),
+            timeout_add_seconds=_counted('GLib.timeout_add_seconds', lambda: next(_source_ids)),
+            source_remove=_counted('GLib.source_remove', True),
+        ),
+    }
+    sys.modules['gi'] = gi
+    sys.modules['gi.repository'] = repository
+    for name, module in modules.items():
+        setattr(repository, name, module)
+        sys.modules[f'gi.repository.{name}'] = module
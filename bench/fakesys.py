@@ -0,0 +1,184 @@
+"""Fake sysfs and config tree for the offline benchmarks
+
+The layout mirrors what GPUMode and power-profile-manager read on a
+Framework Laptop 16 with the NVIDIA module: an AMD iGPU and an NVIDIA dGPU
+on PCI, a Mains adapter, USB-C/UCSI sources, a battery, and the CPU, GPU, SSD and
+ACPI temperature sensors. /boot, /proc/cmdline and the lockdown file let
+the Apply Now restart be planned and run against the stub kexec.
+"""
+import os
+from pathlib import Path
+
+IGPU_BDF = "0000:c1:00.0"
+DGPU_BDF = "0000:01:00.0"
+MODES = ("integrated", "hybrid", "nvidia")
+
+
+def _write(path, text):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(text if text.endswith("\n") else text + "\n")
+
+
+def _symlink(target, link):
+    link.parent.mkdir(parents=True, exist_ok=True)
+    if link.is_symlink():
+        link.unlink()
+    os.symlink(target, link)
+
+
+def _add_gpu(sys_root, bdf, vendor, pci_class, driver, boot_vga, cards):
+    device = sys_root / "devices/pci0000:00" / bdf
+    _write(device / "vendor", vendor)
+    _write(device / "class", pci_class)
+    _write(device / "boot_vga", "1" if boot_vga else "0")
+    _write(device / "power/control", "auto")
+    _write(device / "power/runtime_status", "suspended")
+    _write(device / "power/runtime_suspended_time", "0")
+    _write(device / "power/runtime_active_time", "0")
+    (sys_root / "bus/pci/drivers" / driver).mkdir(parents=True, exist_ok=True)
+    _symlink(f"../../../bus/pci/drivers/{driver}", device / "driver")
+    _symlink(f"../../../devices/pci0000:00/{bdf}", sys_root / "bus/pci/devices" / bdf)
+    for card in cards:
+        (device / "drm" / card).mkdir(parents=True, exist_ok=True)
+        if card.startswith("card"):
+            _symlink(f"../../devices/pci0000:00/{bdf}/drm/{card}", sys_root / "class/drm" / card)
+            _symlink(f"../../../{bdf}", device / "drm" / card / "device")
+
+
+def _write_supply(sys_root, name, props):
+    """power_supply entry with its uevent file and the per-attribute files"""
+    supply = sys_root / "class/power_supply" / name
+    lines = [f"POWER_SUPPLY_NAME={name}"]
+    for key, value in props.items():
+        lines.append(f"POWER_SUPPLY_{key.upper()}={value}")
+        _write(supply / key, str(value))
+    _write(supply / "uevent", "\n".join(lines))
+
+
+def set_supply_online(root, name, online):
+    """Plug or unplug one external power source"""
+    props = supply_props(root, name)
+    props['online'] = 1 if online else 0
+    _write_supply(Path(root) / "sys", name, props)
+    return {**{f"POWER_SUPPLY_{k.upper()}": str(v) for k, v in props.items()},
+            'POWER_SUPPLY_NAME': name, 'ACTION': 'change'}
+
+
+def supply_props(root, name):
+    supply = Path(root) / "sys/class/power_supply" / name
+    props = {}
+    for line in (supply / "uevent").read_text().splitlines():
+        key, _, value = line.partition('=')
+        if key != "POWER_SUPPLY_NAME":
+            props[key[len("POWER_SUPPLY_"):].lower()] = value
+    return props
+
+
+def set_battery(root, status="Discharging", capacity=80, power_uw=12_000_000):
+    _write_supply(Path(root) / "sys", "BAT1", {
+        'type': "Battery", 'status': status, 'capacity': capacity,
+        'power_now': power_uw, 'energy_full': 85_000_000,
+    })
+
+
+# hwmon name, label, limit attribute and value (millidegrees), as on the FW16
+HWMON_SENSORS = (
+    ("k10temp", "Tctl", None, None),
+    ("amdgpu", "edge", "crit", 100_000),
+    ("nvme", "Composite", "max", 81_850),
+)
+# thermal zone type and trip points
+THERMAL_ZONES = (
+    ("acpitz", (("passive", 90_000), ("critical", 110_000))),
+)
+
+
+def _add_thermal(sys_root, celsius):
+    for index, (name, label, limit, value) in enumerate(HWMON_SENSORS):
+        hwmon = sys_root / "class/hwmon" / f"hwmon{index}"
+        _write(hwmon / "name", name)
+        _write(hwmon / "temp1_label", label)
+        _write(hwmon / "temp1_input", str(int(celsius * 1000)))
+        if limit:
+            _write(hwmon / f"temp1_{limit}", str(value))
+    for index, (kind, trips) in enumerate(THERMAL_ZONES):
+        zone = sys_root / "class/thermal" / f"thermal_zone{index}"
+        _write(zone / "type", kind)
+        _write(zone / "temp", str(int(celsius * 1000)))
+        for trip, (trip_type, value) in enumerate(trips):
+            _write(zone / f"trip_point_{trip}_type", trip_type)
+            _write(zone / f"trip_point_{trip}_temp", str(value))
+
+
+def set_temperature(root, celsius, sensor=None):
+    """Set every temperature sensor, or only hwmon/zone `sensor` (e.g. "amdgpu")"""
+    sys_root = Path(root) / "sys"
+    for index, (name, *_) in enumerate(HWMON_SENSORS):
+        if sensor in (None, name):
+            _write(sys_root / "class/hwmon" / f"hwmon{index}/temp1_input", str(int(celsius * 1000)))
+    for index, (kind, _) in enumerate(THERMAL_ZONES):
+        if sensor in (None, kind):
+            _write(sys_root / "class/thermal" / f"thermal_zone{index}/temp", str(int(celsius * 1000)))
+
+
+def set_config_mode(root, mode):
+    """Write the envycontrol files for `mode` (the configured mode, not the live one)"""
+    root = Path(root)
+    for rel in ("etc/modprobe.d/blacklist-nvidia.conf", "lib/udev/rules.d/50-remove-nvidia.rules",
+                "etc/modprobe.d/nvidia.conf", "lib/udev/rules.d/80-nvidia-pm.rules",
+                "etc/X11/xorg.conf"):
+        (root / rel).unlink(missing_ok=True)
+    if mode == "integrated":
+        _write(root / "etc/modprobe.d/blacklist-nvidia.conf", "blacklist nvidia")
+        _write(root / "lib/udev/rules.d/50-remove-nvidia.rules", "# remove nvidia")
+    elif mode == "hybrid":
+        _write(root / "etc/modprobe.d/nvidia.conf", "options nvidia NVreg_DynamicPowerManagement=0x02")
+        _write(root / "lib/udev/rules.d/80-nvidia-pm.rules", "# nvidia pm")
+    else:
+        _write(root / "etc/X11/xorg.conf", "# nvidia")
+
+
+def set_lockdown(root, level="none"):
+    """Kernel lockdown level as /sys/kernel/security/lockdown shows it"""
+    levels = " ".join(f"[{name}]" if name == level else name for name in ("none", "integrity", "confidentiality"))
+    _write(Path(root) / "sys/kernel/security/lockdown", levels)
+
+
+def _add_boot(root):
+    kernel = os.uname().release
+    _write(root / f"boot/vmlinuz-{kernel}", "kernel")
+    _write(root / f"boot/initramfs-{kernel}.img", "initramfs")
+    _write(root / "proc/cmdline", f"BOOT_IMAGE=(hd0,gpt2)/vmlinuz-{kernel} root=UUID=0f6e rhgb quiet")
+    _write(root / "proc/sys/kernel/kexec_load_disabled", "0")
+    _write(root / "sys/kernel/kexec_loaded", "0")
+    set_lockdown(root)
+
+
+def build_tree(root, mode="hybrid", usb_sources=4, on_ac=True):
+    """Create the fake tree at root/{sys,etc,lib}; returns root as a Path
+
+    The first USB-C source is the charger when on_ac; the rest are empty ports.
+    """
+    if mode not in MODES:
+        raise ValueError(f"unknown mode {mode}")
+    root = Path(root)
+    sys_root = root / "sys"
+    _add_gpu(sys_root, IGPU_BDF, "0x1002", "0x030000", "amdgpu", mode != "nvidia",
+             ["card1", "renderD128"])
+    if mode != "integrated":
+        _add_gpu(sys_root, DGPU_BDF, "0x10de", "0x030000", "nvidia", mode == "nvidia",
+                 ["card0", "renderD129"])
+    _write_supply(sys_root, "ACAD", {'type': "Mains", 'online': 0})
+    for port in range(usb_sources):
+        _write_supply(sys_root, f"ucsi-source-psy-USBC000:00{port + 1}", {
+            'type': "USB", 'online': 1 if on_ac and port == 0 else 0,
+            'current_max': 5_000_000, 'voltage_max': 20_000_000,
+        })
+    set_battery(root, "Charging" if on_ac else "Discharging")
+    _add_thermal(sys_root, 45)
+    set_config_mode(root, mode)
+    # After the config, as a fresh initramfs would be
+    _add_boot(root)
+    _write(root / "etc/tuned/active_profile", "balanced")
+    (root / "calls.log").touch()
+    return root
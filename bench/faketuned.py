@@ -0,0 +1,115 @@
+"""Stand-in TuneD daemon on the session bus for the D-Bus benchmarks
+
+Exports the com.redhat.tuned methods power-profile-manager calls, with
+TuneD's own signatures (switch_profile replies with a single (bs) struct),
+and keeps the active profile in $BENCH_ROOT/etc/tuned/active_profile like
+the tuned-adm stub. Prints "ready" once it owns the bus name.
+
+`faketuned.py --measure N` is the client side: it switches profiles N times
+through power-profile-manager's TunedDBusBackend and prints the durations as
+JSON. It runs in its own process because the benchmarks replace gi with
+recorders.
+"""
+import json
+import os
+import sys
+import time
+import importlib.util
+from importlib.machinery import SourceFileLoader
+from pathlib import Path
+
+import gi
+gi.require_version('Gio', '2.0')
+from gi.repository import Gio, GLib
+
+BUS_NAME = "com.redhat.tuned"
+OBJECT_PATH = "/Tuned"
+INTROSPECTION = """
+<node>
+  <interface name="com.redhat.tuned.control">
+    <method name="is_running"><arg direction="out" type="b"/></method>
+    <method name="active_profile"><arg direction="out" type="s"/></method>
+    <method name="profiles"><arg direction="out" type="as"/></method>
+    <method name="switch_profile">
+      <arg direction="in" name="profile" type="s"/>
+      <arg direction="out" type="(bs)"/>
+    </method>
+  </interface>
+</node>
+"""
+PROFILES = ("balanced", "powersave", "throughput-performance",
+            "gpumode-battery-integrated", "gpumode-battery-hybrid")
+
+root = Path(os.environ['BENCH_ROOT'])
+active_file = root / "etc/tuned/active_profile"
+latency = float(os.environ.get('BENCH_LATENCY_TUNED_DBUS', os.environ.get('BENCH_LATENCY', 0)))
+
+
+def log_call(text):
+    with open(root / "calls.log", 'a') as f:
+        f.write(f"tuned-dbus {text}\n")
+
+
+def on_call(connection, sender, path, interface, method, params, invocation):
+    log_call(method)
+    time.sleep(latency)
+    if method == 'is_running':
+        invocation.return_value(GLib.Variant('(b)', (True,)))
+    elif method == 'active_profile':
+        try:
+            profile = active_file.read_text().strip()
+        except OSError:
+            profile = ""
+        invocation.return_value(GLib.Variant('(s)', (profile,)))
+    elif method == 'profiles':
+        invocation.return_value(GLib.Variant('(as)', (list(PROFILES),)))
+    elif method == 'switch_profile':
+        profile, = params.unpack()
+        if profile in PROFILES:
+            active_file.write_text(profile + "\n")
+            result = (True, "OK")
+        else:
+            result = (False, f"Requested profile '{profile}' doesn't exist.")
+        invocation.return_value(GLib.Variant('((bs))', (result,)))
+    else:
+        invocation.return_dbus_error("org.freedesktop.DBus.Error.UnknownMethod", method)
+
+
+def on_bus(connection, name):
+    node = Gio.DBusNodeInfo.new_for_xml(INTROSPECTION)
+    connection.register_object(OBJECT_PATH, node.interfaces[0], on_call, None, None)
+
+
+def measure(count):
+    """Alternate between two profiles through the D-Bus backend, checking each switch"""
+    loader = SourceFileLoader("power_profile_manager",
+                              str(Path(__file__).resolve().parent.parent / "power-profile-manager.py"))
+    ppm = importlib.util.module_from_spec(importlib.util.spec_from_loader(loader.name, loader))
+    loader.exec_module(ppm)
+    backend = ppm.TunedDBusBackend(bus="session")
+    if not backend.is_running():
+        raise RuntimeError("faketuned reports TuneD not running")
+    samples = []
+    for i in range(count):
+        profile = ("powersave", "balanced")[i % 2]
+        started = time.perf_counter()
+        ok, message = backend.switch_profile(profile)
+        samples.append(time.perf_counter() - started)
+        if not ok or backend.active_profile() != profile:
+            raise RuntimeError(f"D-Bus switch to {profile} failed: {message}")
+    print(json.dumps(samples))
+    return 0
+
+
+def main():
+    if sys.argv[1:2] == ['--measure']:
+        return measure(int(sys.argv[2]))
+    loop = GLib.MainLoop()
+    Gio.bus_own_name(Gio.BusType.SESSION, BUS_NAME, Gio.BusNameOwnerFlags.NONE, on_bus,
+                     lambda *_: print("ready", flush=True), lambda *_: loop.quit())
+    loop.run()
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,497 @@
+#!/usr/bin/env python3
+"""Offline benchmarks for GPUMode and power-profile-manager
+
+Everything runs against a fake sysfs/config tree (fakesys.py), stub system
+tools (stubs/) and recording stand-ins for the GTK libraries (fakegi.py),
+so runs are reproducible without the hardware, a desktop session or root.
+Results are saved as JSON under bench/results/ and can be compared.
+"""
+import argparse
+import fnmatch
+import importlib.util
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from importlib.machinery import PathFinder, SourceFileLoader
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+REPO_DIR = BENCH_DIR.parent
+STUB_DIR = BENCH_DIR / "stubs"
+RESULTS_DIR = BENCH_DIR / "results"
+# A median (or throughput) this many percent worse than the baseline is a regression
+DEFAULT_THRESHOLD = 20.0
+DEFAULT_ITERATIONS = 200
+DEFAULT_BURST = 200
+WARMUP = 5
+CHARGER = "ucsi-source-psy-USBC000:001"
+RESULT_TIMEOUT = 5.0
+
+sys.path.insert(0, str(BENCH_DIR))
+sys.path.insert(0, str(REPO_DIR))
+import fakegi
+import fakesys
+
+BENCHMARKS = {}
+
+
+def benchmark(name, description):
+    """Register a benchmark; it gets the Bench context and returns a result dict"""
+    def register(func):
+        BENCHMARKS[name] = (func, description)
+        return func
+    return register
+
+
+def latency(samples):
+    """Latency result (milliseconds) from a list of durations in seconds"""
+    from gpumode_common import percentile
+    values = sorted(s * 1000 for s in samples)
+    return {
+        'metric': 'median_ms', 'better': 'lower', 'n': len(values),
+        'median_ms': percentile(values, 50), 'p90_ms': percentile(values, 90),
+        'min_ms': values[0], 'max_ms': values[-1],
+    }
+
+
+def throughput(events, seconds, **counters):
+    return {
+        'metric': 'events_per_s', 'better': 'higher', 'events': events,
+        'seconds': seconds, 'events_per_s': events / seconds if seconds else None,
+        **counters,
+    }
+
+
+def load_module(name, path):
+    loader = SourceFileLoader(name, str(path))
+    spec = importlib.util.spec_from_loader(name, loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+
+class FakeUPowerClient:
+    """Just enough of UPowerGlib.Client for GPUIndicator.on_power_changed"""
+
+    def __init__(self, on_battery=False):
+        self.on_battery = on_battery
+
+    def get_on_battery(self):
+        return self.on_battery
+
+
+class Bench:
+    """Fake tree, stubbed environment and the two programs loaded against them"""
+
+    def __init__(self, root, args):
+        self.root = Path(root)
+        self.args = args
+        self.processes = []
+        self.bus_address = None
+        fakesys.build_tree(self.root, usb_sources=args.usb_sources)
+        os.environ.update({
+            'BENCH_ROOT': str(self.root),
+            'BENCH_LATENCY': str(args.latency),
+            'PATH': f"{STUB_DIR}{os.pathsep}{os.environ.get('PATH', '')}",
+            'HOME': str(self.root / "home"),
+            'XDG_RUNTIME_DIR': str(self.root / "run"),
+            'GPUMODE_SYSFS_ROOT': str(self.root / "sys"),
+            'GPUMODE_CONFIG_ROOT': str(self.root),
+            'GPUMODE_PROC_ROOT': str(self.root / "proc"),
+            'GPUMODE_STAGE_DIR': str(self.root / "stages"),
+            'PPM_SYSFS_ROOT': str(self.root / "sys"),
+            'PPM_CONFIG': str(self.root / "etc/power-profile-manager.conf"),
+            'PPM_TUNED_ACTIVE_PROFILE_FILE': str(self.root / "etc/tuned/active_profile"),
+            'PPM_GPU_STATE_GLOB': str(self.root / "run/gpumode/state.json"),
+            'PPM_PROC_ROOT': str(self.root / "proc"),
+            'PPM_TUNED_BUS': "session",
+        })
+        os.environ.pop('DBUS_SESSION_BUS_ADDRESS', None)
+        os.environ['GPUMODE_HELPER'] = str(self.install_helper())
+        fakegi.install()
+
+        self.gpumode = load_module("GPUMode", REPO_DIR / "GPUMode.py")
+        self.gpumode.load_gi_modules('Gtk', 'AppIndicator3', 'Notify', 'GLib')
+        self.indicator = self.gpumode.GPUIndicator()
+        self.service = self.indicator.service
+        self.service.mode_probe = self.gpumode.ModeProbe(metrics=self.service.metrics)
+        self.indicator.upower_client = FakeUPowerClient()
+        self.indicator.last_power_state = False
+        self.service.set_power_state(False)
+
+        self.ppm = load_module("power_profile_manager", REPO_DIR / "power-profile-manager.py")
+        log_dir = self.root / "log/power-profile-manager"
+        self.ppm.LOG_FILE = log_dir / "power-profile-manager.log"
+        self.ppm.EVENTS_FILE = log_dir / "events.jsonl"
+        self.ppm.METRICS_FILE = self.root / "lib/power-profile-manager/metrics.bin"
+        self.ppm.THERMAL_STATE_FILE = self.root / "lib/power-profile-manager/thermal.json"
+        self.manager = self.ppm.PowerProfileManager()
+        self.manager.set_profile_for_current_state()
+
+    def start_fake_tuned(self):
+        """Private session bus with faketuned.py on it; returns its address, or a reason it cannot run"""
+        if self.bus_address is not None:
+            return self.bus_address, None
+        if shutil.which('dbus-daemon') is None:
+            return None, "dbus-daemon not installed"
+        # gi itself is replaced by fakegi in this process
+        if PathFinder.find_spec('gi') is None:
+            return None, "PyGObject not installed"
+        daemon = subprocess.Popen(['dbus-daemon', '--session', '--nofork', '--print-address=1'],
+                                  stdout=subprocess.PIPE, text=True)
+        self.processes.append(daemon)
+        address = daemon.stdout.readline().strip()
+        env = dict(os.environ, DBUS_SESSION_BUS_ADDRESS=address)
+        service = subprocess.Popen([sys.executable, str(BENCH_DIR / "faketuned.py")],
+                                   stdout=subprocess.PIPE, text=True, env=env)
+        self.processes.append(service)
+        if service.stdout.readline().strip() != "ready":
+            return None, "faketuned.py did not start"
+        self.bus_address = address
+        return address, None
+
+    def close(self):
+        for proc in reversed(self.processes):
+            proc.terminate()
+            proc.wait()
+
+    def install_helper(self):
+        """The repo's pkexec helper, pointed at this checkout instead of /usr/bin/gpumode"""
+        gpumode = self.root / "bin/gpumode"
+        gpumode.parent.mkdir(parents=True, exist_ok=True)
+        gpumode.write_text(f'#!/bin/sh\nexec "{sys.executable}" "{REPO_DIR / "GPUMode.py"}" "$@"\n')
+        helper = self.root / "bin/gpumode-helper"
+        helper.write_text((REPO_DIR / "gpumode-helper").read_text().replace(
+            "GPUMODE=/usr/bin/gpumode", f"GPUMODE={gpumode}"))
+        for path in (gpumode, helper):
+            path.chmod(0o755)
+        return helper
+
+    def tool_calls(self, tool=None):
+        lines = (self.root / "calls.log").read_text().splitlines()
+        return sum(1 for line in lines if tool is None or line.split(' ', 1)[0] == tool)
+
+    def timed(self, func, iterations=None, before=None):
+        """Run func `iterations` times after a warmup; returns a latency result"""
+        iterations = iterations or self.args.iterations
+        samples = []
+        for i in range(WARMUP + iterations):
+            if before is not None:
+                before()
+            started = time.perf_counter()
+            func()
+            if i >= WARMUP:
+                samples.append(time.perf_counter() - started)
+        return latency(samples)
+
+
+@benchmark('get_current_mode', "GPUIndicator.get_current_mode with a cold mode cache")
+def bench_get_current_mode(b):
+    b.service.power_from_client = False
+    try:
+        return b.timed(b.indicator.get_current_mode, before=b.service.mode_probe.invalidate)
+    finally:
+        b.service.power_from_client = True
+
+
+@benchmark('get_current_mode_cached', "GPUIndicator.get_current_mode answered from the cache")
+def bench_get_current_mode_cached(b):
+    b.service.mode_probe.get_mode()
+    return b.timed(b.indicator.get_current_mode)
+
+
+@benchmark('refresh_mode', "GPUIndicator.refresh_mode until the background probe is applied")
+def bench_refresh_mode(b):
+    done = threading.Event()
+
+    def on_result(mode):
+        b.service._on_probed(mode)
+        done.set()
+
+    # No spacing between probes, so each iteration measures one full round trip
+    b.service.refresher = b.gpumode.ModeRefresher(b.service.probe_mode, on_result, min_interval=0)
+    returned = []
+
+    def refresh():
+        done.clear()
+        started = time.perf_counter()
+        b.indicator.refresh_mode()
+        returned.append(time.perf_counter() - started)
+        if not done.wait(RESULT_TIMEOUT):
+            raise RuntimeError("background mode refresh did not finish")
+
+    result = b.timed(refresh, before=b.service.mode_probe.invalidate)
+    result['call_median_ms'] = latency(returned[WARMUP:])['median_ms']
+    return result
+
+
+@benchmark('build_menu', "GPUIndicator.build_menu (menu construction and first update)")
+def bench_build_menu(b):
+    fakegi.calls.clear()
+    result = b.timed(b.indicator.build_menu)
+    runs = WARMUP + b.args.iterations
+    result['widget_calls_per_build'] = (sum(fakegi.calls.values())) / runs
+    return result
+
+
+@benchmark('update_menu', "GPUIndicator.update_menu on a GPU mode change")
+def bench_update_menu(b):
+    modes = iter(["integrated", "hybrid"] * (WARMUP + b.args.iterations))
+
+    def change_mode():
+        b.service.mode = next(modes)
+
+    before = dict(b.indicator.tray_menu.stats)
+    result = b.timed(b.indicator.update_menu, before=change_mode)
+    after = b.indicator.tray_menu.stats
+    updates = after['state_changes'] - before['state_changes']
+    result['widget_updates_per_change'] = (after['widget_updates'] - before['widget_updates']) / updates
+    result['dbus_updates_per_change'] = (after['dbus_updates'] - before['dbus_updates']) / updates
+    return result
+
+
+@benchmark('is_on_ac_power', "PowerProfileManager.is_on_ac_power from the supply index")
+def bench_is_on_ac_power(b):
+    return b.timed(b.manager.is_on_ac_power)
+
+
+@benchmark('power_supply_rescan', "PowerSupplyIndex full sysfs rescan")
+def bench_power_supply_rescan(b):
+    return b.timed(b.manager.power_supplies.rescan)
+
+
+@benchmark('probe_on_battery', "GPUMode's sysfs power source scan")
+def bench_probe_on_battery(b):
+    return b.timed(b.gpumode.probe_on_battery)
+
+
+@benchmark('on_power_changed_burst', "Burst of UPower on-battery flips through on_power_changed")
+def bench_on_power_changed_burst(b):
+    client = b.indicator.upower_client
+    b.indicator.power_prompts_enabled = True
+    fakegi.calls.clear()
+    started = time.perf_counter()
+    for _ in range(b.args.burst):
+        client.on_battery = not client.on_battery
+        b.indicator.on_power_changed(client, None)
+    elapsed = time.perf_counter() - started
+    if client.on_battery:
+        client.on_battery = False
+        b.indicator.on_power_changed(client, None)
+    return throughput(b.args.burst, elapsed,
+                      notifications=fakegi.calls['Notification.new'],
+                      timers=fakegi.calls['GLib.timeout_add'])
+
+
+def _ppm_burst(b, apply_each):
+    calls = b.tool_calls('tuned-adm')
+    online = True
+    started = time.perf_counter()
+    for _ in range(b.args.burst):
+        online = not online
+        b.manager.power_supplies.update(fakesys.set_supply_online(b.root, CHARGER, online))
+        if apply_each:
+            b.manager.apply_if_changed()
+    if not apply_each:
+        b.manager.apply_if_changed()
+    elapsed = time.perf_counter() - started
+    if not online:
+        b.manager.power_supplies.update(fakesys.set_supply_online(b.root, CHARGER, True))
+        b.manager.apply_if_changed()
+    return throughput(b.args.burst, elapsed, tuned_adm_calls=b.tool_calls('tuned-adm') - calls)
+
+
+@benchmark('ppm_uevent_burst', "Charger flap uevents, each evaluated by PowerProfileManager")
+def bench_ppm_uevent_burst(b):
+    return _ppm_burst(b, apply_each=True)
+
+
+@benchmark('ppm_uevent_burst_coalesced', "Charger flap uevents evaluated once, as the daemon debounces them")
+def bench_ppm_uevent_burst_coalesced(b):
+    return _ppm_burst(b, apply_each=False)
+
+
+@benchmark('thermal_sample', "ThermalSampler.sample over the fake hwmon and thermal zone sensors")
+def bench_thermal_sample(b):
+    sampler = b.manager.thermal
+    sampler.sample()
+    result = b.timed(sampler.sample)
+    result['sensors'] = len(sampler.channels)
+    return result
+
+
+@benchmark('apply_now_plan', "FastReboot.plan: preflight, lockdown and boot image checks before a restart")
+def bench_apply_now_plan(b):
+    reboot = b.gpumode.FastReboot()
+    return b.timed(lambda: reboot.plan('hybrid'))
+
+
+@benchmark('ppm_tuned_dbus_switch', "TunedDBusBackend profile switches against faketuned.py on a private bus")
+def bench_ppm_tuned_dbus_switch(b):
+    address, reason = b.start_fake_tuned()
+    if address is None:
+        return {'metric': 'median_ms', 'better': 'lower', 'median_ms': None, 'skipped': reason}
+    result = subprocess.run([sys.executable, str(BENCH_DIR / "faketuned.py"), '--measure',
+                             str(WARMUP + b.args.iterations)],
+                            capture_output=True, text=True, env=dict(os.environ, DBUS_SESSION_BUS_ADDRESS=address))
+    if result.returncode != 0:
+        raise RuntimeError(f"D-Bus profile switch failed:\n{result.stderr.strip()}")
+    samples = json.loads(result.stdout)
+    b.manager.set_profile_for_current_state()
+    return latency(samples[WARMUP:])
+
+
+def git_revision():
+    try:
+        result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                                capture_output=True, text=True, timeout=5)
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'],
+                               cwd=REPO_DIR, capture_output=True, text=True, timeout=5)
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    if result.returncode != 0:
+        return None
+    return result.stdout.strip() + ("-dirty" if dirty.stdout.strip() else "")
+
+
+def run(args, names):
+    with tempfile.TemporaryDirectory(prefix="gpumode-bench-") as root:
+        bench = Bench(root, args)
+        results = {}
+        try:
+            for name in names:
+                func, description = BENCHMARKS[name]
+                print(f"{name}: {description} ...", end=' ', flush=True)
+                results[name] = func(bench)
+                print(format_value(results[name]))
+        finally:
+            bench.close()
+    return {
+        'meta': {
+            'revision': git_revision(),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'latency': args.latency,
+            'iterations': args.iterations,
+            'burst': args.burst,
+            'usb_sources': args.usb_sources,
+        },
+        'results': results,
+    }
+
+
+def format_value(result, value=None):
+    if result.get('skipped'):
+        return f"skipped ({result['skipped']})"
+    value = result[result['metric']] if value is None else value
+    if value is None:
+        return "n/a"
+    if result['metric'] == 'median_ms':
+        return f"{value:.3f} ms"
+    return f"{value:.0f} events/s"
+
+
+def save(report, path=None):
+    if path is None:
+        RESULTS_DIR.mkdir(parents=True, exist_ok=True)
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        path = RESULTS_DIR / f"{stamp}-{report['meta']['revision'] or 'unknown'}.json"
+    Path(path).write_text(json.dumps(report, indent=2) + "\n")
+    return Path(path)
+
+
+def latest_result(exclude=None):
+    files = sorted(RESULTS_DIR.glob("*.json"), key=lambda p: p.stat().st_mtime)
+    files = [p for p in files if exclude is None or p.resolve() != Path(exclude).resolve()]
+    return files[-1] if files else None
+
+
+def compare(baseline, current, threshold):
+    """Print a comparison table; returns the names that regressed beyond threshold"""
+    regressions = []
+    for key in ('latency', 'iterations', 'burst', 'usb_sources'):
+        if baseline['meta'].get(key) != current['meta'].get(key):
+            print(f"note: {key} differs ({baseline['meta'].get(key)} -> {current['meta'].get(key)}), "
+                  "results are not directly comparable")
+    print(f"\n{'benchmark':<28} {'baseline':>16} {'current':>16} {'change':>8}")
+    for name, result in current['results'].items():
+        old = baseline['results'].get(name)
+        if old is None or old.get('metric') != result['metric']:
+            print(f"{name:<28} {'-':>16} {format_value(result):>16}")
+            continue
+        before, after = old[result['metric']], result[result['metric']]
+        if not before or after is None:
+            continue
+        change = (after - before) / before * 100
+        worse = change if result['better'] == 'lower' else -change
+        flag = ""
+        if worse > threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print(f"{name:<28} {format_value(old):>16} {format_value(result):>16} {change:>+7.1f}%{flag}")
+    print(f"\nbaseline {baseline['meta'].get('revision')} ({baseline['meta'].get('date')}), "
+          f"current {current['meta'].get('revision')} ({current['meta'].get('date')})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--only', action='append', metavar='PATTERN',
+                        help='Run only benchmarks matching PATTERN (glob, repeatable)')
+    parser.add_argument('--list', action='store_true', help='List the benchmarks and exit')
+    parser.add_argument('--iterations', type=int, default=DEFAULT_ITERATIONS,
+                        help=f'Samples per latency benchmark (default {DEFAULT_ITERATIONS})')
+    parser.add_argument('--burst', type=int, default=DEFAULT_BURST,
+                        help=f'Events per power event burst (default {DEFAULT_BURST})')
+    parser.add_argument('--latency', type=float, default=0.0, metavar='SECONDS',
+                        help='Delay added to every stub tool call (per tool: BENCH_LATENCY_<TOOL>)')
+    parser.add_argument('--usb-sources', type=int, default=4, metavar='N',
+                        help='USB-C power sources in the fake sysfs (default 4)')
+    parser.add_argument('--output', metavar='FILE', help='Save results to FILE instead of bench/results/')
+    parser.add_argument('--no-save', action='store_true', help='Do not save the results')
+    parser.add_argument('--compare', nargs='?', const='latest', metavar='BASELINE',
+                        help='Compare with a saved result (default: the most recent one)')
+    parser.add_argument('--diff', nargs=2, metavar=('BASELINE', 'CURRENT'),
+                        help='Compare two saved results without running anything')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD, metavar='PERCENT',
+                        help=f'Regression threshold for comparisons (default {DEFAULT_THRESHOLD:.0f}%%)')
+    args = parser.parse_args()
+
+    if args.list:
+        for name, (_, description) in BENCHMARKS.items():
+            print(f"{name:<28} {description}")
+        return 0
+    if args.diff:
+        baseline, current = (json.loads(Path(p).read_text()) for p in args.diff)
+        return 1 if compare(baseline, current, args.threshold) else 0
+
+    names = [n for n in BENCHMARKS
+             if not args.only or any(fnmatch.fnmatch(n, p) for p in args.only)]
+    if not names:
+        print("No benchmarks match", file=sys.stderr)
+        return 2
+    baseline_path = None
+    if args.compare:
+        baseline_path = latest_result() if args.compare == 'latest' else Path(args.compare)
+        if baseline_path is None or not baseline_path.exists():
+            print(f"No baseline result to compare with in {RESULTS_DIR}", file=sys.stderr)
+            return 2
+
+    report = run(args, names)
+    if not args.no_save:
+        print(f"Saved {save(report, args.output)}")
+    if baseline_path is not None:
+        baseline = json.loads(baseline_path.read_text())
+        return 1 if compare(baseline, report, args.threshold) else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
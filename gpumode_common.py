@@ -0,0 +1,595 @@
+"""Helpers shared by gpumode (tray) and power-profile-manager"""
+import os
+import sys
+import fcntl
+import json
+import time
+import mmap
+import queue
+import atexit
+import struct
+import logging
+import logging.handlers
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+PCI_VENDOR_NVIDIA = "0x10de"
+PCI_CLASS_DISPLAY = "0x03"
+
+# wall-clock time, operation name (utf-8, NUL padded), duration in seconds
+METRIC_RECORD = struct.Struct('<d24sf')
+METRICS_MAX_RECORDS = 20000
+METRICS_PERCENTILES = (50, 90, 99)
+# Rewrite the Prometheus textfile at most this often (seconds)
+METRICS_TEXTFILE_INTERVAL = 60
+
+
+def _read_sysfs(path):
+    try:
+        return path.read_text().strip()
+    except OSError:
+        return None
+
+
+def display_devices(sysfs_root="/sys"):
+    """List PCI display controllers with vendor, driver binding and boot_vga"""
+    sysfs_root = Path(sysfs_root)
+    devices = []
+    drm_cards = {}
+    drm_dir = sysfs_root / "class/drm"
+    if drm_dir.is_dir():
+        for card in drm_dir.glob("card[0-9]*"):
+            if "-" in card.name:
+                continue
+            try:
+                drm_cards[os.path.realpath(card / "device")] = card.name
+            except OSError:
+                pass
+    pci_dir = sysfs_root / "bus/pci/devices"
+    if not pci_dir.is_dir():
+        return devices
+    for dev in sorted(pci_dir.iterdir()):
+        pci_class = _read_sysfs(dev / "class")
+        if not pci_class or not pci_class.startswith(PCI_CLASS_DISPLAY):
+            continue
+        # Unbound (no link) and unbinding while we look (link just removed) both mean no driver
+        try:
+            driver = os.path.basename(os.readlink(dev / "driver"))
+        except OSError:
+            driver = None
+        devices.append({
+            "bdf": dev.name,
+            "vendor": _read_sysfs(dev / "vendor"),
+            "driver": driver,
+            "boot_vga": _read_sysfs(dev / "boot_vga") == "1",
+            "drm_card": drm_cards.get(os.path.realpath(dev)),
+        })
+    return devices
+
+
+def live_gpu_mode(devices, configured=None):
+    """GPU mode the running system is in, from display_devices(); None if inconclusive"""
+    if not devices:
+        return None
+    nvidia = [d for d in devices if d["vendor"] == PCI_VENDOR_NVIDIA]
+    others = [d for d in devices if d["vendor"] != PCI_VENDOR_NVIDIA]
+    nvidia_active = any(d["driver"] or d["drm_card"] for d in nvidia)
+    if not nvidia_active:
+        return "integrated"
+    if not others or any(d["boot_vga"] for d in nvidia) or configured == "nvidia":
+        return "nvidia"
+    return "hybrid"
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = max(1, -(-pct * len(sorted_values) // 100))
+    return sorted_values[int(rank) - 1]
+
+
+class MetricsStore:
+    """Compact append-only store of per-operation durations with a bounded size
+
+    Each sample is a fixed 36-byte record appended with O_APPEND, so several
+    processes can record into the same file. Once the file holds more than
+    max_records samples the oldest half is dropped. Appends hold a shared
+    flock on a .lock file next to the store and compaction an exclusive one,
+    so no append lands in a file that is being replaced.
+    """
+
+    def __init__(self, path, max_records=METRICS_MAX_RECORDS, textfile=None, prefix="gpumode"):
+        self.path = Path(path)
+        self.lock_path = self.path.with_suffix('.lock')
+        self.max_records = max_records
+        self.textfile = Path(textfile) if textfile else None
+        self.prefix = prefix
+        self.textfile_written = 0.0
+        self.failed = False
+
+    def record(self, op, seconds):
+        """Append one duration sample for `op`"""
+        data = METRIC_RECORD.pack(time.time(), op.encode()[:24], seconds)
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with self._locked(fcntl.LOCK_SH):
+                fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                try:
+                    os.write(fd, data)
+                    size = os.fstat(fd).st_size
+                finally:
+                    os.close(fd)
+            if size > self.max_records * METRIC_RECORD.size:
+                self.compact()
+        except OSError as e:
+            if not self.failed:
+                logging.warning(f"Cannot record metrics to {self.path}: {e}")
+                self.failed = True
+            return
+        if self.textfile and time.monotonic() - self.textfile_written >= METRICS_TEXTFILE_INTERVAL:
+            self.write_textfile()
+
+    @contextmanager
+    def timed(self, op):
+        """Record how long the with-block takes as a sample of `op`"""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(op, time.monotonic() - started)
+
+    def samples(self):
+        """Yield (timestamp, op, seconds) for every stored sample"""
+        try:
+            data = self.path.read_bytes()
+        except OSError:
+            return
+        usable = len(data) - len(data) % METRIC_RECORD.size
+        for ts, op, seconds in METRIC_RECORD.iter_unpack(data[:usable]):
+            yield ts, op.rstrip(b'\0').decode(errors='replace'), seconds
+
+    @contextmanager
+    def _locked(self, operation):
+        """Hold flock `operation` on the store's lock file"""
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o644)
+        try:
+            fcntl.flock(fd, operation)
+            yield
+        finally:
+            os.close(fd)
+
+    def compact(self):
+        """Keep only the newest half of max_records"""
+        with self._locked(fcntl.LOCK_EX):
+            data = self.path.read_bytes()
+            # Another process may have compacted while this one waited for the lock
+            if len(data) <= self.max_records * METRIC_RECORD.size:
+                return
+            keep = (self.max_records // 2) * METRIC_RECORD.size
+            data = data[:len(data) - len(data) % METRIC_RECORD.size]
+            tmp = self.path.with_suffix('.tmp')
+            tmp.write_bytes(data[-keep:])
+            tmp.replace(self.path)
+
+    def durations(self, since=None):
+        """{op: sorted durations} optionally limited to samples newer than `since`"""
+        ops = {}
+        for ts, op, seconds in self.samples():
+            if since is None or ts >= since:
+                ops.setdefault(op, []).append(seconds)
+        for values in ops.values():
+            values.sort()
+        return ops
+
+    def format_stats(self, since=None):
+        """Human-readable percentile table"""
+        ops = self.durations(since)
+        if not ops:
+            return f"No metrics recorded in {self.path}"
+        header = f"{'operation':<22}{'count':>7}" + "".join(f"{'p' + str(p):>10}" for p in METRICS_PERCENTILES) + f"{'max':>10}"
+        lines = [header]
+        for op in sorted(ops):
+            values = ops[op]
+            cells = "".join(f"{percentile(values, p) * 1000:>8.0f}ms" for p in METRICS_PERCENTILES)
+            lines.append(f"{op:<22}{len(values):>7}{cells}{values[-1] * 1000:>8.0f}ms")
+        return "\n".join(lines)
+
+    def write_textfile(self, path=None):
+        """Write a node_exporter textfile-collector summary of all operations"""
+        path = Path(path) if path else self.textfile
+        if path is None:
+            return
+        metric = f"{self.prefix}_operation_duration_seconds"
+        lines = [f"# HELP {metric} Duration of {self.prefix} operations.",
+                 f"# TYPE {metric} summary"]
+        for op, values in sorted(self.durations().items()):
+            for p in METRICS_PERCENTILES:
+                lines.append(f'{metric}{{operation="{op}",quantile="{p / 100}"}} {percentile(values, p):.6f}')
+            lines.append(f'{metric}_sum{{operation="{op}"}} {sum(values):.6f}')
+            lines.append(f'{metric}_count{{operation="{op}"}} {len(values)}')
+        try:
+            tmp = path.with_name(f".{path.name}.tmp")
+            tmp.write_text("\n".join(lines) + "\n")
+            tmp.replace(path)
+            self.textfile_written = time.monotonic()
+        except OSError as e:
+            logging.warning(f"Cannot write metrics textfile {path}: {e}")
+
+
+# Fixed-size, memory-mappable ring of battery discharge samples
+POWER_HISTORY_MAGIC = b"GPUMPWR1"
+# magic, capacity, index of the next slot to write, number of valid records
+POWER_HISTORY_HEADER = struct.Struct('<8sIII')
+# wall-clock time, watts, GPU mode code, TuneD profile (utf-8, NUL padded)
+POWER_HISTORY_RECORD = struct.Struct('<dfB3x24s')
+POWER_HISTORY_CAPACITY = 20160
+POWER_MODES = ("unknown", "integrated", "hybrid", "nvidia")
+
+
+class PowerHistory:
+    """Bounded on-disk history of battery power samples, accessed through mmap
+
+    The file is preallocated to hold `capacity` records after a small header,
+    so it never grows; once full, the oldest record is overwritten.
+    """
+
+    def __init__(self, path, capacity=POWER_HISTORY_CAPACITY):
+        self.path = Path(path)
+        self.capacity = capacity
+        self.map = None
+
+    def _size(self, capacity):
+        return POWER_HISTORY_HEADER.size + capacity * POWER_HISTORY_RECORD.size
+
+    def open(self, writable=True):
+        """Map the file, creating (or resetting a mismatching) file when writable"""
+        if self.map is not None:
+            return True
+        try:
+            if writable:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            else:
+                fd = os.open(self.path, os.O_RDONLY)
+        except OSError as e:
+            if writable:
+                logging.warning(f"Cannot open power history {self.path}: {e}")
+            return False
+        try:
+            header = os.pread(fd, POWER_HISTORY_HEADER.size, 0)
+            valid = len(header) == POWER_HISTORY_HEADER.size and header.startswith(POWER_HISTORY_MAGIC)
+            if valid:
+                self.capacity = POWER_HISTORY_HEADER.unpack(header)[1]
+                valid = os.fstat(fd).st_size == self._size(self.capacity)
+            if not valid:
+                if not writable:
+                    return False
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, self._size(self.capacity))
+                os.pwrite(fd, POWER_HISTORY_HEADER.pack(POWER_HISTORY_MAGIC, self.capacity, 0, 0), 0)
+            self.map = mmap.mmap(fd, self._size(self.capacity),
+                                 access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+            return True
+        finally:
+            os.close(fd)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+    def append(self, watts, mode, profile, timestamp=None):
+        if not self.open():
+            return
+        _, capacity, head, count = POWER_HISTORY_HEADER.unpack_from(self.map, 0)
+        code = POWER_MODES.index(mode) if mode in POWER_MODES else 0
+        POWER_HISTORY_RECORD.pack_into(self.map, POWER_HISTORY_HEADER.size + head * POWER_HISTORY_RECORD.size,
+                                       timestamp if timestamp is not None else time.time(), watts, code,
+                                       (profile or "").encode()[:24])
+        POWER_HISTORY_HEADER.pack_into(self.map, 0, POWER_HISTORY_MAGIC, capacity,
+                                       (head + 1) % capacity, min(count + 1, capacity))
+
+    def samples(self, since=None):
+        """Yield (timestamp, watts, mode, profile), oldest first"""
+        if not self.open(writable=False):
+            return
+        _, capacity, head, count = POWER_HISTORY_HEADER.unpack_from(self.map, 0)
+        first = (head - count) % capacity
+        for i in range(count):
+            offset = POWER_HISTORY_HEADER.size + ((first + i) % capacity) * POWER_HISTORY_RECORD.size
+            ts, watts, code, profile = POWER_HISTORY_RECORD.unpack_from(self.map, offset)
+            if since is not None and ts < since:
+                continue
+            mode = POWER_MODES[code] if code < len(POWER_MODES) else "unknown"
+            yield ts, watts, mode, profile.rstrip(b'\0').decode(errors='replace')
+
+    def stats(self, since=None, by_profile=False):
+        """{mode or (mode, profile): (samples, average watts)}"""
+        sums = {}
+        for _, watts, mode, profile in self.samples(since):
+            key = (mode, profile) if by_profile else mode
+            count, total = sums.get(key, (0, 0.0))
+            sums[key] = (count + 1, total + watts)
+        return {key: (count, total / count) for key, (count, total) in sums.items()}
+
+
+# Text log and structured event log rotation
+LOG_MAX_BYTES = 1024 * 1024
+LOG_BACKUPS = 3
+EVENT_MAX_BYTES = 512 * 1024
+EVENT_BACKUPS = 4
+# Events per index block; each block records its first timestamp, offset and event types
+EVENT_INDEX_STRIDE = 64
+EVENT_INDEX_RECORD = struct.Struct('<dQI')
+# Bit per event type in the index type mask; anything else shares the last bit
+EVENT_TYPES = (
+    "mode-changed", "power-changed", "switch-started", "switch-phase", "switch-finished",
+    "prepare-started", "prepare-finished", "staged-sets", "dgpu-status", "dgpu-awake",
+    "dgpu-holders", "policy-decision", "profile-changed", "power-source", "app-launched",
+    "thermal-throttle", "thermal-step-down", "apply-now-started", "apply-now-finished",
+)
+EVENT_TYPE_OTHER = 1 << 31
+TIME_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def event_type_bit(event):
+    return 1 << EVENT_TYPES.index(event) if event in EVENT_TYPES else EVENT_TYPE_OTHER
+
+
+class EventFileHandler(logging.handlers.RotatingFileHandler):
+    """Write records carrying an `event` attribute as JSON lines, with a block index
+
+    Next to each events file, `<file>.idx` holds one fixed-size entry per
+    EVENT_INDEX_STRIDE events: the block's first timestamp, its byte offset
+    and a bitmask of the event types in it. Index files rotate with their
+    events file.
+    """
+
+    def __init__(self, filename, maxBytes=EVENT_MAX_BYTES, backupCount=EVENT_BACKUPS):
+        super().__init__(filename, maxBytes=maxBytes, backupCount=backupCount)
+        self.addFilter(lambda record: hasattr(record, 'event'))
+        self._load_index()
+
+    def _index_path(self, path=None):
+        return f"{path or self.baseFilename}.idx"
+
+    def _load_index(self):
+        """Continue the index of an existing events file, rebuilding it if stale"""
+        entries = read_event_index(self.baseFilename)
+        if entries is None:
+            entries = build_event_index(self.baseFilename)
+            write_event_index(self.baseFilename, entries)
+        self.index_entries = len(entries)
+        self.block_events = count_block_events(self.baseFilename, entries)
+        self.block_start = entries[-1][:2] if entries else None
+        self.block_mask = entries[-1][2] if entries else 0
+
+    def format(self, record):
+        return json.dumps(dict(record.fields, ts=round(record.created, 3), event=record.event))
+
+    def emit(self, record):
+        try:
+            if self.shouldRollover(record):
+                self.doRollover()
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.flush()
+            offset = self.stream.tell()
+            if self.block_start is None or self.block_events >= EVENT_INDEX_STRIDE:
+                self.index_entries += 1
+                self.block_events = 0
+                self.block_mask = 0
+                self.block_start = (record.created, offset)
+            self.block_events += 1
+            self.block_mask |= event_type_bit(record.event)
+            self.stream.write(self.format(record) + self.terminator)
+            self.stream.flush()
+            self._write_index_entry()
+        except Exception:
+            self.handleError(record)
+
+    def _write_index_entry(self):
+        """Write (or update the type mask of) the current block's index entry"""
+        fd = os.open(self._index_path(), os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            os.pwrite(fd, EVENT_INDEX_RECORD.pack(*self.block_start, self.block_mask),
+                      (self.index_entries - 1) * EVENT_INDEX_RECORD.size)
+        finally:
+            os.close(fd)
+
+    def doRollover(self):
+        for i in range(self.backupCount - 1, 0, -1):
+            src = self._index_path(f"{self.baseFilename}.{i}")
+            if os.path.exists(src):
+                os.replace(src, self._index_path(f"{self.baseFilename}.{i + 1}"))
+        if os.path.exists(self._index_path()):
+            os.replace(self._index_path(), self._index_path(f"{self.baseFilename}.1"))
+        super().doRollover()
+        self.index_entries = 0
+        self.block_events = 0
+        self.block_mask = 0
+        self.block_start = None
+
+
+def read_event_index(path):
+    """[(first ts, offset, type mask)] of an events file, None if missing or stale"""
+    try:
+        data = Path(f"{path}.idx").read_bytes()
+        size = os.path.getsize(path)
+    except OSError:
+        return None if os.path.exists(path) else []
+    entries = list(EVENT_INDEX_RECORD.iter_unpack(data[:len(data) - len(data) % EVENT_INDEX_RECORD.size]))
+    if entries and entries[-1][1] >= size:
+        return None
+    return entries
+
+
+def build_event_index(path):
+    """Recreate the block index of an events file by reading it"""
+    entries = []
+    try:
+        f = open(path, 'rb')
+    except OSError:
+        return entries
+    with f:
+        offset = 0
+        count = 0
+        for line in f:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                offset += len(line)
+                continue
+            if count % EVENT_INDEX_STRIDE == 0:
+                entries.append([event.get('ts', 0.0), offset, 0])
+            entries[-1][2] |= event_type_bit(event.get('event'))
+            count += 1
+            offset += len(line)
+    return [tuple(e) for e in entries]
+
+
+def write_event_index(path, entries):
+    try:
+        with open(f"{path}.idx", 'wb') as f:
+            for entry in entries:
+                f.write(EVENT_INDEX_RECORD.pack(*entry))
+    except OSError as e:
+        logging.warning(f"Cannot write event index for {path}: {e}")
+
+
+def count_block_events(path, entries):
+    """Number of events in the last index block (to continue filling it)"""
+    if not entries:
+        return 0
+    try:
+        with open(path, 'rb') as f:
+            f.seek(entries[-1][1])
+            return sum(1 for _ in f)
+    except OSError:
+        return 0
+
+
+def query_events(path, types=None, since=None, until=None):
+    """Yield events (dicts) from an events file and its rotations, oldest first
+
+    Index blocks whose time range or type mask cannot match are skipped
+    without reading them.
+    """
+    path = Path(path)
+    wanted = 0
+    for event in types or ():
+        wanted |= event_type_bit(event)
+    files = [Path(f"{path}.{i}") for i in range(EVENT_BACKUPS, 0, -1)] + [path]
+    for file in files:
+        if not file.exists():
+            continue
+        entries = read_event_index(file)
+        if entries is None:
+            entries = build_event_index(file)
+        try:
+            f = open(file, 'rb')
+        except OSError:
+            continue
+        with f:
+            for i, (first_ts, offset, mask) in enumerate(entries):
+                next_entry = entries[i + 1] if i + 1 < len(entries) else None
+                if until is not None and first_ts > until:
+                    break
+                if since is not None and next_entry is not None and next_entry[0] < since:
+                    continue
+                if wanted and not mask & wanted:
+                    continue
+                f.seek(offset)
+                data = f.read(next_entry[1] - offset) if next_entry else f.read()
+                for line in data.splitlines():
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        continue
+                    ts = event.get('ts', 0.0)
+                    if since is not None and ts < since or until is not None and ts > until:
+                        continue
+                    if types and event.get('event') not in types:
+                        continue
+                    yield event
+
+
+def parse_time_spec(spec, now=None):
+    """Seconds since the epoch from "30m"/"2h"/"1d" (ago), an ISO date/time or a timestamp"""
+    now = time.time() if now is None else now
+    spec = spec.strip()
+    if spec[:-1].replace('.', '', 1).isdigit() and spec[-1] in TIME_UNITS:
+        return now - float(spec[:-1]) * TIME_UNITS[spec[-1]]
+    try:
+        return float(spec)
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(spec).timestamp()
+    except ValueError:
+        raise ValueError(f"invalid time {spec!r} (use e.g. 30m, 2h, 1d or 2024-05-01T12:00)")
+
+
+def format_event(event):
+    fields = " ".join(f"{k}={v}" for k, v in event.items() if k not in ('ts', 'event'))
+    when = datetime.fromtimestamp(event.get('ts', 0)).strftime('%Y-%m-%d %H:%M:%S')
+    return f"{when}  {event.get('event', '?'):<16} {fields}"
+
+
+def log_event(event, **fields):
+    """Record a structured event (events file only, through the logging queue)"""
+    logging.getLogger().info(event, extra={'event': event, 'fields': fields})
+
+
+class LogListener(logging.handlers.QueueListener):
+    """QueueListener whose stop() may be called more than once (explicitly and at exit)"""
+
+    def stop(self):
+        if self._thread is not None:
+            super().stop()
+
+
+def setup_logging(log_file, events_file, level=logging.INFO):
+    """Log through a queue to rotating text and JSON event files
+
+    Callers only put records on an in-memory queue; a listener thread does
+    the file writes, so logging never blocks a UI thread.
+    """
+    Path(log_file).parent.mkdir(parents=True, exist_ok=True)
+    text = logging.handlers.RotatingFileHandler(log_file, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS)
+    text.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    text.addFilter(lambda record: not hasattr(record, 'event'))
+    handlers = [text]
+    try:
+        handlers.append(EventFileHandler(events_file))
+    except OSError as e:
+        print(f"Event log unavailable: {e}", file=sys.stderr)
+    log_queue = queue.SimpleQueue()
+    listener = LogListener(log_queue, *handlers, respect_handler_level=True)
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(level)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+def print_events(path, types=None, since=None, until=None, as_json=False):
+    """CLI helper behind --events; returns an exit code"""
+    try:
+        since = parse_time_spec(since) if since else None
+        until = parse_time_spec(until) if until else None
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 2
+    found = False
+    for event in query_events(path, types, since, until):
+        found = True
+        print(json.dumps(event) if as_json else format_event(event))
+    if not found:
+        print(f"No matching events in {path}", file=sys.stderr)
+    return 0
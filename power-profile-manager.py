@@ -1,81 +1,943 @@
 #!/usr/bin/env python3
 import subprocess
 import logging
+import os
 import sys
+import time
+import select
+import socket
+import argparse
+import glob
+import json
+import configparser
 from pathlib import Path
 
+from gpumode_common import (
+    MetricsStore, log_event, print_events, setup_logging,
+    PCI_VENDOR_NVIDIA, display_devices, live_gpu_mode,
+)
+
 LOG_DIR = Path("/var/log/power-profile-manager")
 LOG_FILE = LOG_DIR / "power-profile-manager.log"
+EVENTS_FILE = LOG_DIR / "events.jsonl"
+METRICS_FILE = Path("/var/lib/power-profile-manager/metrics.bin")
+# node_exporter metric prefix, shared by the daemon and --stats --metrics-textfile
+METRICS_PREFIX = "power_profile_manager"
+THERMAL_STATE_FILE = Path("/var/lib/power-profile-manager/thermal.json")
 
-class PowerProfileManager:
-    def __init__(self):
-        LOG_DIR.mkdir(parents=True, exist_ok=True)
-        logging.basicConfig(
-            filename=LOG_FILE,
-            level=logging.INFO,
-            format='%(asctime)s - %(levelname)s - %(message)s'
+TUNED_BUS_NAME = "com.redhat.tuned"
+TUNED_OBJECT_PATH = "/Tuned"
+TUNED_INTERFACE = "com.redhat.tuned.control"
+# "system" in production; "session" to run against a stand-in TuneD on the session bus
+TUNED_BUS = os.environ.get("PPM_TUNED_BUS", "system")
+TUNED_SWITCH_TIMEOUT = 30
+# TuneD rewrites this on every profile switch, including ones made with tuned-adm
+TUNED_ACTIVE_PROFILE_FILE = Path(os.environ.get("PPM_TUNED_ACTIVE_PROFILE_FILE", "/etc/tuned/active_profile"))
+
+SYSFS_ROOT = os.environ.get("PPM_SYSFS_ROOT", "/sys")
+POWER_SUPPLY_ROOT = os.path.join(SYSFS_ROOT, "class/power_supply")
+# Supply types that can power the system (batteries are tracked separately)
+POWER_SOURCE_TYPES = ("Mains", "USB")
+# On AC, chargers rated below this are treated as low-power (e.g. USB-C phone chargers)
+LOW_POWER_CHARGER_WATTS = 60
+
+CONFIG_FILE = Path(os.environ.get("PPM_CONFIG", "/etc/power-profile-manager.conf"))
+# State files published by each user's gpumode tray/daemon
+GPU_STATE_GLOB = os.environ.get("PPM_GPU_STATE_GLOB", "/run/user/*/gpumode/state.json")
+LOW_BATTERY_PERCENT = 20
+# source.mode.band = profile; see ProfileMatrix
+PROFILE_MATRIX_DEFAULTS = {
+    'ac.*.*': 'throughput-performance',
+    'ac-low-power.*.*': 'balanced',
+    'battery.*.*': 'powersave',
+    'battery.integrated.normal': 'gpumode-battery-integrated',
+    'battery.hybrid.normal': 'gpumode-battery-hybrid',
+    'battery.*.low': 'powersave',
+}
+# Stock profile per source, used when no rule matches or a custom profile is missing
+PROFILE_FALLBACKS = {
+    'ac': 'throughput-performance',
+    'ac-low-power': 'balanced',
+    'battery': 'powersave',
+}
+# [thermal] settings; see ThermalSampler
+THERMAL_DEFAULTS = {
+    'enabled': 'yes',
+    # recommend = log a less aggressive profile; apply = also switch to it for a while
+    'action': 'recommend',
+    # Seconds between samples: cool and idle / warm or busy / near the throttle point
+    'idle_interval': '30',
+    'active_interval': '5',
+    'hot_interval': '1',
+    # Degrees C below a sensor's throttle point at which sampling speeds up
+    'near_margin': '10',
+    # Throttling episodes under one profile within repeat_window seconds before acting
+    'repeat_count': '3',
+    'repeat_window': '1800',
+}
+THERMAL_ACTIONS = ("recommend", "apply")
+# Next less aggressive profile; [thermal_step_down] in CONFIG_FILE adds or overrides
+THERMAL_STEP_DOWN = {
+    'throughput-performance': 'balanced',
+    'latency-performance': 'balanced',
+    'accelerator-performance': 'balanced',
+    'desktop': 'balanced',
+    'balanced': 'powersave',
+}
+# Throttle point of a sensor with no passive trip point or max/crit limit (degrees C)
+THERMAL_DEFAULT_LIMIT = 95.0
+# An episode ends once every sensor is this far below its throttle point
+THERMAL_HYSTERESIS = 3.0
+# Load average per CPU above which the machine counts as busy
+THERMAL_BUSY_LOAD = 0.5
+# Re-resolve sensor paths at most this often after one disappeared (e.g. dGPU unbound)
+THERMAL_RESOLVE_INTERVAL = 600
+THERMAL_EPISODES_MAX = 500
+PROC_ROOT = os.environ.get("PPM_PROC_ROOT", "/proc")
+TUNED_PROFILE_DIR = "/etc/tuned"
+TUNED_PROFILE_TEMPLATE = """\
+# Generated by power-profile-manager --write-profiles for this machine
+[main]
+summary={summary}
+include=powersave
+
+[sysfs]
+{sysfs}
+"""
+
+NETLINK_KOBJECT_UEVENT = 15
+UEVENT_GROUP_KERNEL = 1
+# Quiet period after the last power_supply uevent before re-evaluating
+UEVENT_DEBOUNCE = 2.0
+# Upper bound on how long a continuous burst can postpone a decision
+UEVENT_MAX_DELAY = 10.0
+
+
+class TunedDBusBackend:
+    """Drive TuneD through its com.redhat.tuned D-Bus API"""
+
+    name = "D-Bus"
+
+    def __init__(self, bus=TUNED_BUS):
+        import gi
+        gi.require_version('Gio', '2.0')
+        from gi.repository import Gio, GLib
+        self.Gio = Gio
+        self.GLib = GLib
+        bus_type = Gio.BusType.SESSION if bus == "session" else Gio.BusType.SYSTEM
+        self.proxy = Gio.DBusProxy.new_for_bus_sync(
+            bus_type,
+            Gio.DBusProxyFlags.DO_NOT_LOAD_PROPERTIES | Gio.DBusProxyFlags.DO_NOT_CONNECT_SIGNALS,
+            None, TUNED_BUS_NAME, TUNED_OBJECT_PATH, TUNED_INTERFACE, None
         )
+
+    def _call(self, method, args=None, timeout=2):
+        result = self.proxy.call_sync(method, args, self.Gio.DBusCallFlags.NONE,
+                                      int(timeout * 1000), None)
+        return result.unpack()
+
+    def is_running(self):
+        return bool(self._call('is_running')[0])
+
+    def active_profile(self):
+        return self._call('active_profile')[0]
+
+    def switch_profile(self, profile):
+        """Returns (success, message)"""
+        # The reply is a single (bs) struct: ((ok, message),)
+        (ok, message), = self._call('switch_profile', self.GLib.Variant('(s)', (profile,)),
+                                    timeout=TUNED_SWITCH_TIMEOUT)
+        return bool(ok), message
+
+
+class TunedAdmBackend:
+    """Fallback: drive TuneD through systemctl and tuned-adm"""
+
+    name = "tuned-adm"
+
+    def is_running(self):
+        result = subprocess.run(['systemctl', 'is-active', 'tuned'],
+                                capture_output=True, text=True, timeout=2)
+        return result.returncode == 0 and result.stdout.strip() == "active"
+
+    def active_profile(self):
+        result = subprocess.run(['tuned-adm', 'active'],
+                                capture_output=True, text=True, timeout=10)
+        for line in result.stdout.splitlines():
+            if line.startswith("Current active profile:"):
+                return line.split(":", 1)[1].strip()
+        return None
+
+    def switch_profile(self, profile):
+        """Returns (success, message)"""
+        result = subprocess.run(['tuned-adm', 'profile', profile],
+                                capture_output=True, text=True, timeout=TUNED_SWITCH_TIMEOUT)
+        return result.returncode == 0, result.stderr.strip()
+
+
+class PowerSupplyIndex:
+    """Index of external power sources, built once from each supply's uevent file
+
+    Entries are updated incrementally from power_supply uevents instead of
+    rescanning sysfs, and cover ACPI adapters (Mains) as well as USB-C/UCSI
+    sources (USB).
+    """
+
+    def __init__(self, root=POWER_SUPPLY_ROOT):
+        self.root = Path(root)
+        self.sources = {}
+        self.rescan()
+
+    @staticmethod
+    def parse_uevent(text):
+        props = {}
+        for line in text.splitlines():
+            key, sep, value = line.partition('=')
+            if sep:
+                props[key] = value
+        return props
+
+    def read_supply(self, name):
+        try:
+            return self.parse_uevent((self.root / name / "uevent").read_text())
+        except OSError:
+            return None
+
+    def rescan(self):
+        """Rebuild the whole index from sysfs"""
+        self.sources = {}
+        try:
+            names = [entry.name for entry in self.root.iterdir()]
+        except OSError as e:
+            logging.error(f"Error scanning power supplies: {e}")
+            return
+        for name in names:
+            props = self.read_supply(name)
+            if props:
+                props.setdefault('POWER_SUPPLY_NAME', name)
+                self.update(props)
+
+    @staticmethod
+    def rating_watts(props):
+        """Best available power rating of a source in watts, or None"""
+        def value(key):
+            try:
+                return int(props[key])
+            except (KeyError, ValueError):
+                return None
+        current = value('POWER_SUPPLY_CURRENT_MAX')
+        voltage = value('POWER_SUPPLY_VOLTAGE_MAX') or value('POWER_SUPPLY_VOLTAGE_NOW')
+        if current and voltage:
+            return current * voltage / 1e12
+        limit = value('POWER_SUPPLY_INPUT_POWER_LIMIT')
+        if limit:
+            return limit / 1e6
+        return None
+
+    def update(self, props):
+        """Apply one supply's properties (from its uevent file or a netlink uevent)"""
+        name = props.get('POWER_SUPPLY_NAME') or props.get('DEVPATH', '').rsplit('/', 1)[-1]
+        if not name:
+            return
+        if props.get('ACTION') == 'remove':
+            self.sources.pop(name, None)
+            return
+        supply_type = props.get('POWER_SUPPLY_TYPE')
+        if supply_type is None and name not in self.sources:
+            props = self.read_supply(name) or {}
+            supply_type = props.get('POWER_SUPPLY_TYPE')
+        if supply_type is not None and supply_type not in POWER_SOURCE_TYPES:
+            return
+        entry = self.sources.setdefault(name, {'name': name, 'type': supply_type,
+                                               'online': False, 'watts': None})
+        if supply_type is not None:
+            entry['type'] = supply_type
+        if 'POWER_SUPPLY_ONLINE' in props:
+            entry['online'] = props['POWER_SUPPLY_ONLINE'] == '1'
+        watts = self.rating_watts(props)
+        if watts is not None:
+            entry['watts'] = watts
+
+    def online_sources(self):
+        return [s for s in self.sources.values() if s['online']]
+
+    def active_source(self):
+        """The online source supplying power (highest rated first), or None"""
+        online = self.online_sources()
+        if not online:
+            return None
+        return max(online, key=lambda s: (s['watts'] is not None, s['watts'] or 0))
+
+
+class UeventMonitor:
+    """Listen for kernel uevents over netlink, filtered to one subsystem"""
+
+    def __init__(self, subsystem="power_supply"):
+        self.subsystem = subsystem
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM | socket.SOCK_CLOEXEC,
+                                  NETLINK_KOBJECT_UEVENT)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        self.sock.bind((0, UEVENT_GROUP_KERNEL))
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    @staticmethod
+    def parse(data):
+        """Parse a kernel uevent datagram into a dict (ACTION, DEVPATH, SUBSYSTEM, ...)"""
+        fields = data.split(b'\0')
+        event = {}
+        for field in fields[1:]:
+            key, sep, value = field.partition(b'=')
+            if sep:
+                event[key.decode(errors='replace')] = value.decode(errors='replace')
+        return event
+
+    def receive(self):
+        """Read one uevent; returns None if it is for another subsystem"""
+        event = self.parse(self.sock.recv(65536))
+        if event.get('SUBSYSTEM') != self.subsystem:
+            return None
+        return event
+
+    def close(self):
+        self.sock.close()
+
+
+class ProfileMatrix:
+    """(power source, GPU mode, battery band) -> TuneD profile
+
+    Rules are `source.mode.band = profile` keys in the [profiles] section of
+    CONFIG_FILE, on top of PROFILE_MATRIX_DEFAULTS; `*` matches anything.
+    Sources are ac, ac-low-power and battery; bands are normal and low.
+    """
+
+    def __init__(self, path=CONFIG_FILE):
+        parser = configparser.ConfigParser()
+        parser.read_dict({'profiles': PROFILE_MATRIX_DEFAULTS,
+                          'bands': {'low_percent': str(LOW_BATTERY_PERCENT)}})
+        try:
+            parser.read(path)
+        except configparser.Error as e:
+            logging.error(f"Ignoring malformed {path}: {e}")
+        self.rules = dict(parser['profiles'])
+        try:
+            self.low_percent = parser.getfloat('bands', 'low_percent')
+        except ValueError:
+            self.low_percent = LOW_BATTERY_PERCENT
+
+    def band(self, capacity):
+        return "low" if capacity is not None and capacity <= self.low_percent else "normal"
+
+    def lookup(self, source, mode, band):
+        """Most specific matching (profile, rule); a battery band beats a mode wildcard"""
+        for key in (f"{source}.{mode}.{band}", f"{source}.*.{band}",
+                    f"{source}.{mode}.*", f"{source}.*.*"):
+            if key in self.rules:
+                return self.rules[key], key
+        return PROFILE_FALLBACKS[source], None
+
+
+def read_gpu_mode():
+    """GPU mode from the newest live gpumode state file, else from sysfs"""
+    newest = None
+    for path in glob.glob(GPU_STATE_GLOB):
+        try:
+            state = json.loads(Path(path).read_text())
+        except (OSError, ValueError):
+            continue
+        # Ignore state left behind by a gpumode that is no longer running
+        if not state.get('pid') or not os.path.exists(f"/proc/{state['pid']}"):
+            continue
+        if newest is None or state.get('updated', 0) > newest.get('updated', 0):
+            newest = state
+    if newest and newest.get('mode') not in (None, 'unknown'):
+        return newest['mode']
+    return live_gpu_mode(display_devices(SYSFS_ROOT)) or "unknown"
+
+
+def read_battery_capacity(root=POWER_SUPPLY_ROOT):
+    """Charge level of the first battery in percent, or None"""
+    for battery in sorted(Path(root).glob("BAT*")):
+        try:
+            return int((battery / "capacity").read_text())
+        except (OSError, ValueError):
+            continue
+    return None
+
+
+def _read_number(path):
+    try:
+        return int(Path(path).read_text())
+    except (OSError, ValueError):
+        return None
+
+
+class ThermalSampler:
+    """Sample hwmon and thermal zone temperatures at an adaptive rate, record throttling
+
+    Sensor paths and their throttle points (passive trip point, hwmon max, or
+    crit minus a margin) are resolved once; each sample then only reads the
+    resolved files. Sampling is slow while the machine is cool and idle and
+    speeds up as any sensor nears its throttle point. A throttling episode
+    (a sensor at its throttle point, or an Intel thermal_throttle counter
+    rising) is recorded with the GPU mode and TuneD profile it happened
+    under. When episodes repeat under one profile, the next less aggressive
+    profile is recommended, or with action = apply used in its place until
+    repeat_window passes without throttling.
+    """
+
+    def __init__(self, sysfs_root=SYSFS_ROOT, config_path=CONFIG_FILE, state_file=THERMAL_STATE_FILE,
+                 clock=time.monotonic, context=None):
+        self.sysfs_root = Path(sysfs_root)
+        self.state_file = Path(state_file)
+        self.clock = clock
+        # Returns (gpu_mode, tuned_profile) when an episode starts
+        self.context = context or (lambda: ("unknown", None))
+        parser = configparser.ConfigParser()
+        parser.read_dict({'thermal': THERMAL_DEFAULTS, 'thermal_step_down': THERMAL_STEP_DOWN})
+        try:
+            parser.read(config_path)
+        except configparser.Error as e:
+            logging.error(f"Ignoring malformed {config_path}: {e}")
+        config = parser['thermal']
+        try:
+            self.enabled = config.getboolean('enabled')
+        except ValueError:
+            self.enabled = True
+        self.action = config.get('action')
+        if self.action not in THERMAL_ACTIONS:
+            logging.error(f"Unknown thermal action {self.action!r}, using 'recommend'")
+            self.action = 'recommend'
+        def number(key):
+            try:
+                return config.getfloat(key)
+            except ValueError:
+                return float(THERMAL_DEFAULTS[key])
+        self.intervals = {name: number(f'{name}_interval') for name in ('idle', 'active', 'hot')}
+        self.near_margin = number('near_margin')
+        self.repeat_count = int(number('repeat_count'))
+        self.repeat_window = number('repeat_window')
+        self.step_down = dict(parser['thermal_step_down'])
+        self.channels = []
+        self.counters = []
+        self.counter_totals = None
+        self.resolved_at = None
+        self.episode = None
+        self.episodes = self.load()
+        # profile -> (less aggressive profile, monotonic expiry) while action = apply
+        self.demoted = {}
+        self.recommended = {}
+        self.last = {}
+
+    def resolve(self):
+        """Find the temperature sensors and throttle counters (once, not per sample)"""
+        channels = []
+        for hwmon in sorted(self.sysfs_root.glob("class/hwmon/hwmon*")):
+            try:
+                name = (hwmon / "name").read_text().strip()
+            except OSError:
+                continue
+            for temp in sorted(hwmon.glob("temp*_input")):
+                prefix = temp.name[:-len("_input")]
+                try:
+                    label = (hwmon / f"{prefix}_label").read_text().strip()
+                except OSError:
+                    label = prefix
+                limit = _read_number(hwmon / f"{prefix}_max")
+                if limit:
+                    limit /= 1000
+                else:
+                    crit = _read_number(hwmon / f"{prefix}_crit")
+                    limit = crit / 1000 - 5 if crit else THERMAL_DEFAULT_LIMIT
+                channels.append({'name': f"{name}/{label}", 'path': temp, 'limit': limit})
+        for zone in sorted(self.sysfs_root.glob("class/thermal/thermal_zone*")):
+            trips = {}
+            for trip_type in zone.glob("trip_point_*_type"):
+                try:
+                    kind = trip_type.read_text().strip()
+                except OSError:
+                    continue
+                value = _read_number(zone / trip_type.name.replace("_type", "_temp"))
+                if value and value > 0:
+                    trips[kind] = min(value / 1000, trips.get(kind, value / 1000))
+            if 'passive' in trips:
+                limit = trips['passive']
+            elif 'hot' in trips:
+                limit = trips['hot']
+            elif 'critical' in trips:
+                limit = trips['critical'] - 5
+            else:
+                limit = THERMAL_DEFAULT_LIMIT
+            try:
+                kind = (zone / "type").read_text().strip()
+            except OSError:
+                kind = zone.name
+            channels.append({'name': f"{zone.name}/{kind}", 'path': zone / "temp", 'limit': limit})
+        # One package counter per physical package (Intel; other CPUs have none)
+        counters = {}
+        for cpu in sorted(self.sysfs_root.glob("devices/system/cpu/cpu[0-9]*")):
+            counter = cpu / "thermal_throttle/package_throttle_count"
+            package = _read_number(cpu / "topology/physical_package_id")
+            if counter.exists() and package not in counters:
+                counters[package] = counter
+        self.channels = channels
+        self.counters = list(counters.values())
+        self.counter_totals = None
+        self.resolved_at = self.clock()
+        logging.info(f"Thermal: {len(channels)} sensors, {len(self.counters)} throttle counters")
+        return channels
+
+    def read(self):
+        """{sensor: degrees C} from the resolved paths; drops sensors that went away"""
+        readings = {}
+        gone = []
+        for channel in self.channels:
+            value = _read_number(channel['path'])
+            if value is None:
+                gone.append(channel)
+                continue
+            readings[channel['name']] = value / 1000
+        for channel in gone:
+            logging.info(f"Thermal sensor {channel['name']} disappeared")
+            self.channels.remove(channel)
+        return readings
+
+    def _counters_rose(self):
+        if not self.counters:
+            return False
+        totals = sum(_read_number(path) or 0 for path in self.counters)
+        rose = self.counter_totals is not None and totals > self.counter_totals
+        self.counter_totals = totals
+        return rose
+
+    def _busy(self):
+        try:
+            load = float(Path(PROC_ROOT, "loadavg").read_text().split()[0])
+        except (OSError, ValueError, IndexError):
+            return False
+        return load / (os.cpu_count() or 1) >= THERMAL_BUSY_LOAD
+
+    def sample(self):
+        """Take one sample; returns (seconds until the next one, True if the profile choice changed)"""
+        now = self.clock()
+        if self.resolved_at is None or (not self.channels and now - self.resolved_at >= THERMAL_RESOLVE_INTERVAL):
+            self.resolve()
+        readings = self.read()
+        limits = {c['name']: c['limit'] for c in self.channels}
+        self.last = readings
+        headroom = {name: limits[name] - temp for name, temp in readings.items()}
+        hottest = min(headroom, key=headroom.get) if headroom else None
+        throttling = self._counters_rose() or any(h <= 0 for h in headroom.values())
+        if self.episode is not None and not throttling:
+            # Stay in the episode until every sensor has cooled off a little
+            throttling = any(h < THERMAL_HYSTERESIS for h in headroom.values())
+        changed = self._expire(now)
+        if throttling:
+            self._throttling(now, hottest, readings.get(hottest))
+        elif self.episode is not None:
+            changed = self._end_episode(now) or changed
+
+        if throttling or (hottest is not None and headroom[hottest] <= self.near_margin):
+            interval = self.intervals['hot']
+        elif (hottest is not None and headroom[hottest] <= 2 * self.near_margin) or self._busy():
+            interval = self.intervals['active']
+        else:
+            interval = self.intervals['idle']
+        return interval, changed
+
+    def _throttling(self, now, sensor, temp):
+        if self.episode is None:
+            gpu_mode, profile = self.context()
+            self.episode = {'start': time.time(), 'started': now, 'sensor': sensor, 'peak': temp,
+                            'gpu_mode': gpu_mode, 'profile': profile}
+            logging.warning(f"Thermal throttling: {sensor} at {temp}°C "
+                            f"(GPU mode {gpu_mode}, profile {profile})")
+        elif temp is not None and (self.episode['peak'] is None or temp > self.episode['peak']):
+            self.episode.update(peak=temp, sensor=sensor)
+
+    def _end_episode(self, now):
+        episode = self.episode
+        self.episode = None
+        record = {key: episode[key] for key in ('start', 'sensor', 'peak', 'gpu_mode', 'profile')}
+        record['seconds'] = round(now - episode['started'], 1)
+        logging.info(f"Thermal throttling ended after {record['seconds']:.0f}s (peak {record['peak']}°C)")
+        log_event('thermal-throttle', **record)
+        self.episodes.append(record)
+        del self.episodes[:-THERMAL_EPISODES_MAX]
+        self.save()
+        return self._check_repeats(now, record['profile'])
+
+    def _check_repeats(self, now, profile):
+        """Recommend or apply a step down once episodes repeat under `profile`"""
+        lower = self.step_down.get(profile)
+        if not profile or not lower:
+            return False
+        since = time.time() - self.repeat_window
+        repeats = sum(1 for e in self.episodes if e['profile'] == profile and e['start'] >= since)
+        if repeats < self.repeat_count:
+            return False
+        if self.action == 'apply':
+            new = profile not in self.demoted
+            self.demoted[profile] = (lower, now + self.repeat_window)
+            if new:
+                logging.warning(f"Throttled {repeats} times under {profile}, using {lower} instead")
+                log_event('thermal-step-down', profile=profile, suggested=lower, episodes=repeats, applied=True)
+            return new
+        if now - self.recommended.get(profile, -self.repeat_window) >= self.repeat_window:
+            self.recommended[profile] = now
+            logging.warning(f"Throttled {repeats} times under {profile}; consider {lower} "
+                            f"(set action = apply in [thermal] to switch automatically)")
+            log_event('thermal-step-down', profile=profile, suggested=lower, episodes=repeats, applied=False)
+        return False
+
+    def _expire(self, now):
+        # Step-downs end only after repeat_window without throttling
+        if self.episode is not None:
+            for profile, (lower, _) in list(self.demoted.items()):
+                self.demoted[profile] = (lower, now + self.repeat_window)
+            return False
+        expired = [p for p, (_, until) in self.demoted.items() if now >= until]
+        for profile in expired:
+            logging.info(f"No throttling for {self.repeat_window:.0f}s, restoring {profile}")
+            del self.demoted[profile]
+        return bool(expired)
+
+    def adjust(self, profile):
+        """The profile to use instead of `profile` while it is stepped down"""
+        seen = set()
+        while profile in self.demoted and profile not in seen:
+            seen.add(profile)
+            profile = self.demoted[profile][0]
+        return profile
+
+    def load(self):
+        try:
+            return json.loads(self.state_file.read_text()).get('episodes', [])
+        except (OSError, ValueError, AttributeError):
+            return []
+
+    def save(self):
+        try:
+            self.state_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.state_file.with_suffix('.tmp')
+            tmp.write_text(json.dumps({'episodes': self.episodes}))
+            tmp.replace(self.state_file)
+        except OSError as e:
+            logging.error(f"Failed to save thermal history: {e}")
+
+    def stats(self):
+        """{(gpu_mode, profile): {'episodes', 'seconds', 'peak'}} over the recorded history"""
+        stats = {}
+        for e in self.episodes:
+            entry = stats.setdefault((e['gpu_mode'], e['profile']), {'episodes': 0, 'seconds': 0.0, 'peak': None})
+            entry['episodes'] += 1
+            entry['seconds'] += e['seconds']
+            if e['peak'] is not None and (entry['peak'] is None or e['peak'] > entry['peak']):
+                entry['peak'] = e['peak']
+        return stats
+
+
+def print_thermal(sampler):
+    """Print the resolved sensors with current readings, and throttling history"""
+    sampler.resolve()
+    readings = sampler.read()
+    print(f"Thermal sampling: {'enabled' if sampler.enabled else 'disabled'}, action {sampler.action}")
+    for channel in sampler.channels:
+        temp = readings.get(channel['name'])
+        current = f"{temp:5.1f}°C" if temp is not None else "   n/a"
+        print(f"  {channel['name']:<32} {current}  (throttles at {channel['limit']:.0f}°C)")
+    if sampler.counters:
+        print(f"  {len(sampler.counters)} package throttle counter(s)")
+    stats = sampler.stats()
+    if not stats:
+        print("No throttling recorded")
+        return 0
+    print("Throttling by GPU mode and TuneD profile:")
+    for (gpu_mode, profile), entry in sorted(stats.items(), key=lambda item: -item[1]['episodes']):
+        peak = f", peak {entry['peak']:.0f}°C" if entry['peak'] is not None else ""
+        lower = sampler.step_down.get(profile)
+        hint = f"  -> consider {lower}" if lower and entry['episodes'] >= sampler.repeat_count else ""
+        print(f"  {gpu_mode:<11} {profile or 'unknown':<28} {entry['episodes']:4d} episodes, "
+              f"{entry['seconds']:.0f}s{peak}{hint}")
+    return 0
+
+
+def generate_tuned_profiles(sysfs_root=SYSFS_ROOT):
+    """Custom TuneD profiles for the battery combinations, for this machine's dGPU"""
+    aspm = ["/sys/module/pcie_aspm/parameters/policy=powersupersave"]
+    dgpu_lines = []
+    nvidia = [d for d in display_devices(sysfs_root) if d['vendor'] == PCI_VENDOR_NVIDIA]
+    for device in nvidia:
+        dev = Path(os.path.realpath(Path(sysfs_root, "bus/pci/devices", device['bdf'])))
+        # The dGPU and the PCIe port above it both have to allow runtime suspend
+        for node in (dev, dev.parent):
+            if (node / "power/control").exists():
+                dgpu_lines.append(f"/sys/bus/pci/devices/{node.name}/power/control=auto")
+        if (dev / "link/l1_aspm").exists():
+            dgpu_lines.append(f"/sys/bus/pci/devices/{dev.name}/link/l1_aspm=1")
+    return {
+        "gpumode-battery-integrated": TUNED_PROFILE_TEMPLATE.format(
+            summary="GPUMode: battery, integrated GPU only",
+            sysfs="\n".join(aspm)),
+        "gpumode-battery-hybrid": TUNED_PROFILE_TEMPLATE.format(
+            summary="GPUMode: battery, hybrid mode with the NVIDIA GPU runtime-suspended",
+            sysfs="\n".join(aspm + dgpu_lines)),
+    }
+
+
+def write_tuned_profiles(target_dir):
+    """Write the generated profiles to target_dir/<name>/tuned.conf"""
+    for name, text in generate_tuned_profiles().items():
+        path = Path(target_dir) / name / "tuned.conf"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(text)
+        print(f"Wrote {path}")
+    return 0
+
+
+class PowerProfileManager:
+    def __init__(self, metrics_textfile=None):
+        setup_logging(LOG_FILE, EVENTS_FILE)
         logging.info("Power Profile Manager started (TuneD)")
-        
+
+        self.metrics = MetricsStore(METRICS_FILE, textfile=metrics_textfile, prefix=METRICS_PREFIX)
+        self.tuned = self.connect_tuned()
+        self.active_profile = None
+        self.active_profile_stamp = None
+
         if not self.check_tuned():
             logging.error("TuneD not found or not running")
             sys.exit(1)
-        
-        logging.info("Using TuneD for power profile management")
+
+        logging.info(f"Using TuneD ({self.tuned.name}) for power profile management")
+        self.applied_profile = None
+        self.last_power_state = None
+        self.matrix = ProfileMatrix()
+        with self.metrics.timed('power_scan'):
+            self.power_supplies = PowerSupplyIndex()
+        self.thermal = ThermalSampler(state_file=THERMAL_STATE_FILE, context=self.thermal_context)
+
+    def thermal_context(self):
+        """GPU mode and TuneD profile a throttling episode is recorded under"""
+        return read_gpu_mode(), self.get_active_profile()
+    
+    def connect_tuned(self):
+        """Prefer TuneD's D-Bus API, fall back to tuned-adm"""
+        try:
+            backend = TunedDBusBackend()
+            if backend.is_running():
+                return backend
+        except Exception as e:
+            logging.info(f"TuneD D-Bus API unavailable, falling back to tuned-adm: {e}")
+        return TunedAdmBackend()
     
     def check_tuned(self):
         """Check if TuneD is active"""
         try:
-            result = subprocess.run(['systemctl', 'is-active', 'tuned'],
-                                  capture_output=True, text=True, timeout=2)
-            return result.returncode == 0 and result.stdout.strip() == "active"
-        except:
+            return self.tuned.is_running()
+        except Exception:
             return False
     
+    def _active_profile_stamp(self):
+        try:
+            st = TUNED_ACTIVE_PROFILE_FILE.stat()
+            return (st.st_mtime_ns, st.st_size)
+        except OSError:
+            return None
+    
+    def get_active_profile(self):
+        """Active TuneD profile, queried once and re-queried only if TuneD switched since"""
+        stamp = self._active_profile_stamp()
+        if self.active_profile is None or stamp != self.active_profile_stamp:
+            try:
+                with self.metrics.timed('tuned_query'):
+                    self.active_profile = self.tuned.active_profile()
+                self.active_profile_stamp = stamp
+            except Exception as e:
+                logging.error(f"Error querying active TuneD profile: {e}")
+                self.active_profile = None
+        return self.active_profile
+    
     def is_on_ac_power(self):
         """Check if system is on AC power"""
-        try:
-            power_supply_path = Path("/sys/class/power_supply")
-            for adapter in power_supply_path.glob("AC*"):
-                online_file = adapter / "online"
-                if online_file.exists():
-                    return online_file.read_text().strip() == "1"
-            
-            for adapter in power_supply_path.glob("A*"):
-                if adapter.name.startswith("AC") or adapter.name.startswith("ADP"):
-                    online_file = adapter / "online"
-                    if online_file.exists():
-                        return online_file.read_text().strip() == "1"
-            
-            return False
-        except Exception as e:
-            logging.error(f"Error checking AC power status: {e}")
-            return False
+        return self.power_supplies.active_source() is not None
     
     def set_tuned_profile(self, profile):
-        """Set TuneD profile"""
+        """Set TuneD profile, skipping the switch if it is already active"""
+        if self.get_active_profile() == profile:
+            logging.info(f"TuneD profile {profile} already active, not re-applying")
+            return True
         try:
-            result = subprocess.run(['tuned-adm', 'profile', profile],
-                                  capture_output=True, text=True, timeout=10)
-            if result.returncode == 0:
+            with self.metrics.timed('tuned_switch'):
+                ok, message = self.tuned.switch_profile(profile)
+            if ok:
                 logging.info(f"Set TuneD profile to {profile}")
+                log_event('profile-changed', profile=profile, previous=self.active_profile)
+                self.active_profile = profile
+                self.active_profile_stamp = self._active_profile_stamp()
                 return True
             else:
-                logging.error(f"Failed to set TuneD profile: {result.stderr}")
+                logging.error(f"Failed to set TuneD profile: {message}")
                 return False
         except Exception as e:
             logging.error(f"Error setting TuneD profile: {e}")
             return False
     
+    def source_kind(self, source):
+        """Matrix source name for the active power source (None = battery)"""
+        if source is None:
+            return "battery"
+        if source['watts'] is not None and source['watts'] < LOW_POWER_CHARGER_WATTS:
+            return "ac-low-power"
+        return "ac"
+
+    def profile_for_state(self, on_ac, source=None, gpu_mode="unknown", capacity=None):
+        """Pick the TuneD profile for a power source, GPU mode and battery level"""
+        kind = self.source_kind(source) if on_ac else "battery"
+        band = self.matrix.band(capacity)
+        profile, rule = self.matrix.lookup(kind, gpu_mode, band)
+        logging.info(f"Profile for {kind}/{gpu_mode}/{band}: {profile} (rule {rule or 'fallback'})")
+        return profile
+
+    def current_profile_choice(self):
+        source = self.power_supplies.active_source()
+        on_ac = source is not None
+        if on_ac:
+            rating = f"{source['watts']:.0f}W" if source['watts'] is not None else "unknown rating"
+            logging.info(f"Current power state: AC via {source['name']} ({source['type']}, {rating})")
+        else:
+            logging.info("Current power state: Battery")
+        state = (on_ac, source['name'] if source else None)
+        if state != self.last_power_state:
+            self.last_power_state = state
+            log_event('power-changed', on_battery=not on_ac, source=state[1],
+                      watts=source['watts'] if source else None)
+        profile = self.profile_for_state(on_ac, source, read_gpu_mode(), read_battery_capacity())
+        adjusted = self.thermal.adjust(profile)
+        if adjusted != profile:
+            logging.info(f"Using {adjusted} instead of {profile} after repeated thermal throttling")
+        return adjusted
+
+    def apply_profile(self, profile):
+        """Set `profile`, falling back to the stock profile if a custom one is missing"""
+        if self.set_tuned_profile(profile):
+            self.applied_profile = profile
+            return True
+        fallback = PROFILE_FALLBACKS[self.source_kind(self.power_supplies.active_source())]
+        if fallback != profile and self.set_tuned_profile(fallback):
+            logging.warning(f"Using {fallback} instead (run power-profile-manager --write-profiles?)")
+            # Remember the intended profile so the next evaluation does not retry it
+            self.applied_profile = profile
+            return True
+        return False
+
     def set_profile_for_current_state(self):
-        """Set appropriate TuneD profile based on current AC status"""
-        on_ac = self.is_on_ac_power()
-        power_state = "AC" if on_ac else "Battery"
-        logging.info(f"Current power state: {power_state}")
-        
-        profile = "throughput-performance" if on_ac else "powersave"
-        return self.set_tuned_profile(profile)
+        """Set appropriate TuneD profile based on power source, GPU mode and battery level"""
+        return self.apply_profile(self.current_profile_choice())
+
+    def apply_if_changed(self):
+        """Re-evaluate the power state, only touch TuneD on a real transition"""
+        profile = self.current_profile_choice()
+        if profile == self.applied_profile:
+            logging.info(f"Power state unchanged, keeping profile {profile}")
+            return False
+        return self.apply_profile(profile)
+
+    def run_daemon(self, debounce=UEVENT_DEBOUNCE, max_delay=UEVENT_MAX_DELAY):
+        """Stay resident and coalesce bursts of power_supply uevents into one decision
+
+        Between events, the thermal sampler runs at the interval it asks for.
+        """
+        monitor = UeventMonitor()
+        logging.info(f"Daemon mode: listening for power_supply uevents (debounce {debounce}s)")
+        self.set_profile_for_current_state()
+
+        first_event = None
+        deadline = None
+        pending = 0
+        thermal_due = time.monotonic() if self.thermal.enabled else None
+        try:
+            while True:
+                now = time.monotonic()
+                if thermal_due is not None and now >= thermal_due:
+                    with self.metrics.timed('thermal_sample'):
+                        interval, changed = self.thermal.sample()
+                    thermal_due = now + interval
+                    # With power events pending, their evaluation picks up the change
+                    if changed and deadline is None:
+                        self.apply_if_changed()
+                wakeups = [t for t in (deadline, thermal_due) if t is not None]
+                timeout = max(0.0, min(wakeups) - time.monotonic()) if wakeups else None
+                ready, _, _ = select.select([monitor], [], [], timeout)
+                if ready:
+                    try:
+                        event = monitor.receive()
+                    except OSError as e:
+                        # ENOBUFS after a flood: events were lost, rebuild the index
+                        logging.warning(f"uevent receive error, rescanning power supplies: {e}")
+                        self.power_supplies.rescan()
+                        event = {}
+                    if event is None:
+                        continue
+                    if event:
+                        self.power_supplies.update(event)
+                    now = time.monotonic()
+                    if first_event is None:
+                        first_event = now
+                    pending += 1
+                    deadline = min(now + debounce, first_event + max_delay)
+                    continue
+                if deadline is None or time.monotonic() < deadline:
+                    continue
+
+                logging.info(f"Handling {pending} coalesced power_supply event(s)")
+                first_event = None
+                deadline = None
+                pending = 0
+                self.apply_if_changed()
+        except KeyboardInterrupt:
+            logging.info("Daemon stopped")
+        finally:
+            monitor.close()
 
 if __name__ == "__main__":
-    manager = PowerProfileManager()
-    manager.set_profile_for_current_state()
+    parser = argparse.ArgumentParser(description="Switch TuneD profiles on AC/battery changes")
+    parser.add_argument('--daemon', action='store_true',
+                        help="stay running and react to power_supply uevents (default: apply once and exit)")
+    parser.add_argument('--stats', action='store_true', help="print TuneD/power scan timing percentiles")
+    parser.add_argument('--metrics-textfile', metavar='PATH',
+                        help="keep a node_exporter textfile with operation timings at PATH")
+    parser.add_argument('--events', action='store_true', help="print logged power and profile changes")
+    parser.add_argument('--thermal', action='store_true',
+                        help="print temperature sensors, throttle points and throttling history")
+    parser.add_argument('--type', action='append', metavar='EVENT',
+                        help="with --events, only show this event type (repeatable)")
+    parser.add_argument('--since', metavar='TIME', help="with --events, e.g. 2h, 1d or 2024-05-01T12:00")
+    parser.add_argument('--until', metavar='TIME', help="with --events, end of the time range")
+    parser.add_argument('--json', action='store_true', help="with --events, print JSON lines")
+    parser.add_argument('--write-profiles', nargs='?', const=TUNED_PROFILE_DIR, metavar='DIR',
+                        help=f"generate the custom TuneD profiles for this machine into DIR (default {TUNED_PROFILE_DIR})")
+    args = parser.parse_args()
+    
+    if args.write_profiles:
+        sys.exit(write_tuned_profiles(args.write_profiles))
+    
+    if args.thermal:
+        sys.exit(print_thermal(ThermalSampler()))
+    
+    if args.events:
+        sys.exit(print_events(EVENTS_FILE, args.type, args.since, args.until, args.json))
+    
+    if args.stats:
+        metrics = MetricsStore(METRICS_FILE, prefix=METRICS_PREFIX)
+        print(metrics.format_stats())
+        if args.metrics_textfile:
+            metrics.write_textfile(args.metrics_textfile)
+        sys.exit(0)
+    
+    manager = PowerProfileManager(metrics_textfile=args.metrics_textfile)
+    if args.daemon:
+        manager.run_daemon()
+    else:
+        manager.set_profile_for_current_state()
@@ -0,0 +1,45 @@
+"""Shared fixtures: the two programs loaded as modules and a fake sysfs tree
+
+The trees come from bench/fakesys.py, the same ones the benchmarks use.
+Clocks are plain lists so a test can move time forward by assigning to [0].
+"""
+import importlib.util
+import sys
+from importlib.machinery import SourceFileLoader
+from pathlib import Path
+
+import pytest
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_DIR / "bench"))
+sys.path.insert(0, str(REPO_DIR))
+import fakesys
+
+
+def load_module(name, path):
+    loader = SourceFileLoader(name, str(path))
+    module = importlib.util.module_from_spec(importlib.util.spec_from_loader(name, loader))
+    loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(scope="session")
+def gpumode():
+    return load_module("gpumode", REPO_DIR / "GPUMode.py")
+
+
+@pytest.fixture(scope="session")
+def ppm():
+    return load_module("power_profile_manager", REPO_DIR / "power-profile-manager.py")
+
+
+@pytest.fixture
+def tree(tmp_path):
+    """Fake FW16 tree in hybrid mode on AC (see fakesys.build_tree)"""
+    return fakesys.build_tree(tmp_path / "root")
+
+
+@pytest.fixture
+def clock():
+    now = [0.0]
+    return now
@@ -0,0 +1,116 @@
+"""PowerPolicy decisions on a simulated clock, fed from the fake power supplies"""
+import pytest
+
+import fakesys
+
+CHARGER = "ucsi-source-psy-USBC000:001"
+
+
+@pytest.fixture
+def make_policy(gpumode, tmp_path, clock):
+    def make(**policy):
+        settings = tmp_path / "settings.conf"
+        settings.write_text("[policy]\n" + "".join(f"{k} = {v}\n" for k, v in policy.items()))
+        return gpumode.PowerPolicy(gpumode.Settings(settings), clock=lambda: clock[0])
+    return make
+
+
+def observe(gpumode, policy, tree, settled=False):
+    """Feed the policy what the tray would see for the tree's current power state"""
+    on_battery = gpumode.probe_on_battery(tree / "sys")
+    capacity = float((tree / "sys/class/power_supply/BAT1/capacity").read_text())
+    policy.observe(on_battery, capacity, settled=settled)
+
+
+def unplug(tree, capacity=80):
+    fakesys.set_supply_online(tree, CHARGER, False)
+    fakesys.set_battery(tree, "Discharging", capacity)
+
+
+def plug(tree, capacity=80):
+    fakesys.set_supply_online(tree, CHARGER, True)
+    fakesys.set_battery(tree, "Charging", capacity)
+
+
+def test_battery_suggestion_waits_for_debounce(gpumode, make_policy, tree, clock):
+    policy = make_policy(debounce=30)
+    observe(gpumode, policy, tree, settled=True)
+    unplug(tree)
+    observe(gpumode, policy, tree)
+    assert policy.evaluate('hybrid') is None
+    assert policy.retry_in == 30
+    clock[0] = 29.9
+    assert policy.evaluate('hybrid') is None
+    clock[0] = 30
+    decision = policy.evaluate('hybrid')
+    assert decision == {'target': 'integrated', 'reason': "running on battery", 'action': 'notify'}
+
+
+def test_flapping_power_restarts_debounce(gpumode, make_policy, tree, clock):
+    policy = make_policy(debounce=30)
+    observe(gpumode, policy, tree, settled=True)
+    for t, change in ((0, unplug), (10, plug), (20, unplug)):
+        clock[0] = t
+        change(tree)
+        observe(gpumode, policy, tree)
+    clock[0] = 30
+    assert policy.evaluate('hybrid') is None
+    assert policy.retry_in == pytest.approx(20)
+    clock[0] = 50
+    assert policy.evaluate('hybrid')['target'] == 'integrated'
+
+
+def test_suggestion_fires_once_per_period_and_respects_cooldown(gpumode, make_policy, tree, clock):
+    policy = make_policy(debounce=0, cooldown=600)
+    unplug(tree)
+    observe(gpumode, policy, tree)
+    assert policy.evaluate('hybrid') is not None
+    clock[0] = 100
+    assert policy.evaluate('hybrid') is None
+    assert policy.retry_in is None
+    # A new battery period re-arms the suggestion, but only once the cooldown passed
+    plug(tree)
+    observe(gpumode, policy, tree)
+    unplug(tree)
+    observe(gpumode, policy, tree)
+    assert policy.evaluate('hybrid') is None
+    assert policy.retry_in == pytest.approx(500)
+    clock[0] = 600
+    assert policy.evaluate('hybrid') is not None
+
+
+def test_battery_threshold_has_hysteresis(gpumode, make_policy, tree, clock):
+    policy = make_policy(debounce=0, cooldown=0, battery_percent_below=20, hysteresis_percent=5)
+    unplug(tree, capacity=50)
+    observe(gpumode, policy, tree)
+    assert policy.evaluate('hybrid') is None
+    fakesys.set_battery(tree, "Discharging", 20)
+    observe(gpumode, policy, tree)
+    assert policy.evaluate('hybrid')['reason'] == "battery at 20%"
+    # Wobbling within the hysteresis band neither clears the low state nor re-fires
+    for capacity in (24, 19, 25):
+        fakesys.set_battery(tree, "Discharging", capacity)
+        observe(gpumode, policy, tree)
+        assert policy.battery_low
+        assert policy.evaluate('hybrid') is None
+    # Rising past the band re-arms; dropping to the threshold again fires again
+    fakesys.set_battery(tree, "Discharging", 26)
+    observe(gpumode, policy, tree)
+    assert not policy.battery_low
+    fakesys.set_battery(tree, "Discharging", 20)
+    observe(gpumode, policy, tree)
+    assert policy.evaluate('hybrid')['target'] == 'integrated'
+
+
+def test_ac_suggests_hybrid_and_nvidia_mode_only_notifies(gpumode, make_policy, tree, clock):
+    policy = make_policy(debounce=30, action='schedule')
+    unplug(tree)
+    observe(gpumode, policy, tree, settled=True)
+    decision = policy.evaluate('nvidia')
+    assert decision['target'] == 'integrated' and decision['action'] == 'notify'
+    plug(tree)
+    observe(gpumode, policy, tree)
+    assert policy.evaluate('hybrid') is None
+    clock[0] = 30
+    assert policy.evaluate('integrated') == {'target': 'hybrid', 'reason': "AC power connected",
+                                             'action': 'schedule'}
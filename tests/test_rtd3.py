@@ -0,0 +1,125 @@
+"""dGPU runtime PM residency and the awake warning on the fake sysfs tree"""
+import pytest
+
+import fakesys
+
+INTERVAL = 10
+
+
+class FakeDGPU:
+    """Advance the dGPU's runtime PM counters (milliseconds) in the fake tree"""
+
+    def __init__(self, tree, clock):
+        self.power = tree / "sys/bus/pci/devices" / fakesys.DGPU_BDF / "power"
+        self.clock = clock
+        self.suspended = 0
+        self.active = 0
+
+    def run(self, seconds, status, sample):
+        """Stay in `status` for `seconds`, calling sample() every INTERVAL seconds"""
+        for _ in range(int(seconds // INTERVAL)):
+            self.clock[0] += INTERVAL
+            if status == "suspended":
+                self.suspended += INTERVAL * 1000
+            else:
+                self.active += INTERVAL * 1000
+            self.write(status)
+            sample()
+
+    def write(self, status):
+        (self.power / "runtime_status").write_text(status + "\n")
+        (self.power / "runtime_suspended_time").write_text(f"{self.suspended}\n")
+        (self.power / "runtime_active_time").write_text(f"{self.active}\n")
+
+
+@pytest.fixture
+def monitor(gpumode, tree, clock):
+    return gpumode.RuntimePMMonitor(sysfs_root=tree / "sys", clock=lambda: clock[0])
+
+
+@pytest.fixture
+def dgpu(tree, clock):
+    return FakeDGPU(tree, clock)
+
+
+@pytest.fixture
+def service(gpumode, tree, tmp_path, clock):
+    settings = tmp_path / "settings.conf"
+    settings.write_text("[gpumode]\nrtd3_warn_minutes = 15\n")
+    service = gpumode.GPUModeService(gpumode.Settings(settings),
+                                     gpumode.MetricsStore(tmp_path / "metrics.bin"), publish=False)
+    service.rtd3 = gpumode.RuntimePMMonitor(sysfs_root=tree / "sys", clock=lambda: clock[0])
+    service.holder_scanner = gpumode.GPUHolderScanner(proc_root=tmp_path / "proc", sysfs_root=tree / "sys")
+    service.mode = 'hybrid'
+    service.events = []
+    service.add_listener(lambda event, data: service.events.append((event, data)))
+    return service
+
+
+def warnings(service):
+    return [data for event, data in service.events if event == 'dgpu-awake']
+
+
+def test_finds_the_nvidia_gpu(monitor):
+    assert monitor.sample() == "suspended"
+    assert monitor.bdf == fakesys.DGPU_BDF
+
+
+def test_residency_windows(monitor, dgpu):
+    dgpu.write("suspended")
+    monitor.sample()
+    assert monitor.residency(60) is None
+    dgpu.run(300, "suspended", monitor.sample)
+    dgpu.run(300, "active", monitor.sample)
+    assert monitor.residency(60) == 0.0
+    assert monitor.residency(600) == pytest.approx(0.5)
+    # Longer than what was sampled: measured over everything so far
+    assert monitor.residency(3600) == pytest.approx(0.5)
+    dgpu.run(60, "suspended", monitor.sample)
+    assert monitor.residency(60) == 1.0
+    # The window now starts 60 s into the suspended stretch
+    assert monitor.residency(600) == pytest.approx(300 / 600)
+
+
+def test_counter_reset_starts_over(monitor, dgpu):
+    dgpu.run(100, "active", monitor.sample)
+    # The device was removed and re-added: counters start from zero again
+    dgpu.suspended = dgpu.active = 0
+    dgpu.run(20, "suspended", monitor.sample)
+    assert monitor.residency(600) == 1.0
+
+
+def test_awake_for_counts_from_the_last_suspension(monitor, dgpu, clock):
+    dgpu.run(50, "suspended", monitor.sample)
+    dgpu.run(120, "active", monitor.sample)
+    assert monitor.awake_for() == 120
+
+
+def test_warns_once_after_the_limit_and_rearms(service, dgpu, clock):
+    dgpu.write("active")
+    service.sample_rtd3()
+    dgpu.run(890, "active", service.sample_rtd3)
+    assert warnings(service) == []
+    dgpu.run(10, "active", service.sample_rtd3)
+    assert len(warnings(service)) == 1
+    assert warnings(service)[0]['minutes'] == pytest.approx(15, abs=0.2)
+    assert warnings(service)[0]['bdf'] == fakesys.DGPU_BDF
+    dgpu.run(600, "active", service.sample_rtd3)
+    assert len(warnings(service)) == 1
+    # Suspending re-arms the warning; a further 15 awake minutes warn again
+    dgpu.run(10, "suspended", service.sample_rtd3)
+    dgpu.run(890, "active", service.sample_rtd3)
+    assert len(warnings(service)) == 1
+    dgpu.run(10, "active", service.sample_rtd3)
+    assert len(warnings(service)) == 2
+
+
+def test_leaving_hybrid_mode_stops_monitoring(service, dgpu):
+    dgpu.run(30, "active", service.sample_rtd3)
+    assert service.rtd3.status == "active"
+    service.mode = 'integrated'
+    service.sample_rtd3()
+    assert service.rtd3.status is None
+    assert ('dgpu-status', {'status': None}) in service.events
+    dgpu.run(1800, "active", service.sample_rtd3)
+    assert warnings(service) == []
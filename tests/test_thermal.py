@@ -0,0 +1,131 @@
+"""ThermalSampler episodes, sampling rate, step-down and expiry on the fake hwmon tree"""
+import json
+
+import pytest
+
+import fakesys
+
+PROFILE = "throughput-performance"
+
+
+@pytest.fixture
+def make_sampler(ppm, tree, tmp_path, clock, monkeypatch):
+    # An idle machine, so only temperatures decide the sampling rate
+    (tree / "proc").mkdir(exist_ok=True)
+    (tree / "proc/loadavg").write_text("0.00 0.00 0.00 1/100 1\n")
+    monkeypatch.setattr(ppm, "PROC_ROOT", str(tree / "proc"))
+
+    def make(profile=PROFILE, **thermal):
+        config = tmp_path / "power-profile-manager.conf"
+        config.write_text("[thermal]\n" + "".join(f"{k} = {v}\n" for k, v in thermal.items()))
+        return ppm.ThermalSampler(sysfs_root=tree / "sys", config_path=config,
+                                  state_file=tmp_path / "thermal.json", clock=lambda: clock[0],
+                                  context=lambda: ("hybrid", profile))
+    return make
+
+
+def episode(tree, sampler, clock, seconds=20, celsius=83):
+    """Run the NVMe drive past its 81.85 °C limit for `seconds`, then cool everything down"""
+    fakesys.set_temperature(tree, celsius, "nvme")
+    for _ in range(seconds):
+        sampler.sample()
+        clock[0] += 1
+    fakesys.set_temperature(tree, 45)
+    return sampler.sample()
+
+
+def test_resolves_sensor_limits(make_sampler):
+    sampler = make_sampler()
+    limits = {c['name']: c['limit'] for c in sampler.resolve()}
+    assert limits == {
+        "k10temp/Tctl": 95.0,                    # no limit: the default
+        "amdgpu/edge": 95.0,                     # crit 100 less the margin
+        "nvme/Composite": pytest.approx(81.85),  # max
+        "thermal_zone0/acpitz": 90.0,            # passive trip point
+    }
+
+
+def test_sampling_speeds_up_near_the_limit(make_sampler, tree):
+    sampler = make_sampler()
+    assert sampler.sample() == (30, False)
+    fakesys.set_temperature(tree, 65, "nvme")   # 16.85 °C below the limit
+    assert sampler.sample() == (5, False)
+    fakesys.set_temperature(tree, 75, "nvme")   # 6.85 °C below
+    assert sampler.sample() == (1, False)
+    assert sampler.episode is None
+
+
+def test_episode_starts_at_the_limit_and_ends_after_cooling(make_sampler, tree, clock, tmp_path):
+    sampler = make_sampler()
+    sampler.sample()
+    fakesys.set_temperature(tree, 82, "nvme")
+    sampler.sample()
+    assert sampler.episode['sensor'] == "nvme/Composite"
+    assert sampler.episode['profile'] == PROFILE
+    clock[0] = 5
+    fakesys.set_temperature(tree, 84, "nvme")
+    sampler.sample()
+    assert sampler.episode['peak'] == 84
+    # Below the limit but within the hysteresis: still the same episode
+    clock[0] = 10
+    fakesys.set_temperature(tree, 80, "nvme")
+    assert sampler.sample() == (1, False)
+    assert sampler.episode is not None
+    clock[0] = 12
+    fakesys.set_temperature(tree, 78, "nvme")
+    sampler.sample()
+    assert sampler.episode is None
+    record, = sampler.episodes
+    assert record['seconds'] == 12
+    assert (record['gpu_mode'], record['profile'], record['peak']) == ("hybrid", PROFILE, 84)
+    assert json.loads((tmp_path / "thermal.json").read_text())['episodes'] == [record]
+
+
+def test_rising_throttle_counter_starts_an_episode(make_sampler, tree):
+    cpu = tree / "sys/devices/system/cpu/cpu0"
+    (cpu / "thermal_throttle").mkdir(parents=True)
+    (cpu / "topology").mkdir()
+    (cpu / "topology/physical_package_id").write_text("0\n")
+    counter = cpu / "thermal_throttle/package_throttle_count"
+    counter.write_text("7\n")
+    sampler = make_sampler()
+    sampler.sample()
+    sampler.sample()
+    assert sampler.episode is None
+    counter.write_text("9\n")
+    sampler.sample()
+    assert sampler.episode is not None
+
+
+def test_repeats_only_recommend_by_default(make_sampler, tree, clock):
+    sampler = make_sampler()
+    for _ in range(3):
+        assert episode(tree, sampler, clock)[1] is False
+    assert PROFILE in sampler.recommended
+    assert sampler.adjust(PROFILE) == PROFILE
+
+
+def test_apply_steps_down_and_restores_after_the_window(make_sampler, tree, clock):
+    sampler = make_sampler(action="apply", repeat_count=3, repeat_window=1800)
+    assert episode(tree, sampler, clock)[1] is False
+    assert episode(tree, sampler, clock)[1] is False
+    assert sampler.adjust(PROFILE) == PROFILE
+    assert episode(tree, sampler, clock)[1] is True
+    assert sampler.adjust(PROFILE) == "balanced"
+    stepped_down_at = clock[0]
+    # Another episode under the step-down pushes the expiry back
+    clock[0] += 1000
+    episode(tree, sampler, clock)
+    clock[0] = stepped_down_at + 1800
+    assert sampler.sample() == (30, False)
+    assert sampler.adjust(PROFILE) == "balanced"
+    clock[0] += 1800
+    assert sampler.sample() == (30, True)
+    assert sampler.adjust(PROFILE) == PROFILE
+
+
+def test_profiles_without_a_step_down_are_left_alone(make_sampler, tree, clock):
+    sampler = make_sampler(profile="powersave", action="apply")
+    for _ in range(3):
+        assert episode(tree, sampler, clock)[1] is False
+    assert sampler.demoted == {}